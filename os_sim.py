@@ -0,0 +1,693 @@
+#!/usr/bin/env python3
+
+# Simulated openstack CLI, for benchmarks and dry runs of os_vm_transfer.py without any cloud:
+#   ./os_vm_transfer.py --openstack-cmd './os_sim.py' ...
+# The state of all the simulated clouds is kept in $OS_SIM_DIR (default .os_sim), see init_state().
+# With --serve, it also serves the image data over HTTP like the Glance endpoint, for ranged downloads.
+
+sim_dir = '.os_sim'
+default_config = {
+    # Seconds spent by each call, per command or 'default'
+    'latency': {'default': 0.0},
+    # Seconds before a new resource leaves its transitional status ('creating', 'saving', 'BUILD'...)
+    'delay': {'server': 1.0, 'server stop': 1.0, 'volume': 1.0, 'snapshot': 1.0, 'image': 2.0, 'delete': 0.5},
+    # Probability for a command to fail with an error on stderr
+    'errors': {},
+    # Probability for an image save stream to break off halfway, like a flaky link
+    'stream_breaks': 0,
+    # Probability for a new resource of a type to end up in error status
+    'error_status': {},
+    # Synthetic image payloads: size, share of zero blocks, block size and bandwidth (bytes/s, 0 = unlimited)
+    'image_size': 16 * 1024 * 1024,
+    'zero_percent': 0,
+    'block_size': 64 * 1024,
+    'bandwidth': 0,
+    # Image endpoint returned by catalog show, set by os_sim.py --serve, and whether it supports HTTP ranges
+    'image_url': None,
+    'http_ranges': True,
+    # Data volumes attached to each VM besides its boot volume, and their size (GiB)
+    'data_volumes': 0,
+    'data_volume_size': 10,
+    # Share (%) of the blocks that all the VMs have in common, as if made from the same base image
+    'shared_percent': 0,
+    # Share (%) of the blocks rewritten by a running VM after each snapshot of its volumes, see seed_generation()
+    'change_percent': 5,
+}
+
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import fcntl
+import re
+import http.server
+
+flag_options = ['--unprotected', '--protected', '--bootable', '--force', '--long', '--private', '--public', '--all']
+commands = ['server show', 'server stop', 'server create', 'server add volume', 'server list', 'flavor show', 'flavor list', 'volume show', 'volume create', 'volume delete', 'volume list', 'volume snapshot create', 'volume snapshot show', 'volume snapshot delete', 'volume snapshot list', 'image create', 'image show', 'image save', 'image delete', 'image list', 'network list', 'security group list', 'keypair list', 'port list', 'floating ip list', 'floating ip create', 'floating ip set', 'floating ip delete', 'token issue', 'catalog show']
+no_format_cmds = ['server stop', 'server add volume', 'volume delete', 'volume snapshot delete', 'image save', 'image delete', 'floating ip set']
+
+class SimError(Exception):
+    pass
+
+def get_sim_dir():
+    return os.environ.get('OS_SIM_DIR', sim_dir)
+
+def load_config():
+    config = json.loads(json.dumps(default_config))
+    filename = os.path.join(get_sim_dir(), 'config.json')
+    if os.path.isfile(filename):
+        with open(filename, 'r') as f:
+            for key, value in json.load(f).items():
+                if isinstance(value, dict) and isinstance(config.get(key), dict):
+                    config[key].update(value)
+                else:
+                    config[key] = value
+    return config
+
+def init_state(directory, clouds, vms, config=None, export_cloud=None):
+    os.makedirs(os.path.join(directory, 'blobs'), exist_ok=True)
+
+    state = {'next_id': 1, 'clouds': {}}
+    for cloud in clouds:
+        state['clouds'][cloud] = {'servers': {}, 'volumes': {}, 'snapshots': {}, 'images': {}, 'ports': {}, 'floating_ips': {},
+                                  'flavors': {'m1.small': {'id': 'm1.small', 'name': 'm1.small', 'ram': 2048, 'disk': 20, 'vcpus': 1}, 'm1.medium': {'id': 'm1.medium', 'name': 'm1.medium', 'ram': 4096, 'disk': 40, 'vcpus': 2}},
+                                  'networks': {'private': {'id': 'private', 'name': 'private', 'cidr': '10.0.0.0/16'}, 'ext-net1': {'id': 'ext-net1', 'name': 'ext-net1', 'cidr': '192.0.2.0/24'}},
+                                  'security_groups': ['default'], 'keypairs': ['default']}
+
+    # The VMs to migrate live on the export cloud, each with a boot volume, its data volumes and a floating IP
+    if export_cloud is None:
+        export_cloud = clouds[0]
+    cloud = state['clouds'][export_cloud]
+    data_volumes = (config or {}).get('data_volumes', default_config['data_volumes'])
+    data_volume_size = (config or {}).get('data_volume_size', default_config['data_volume_size'])
+    i = 0
+    for vm in vms:
+        i += 1
+        volume_id = new_id(state, 'vol')
+        server_id = new_id(state, 'srv')
+        cloud['volumes'][volume_id] = {'id': volume_id, 'name': vm, 'vm': vm, 'size': 20, 'attached_to': server_id, 'data_seed': vm, 'created': 0, 'ready_at': 0}
+        ip = '10.0.%s.%s' %(i // 250, i % 250 + 2)
+        fip = '192.0.2.%s' %(i % 250 + 2)
+        volume_ids = [volume_id]
+        for disk in range(1, data_volumes + 1):
+            volume_id = new_id(state, 'vol')
+            cloud['volumes'][volume_id] = {'id': volume_id, 'name': '%s-disk%s' %(vm, disk), 'vm': vm, 'size': data_volume_size, 'attached_to': server_id, 'data_seed': '%s-disk%s' %(vm, disk), 'created': 0, 'ready_at': 0}
+            volume_ids.append(volume_id)
+        cloud['servers'][server_id] = {'id': server_id, 'name': vm, 'vm': vm, 'status': 'ACTIVE', 'key_name': 'default', 'flavor': 'm1.small', 'security_groups': ['default'], 'addresses': {'private': [ip, fip]}, 'volumes': volume_ids, 'created': 0, 'ready_at': 0}
+        port_id = new_id(state, 'port')
+        cloud['ports'][port_id] = {'id': port_id, 'server': server_id, 'network': 'private', 'ip': ip}
+        fip_id = new_id(state, 'fip')
+        cloud['floating_ips'][fip_id] = {'id': fip_id, 'address': fip, 'port': port_id, 'fixed_ip': ip}
+
+    with open(os.path.join(directory, 'state.json'), 'w') as f:
+        json.dump(state, f)
+    with open(os.path.join(directory, 'config.json'), 'w') as f:
+        json.dump(config if config is not None else {}, f, indent=4)
+    open(os.path.join(directory, 'calls.log'), 'w').close()
+
+    return state
+
+def new_id(state, kind):
+    result = '%s-%06d' %(kind, state['next_id'])
+    state['next_id'] += 1
+    return result
+
+class SimState:
+    __lock_file = None
+    state = None
+
+    def __enter__(self):
+        self.__lock_file = open(os.path.join(get_sim_dir(), 'state.lock'), 'w')
+        fcntl.flock(self.__lock_file, fcntl.LOCK_EX)
+        with open(os.path.join(get_sim_dir(), 'state.json'), 'r') as f:
+            self.state = json.load(f)
+        return self
+
+    def save(self):
+        tmp_filename = os.path.join(get_sim_dir(), 'state.json.tmp')
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_filename, os.path.join(get_sim_dir(), 'state.json'))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.__lock_file, fcntl.LOCK_UN)
+        self.__lock_file.close()
+
+def seed_generation(seed, generations):
+    # A seed '<base>@<N>' is the payload of <base> after N rounds of writes
+    base, _, generation = seed.partition('@')
+    generation = int(generation or 0) + generations
+    if generation == 0:
+        return base
+    return '%s@%s' %(base, generation)
+
+def payload_chunks(seed, size, zero_percent, block_size, change_percent=0, shared_percent=0):
+    base, _, generation = seed.partition('@')
+    generation = int(generation or 0)
+    offset = 0
+    block = 0
+    while offset < size:
+        length = min(block_size, size - offset)
+        # Blocks of the common base image, then the last round of writes that changed the block
+        block_seed = base
+        if random.Random('shared-%s' %(block)).randrange(100) < shared_percent:
+            block_seed = 'shared'
+        for i in range(1, generation + 1):
+            if random.Random('%s-%s-%s' %(base, block, i)).randrange(100) < change_percent:
+                block_seed = '%s@%s' %(base, i)
+        rnd = random.Random('%s-%s' %(block_seed, block))
+        if rnd.randrange(100) < zero_percent:
+            yield bytes(length)
+        else:
+            yield rnd.randbytes(length)
+        offset += length
+        block += 1
+
+def payload_hashes(chunks):
+    md5 = hashlib.md5()
+    sha512 = hashlib.sha512()
+    size = 0
+    for chunk in chunks:
+        md5.update(chunk)
+        sha512.update(chunk)
+        size += len(chunk)
+    return md5.hexdigest(), sha512.hexdigest(), size
+
+def parse_params(tokens):
+    options = {}
+    positionals = []
+
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token.startswith('-') and len(token) > 1:
+            value = True
+            if token not in flag_options:
+                i += 1
+                value = tokens[i]
+            options.setdefault(token.lstrip('-'), []).append(value)
+        else:
+            positionals.append(token)
+        i += 1
+
+    return options, positionals
+
+def option(options, name, default=None):
+    if name in options:
+        return options[name][-1]
+    return default
+
+def status(res, kind, config, now):
+    if res.get('deleted_at') is not None:
+        if now >= res['deleted_at']:
+            return None
+        return 'deleting'
+    if res.get('error'):
+        return 'ERROR' if kind == 'server' else 'error'
+    if now < res.get('ready_at', 0):
+        return {'server': 'BUILD', 'volume': 'creating', 'snapshot': 'creating', 'image': 'saving'}[kind]
+    if kind == 'server':
+        if res.get('stop_at') is not None and now >= res['stop_at']:
+            return 'SHUTOFF'
+        return res['status']
+    if kind == 'volume' and res.get('attached_to') is not None:
+        return 'in-use'
+    if kind == 'image':
+        return 'active'
+    return 'available'
+
+def find(cloud, collection, kind, name_or_id, config, now):
+    items = cloud[collection]
+    res = items.get(name_or_id)
+    if res is None:
+        for item in items.values():
+            if item.get('name') == name_or_id:
+                res = item
+                break
+    if res is None or status(res, kind, config, now) is None:
+        if kind == 'image':
+            raise SimError('No Image found for %s' %(name_or_id))
+        raise SimError("No %s with a name or ID of '%s' exists." %(kind, name_or_id))
+    return res
+
+def new_resource(state, cloud, collection, kind, config, now, **fields):
+    res_id = new_id(state, kind[:3])
+    res = {'id': res_id, 'created': now, 'ready_at': now + config['delay'].get(kind, 0)}
+    res.update(fields)
+    if random.random() < config['error_status'].get(kind, 0):
+        res['error'] = True
+    cloud[collection][res_id] = res
+    return res
+
+def delete(res, config, now):
+    if res.get('deleted_at') is None:
+        res['deleted_at'] = now + config['delay'].get('delete', 0)
+
+def vm_of(name):
+    if name is None:
+        return None
+    for suffix in ['.bkp', '.rst']:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    # Data volumes of the VM
+    return re.sub(r'-disk[0-9]+$', '', name)
+
+def server_show(cloud, server, config, now):
+    flavor = cloud['flavors'].get(server['flavor'], {'id': server['flavor'], 'name': server['flavor']})
+    return {'id': server['id'], 'name': server['name'], 'status': status(server, 'server', config, now), 'key_name': server['key_name'], 'flavor': '%s (%s)' %(flavor['name'], flavor['id']), 'security_groups': [{'name': sg} for sg in server['security_groups']], 'addresses': server['addresses'], 'volumes_attached': [{'id': v} for v in server['volumes']]}
+
+def volume_show(volume, config, now):
+    return {'id': volume['id'], 'name': volume['name'], 'status': status(volume, 'volume', config, now), 'size': volume['size'], 'bootable': str(volume.get('bootable', False)).lower(), 'snapshot_id': volume.get('snapshot_id'), 'attachments': []}
+
+def snapshot_show(snapshot, config, now):
+    return {'id': snapshot['id'], 'name': snapshot['name'], 'status': status(snapshot, 'snapshot', config, now), 'size': snapshot['size'], 'volume_id': snapshot['volume_id']}
+
+def image_show(image, config, now):
+    result = {'id': image['id'], 'name': image['name'], 'status': status(image, 'image', config, now), 'checksum': None, 'size': None, 'os_hash_algo': None, 'os_hash_value': None, 'min_ram': image.get('min_ram', 0), 'min_disk': image.get('min_disk', 0), 'disk_format': image.get('disk_format'), 'container_format': image.get('container_format')}
+    if result['status'] == 'active':
+        result['checksum'] = image['checksum']
+        result['size'] = image['size']
+        result['os_hash_algo'] = 'sha512'
+        result['os_hash_value'] = image['sha512']
+    return result
+
+def image_data(image, config):
+    if image.get('blob') is not None:
+        with open(os.path.join(get_sim_dir(), 'blobs', image['blob']), 'rb') as f:
+            chunk = f.read(config['block_size'])
+            while chunk:
+                yield chunk
+                chunk = f.read(config['block_size'])
+    else:
+        for chunk in payload_chunks(image['data_seed'], image['size'], config['zero_percent'], config['block_size'], config['change_percent'], config['shared_percent']):
+            yield chunk
+
+def throttle(chunks, bandwidth):
+    start = time.time()
+    sent = 0
+    for chunk in chunks:
+        yield chunk
+        sent += len(chunk)
+        if bandwidth > 0:
+            ahead = sent / bandwidth - (time.time() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+def upload_image(state_cloud_name, name, options, data, config):
+    # The data is read before taking the lock, an upload must not block the other calls
+    blob = 'upload-%s-%s' %(os.getpid(), time.time())
+    md5 = hashlib.md5()
+    sha512 = hashlib.sha512()
+    size = 0
+    with open(os.path.join(get_sim_dir(), 'blobs', blob), 'wb') as f:
+        for chunk in throttle(data, config['bandwidth']):
+            md5.update(chunk)
+            sha512.update(chunk)
+            size += len(chunk)
+            f.write(chunk)
+
+    with SimState() as sim:
+        now = time.time()
+        cloud = sim.state['clouds'][state_cloud_name]
+        image = new_resource(sim.state, cloud, 'images', 'image', config, now, name=name, vm=vm_of(name), blob=blob, checksum=md5.hexdigest(), sha512=sha512.hexdigest(), size=size, data_seed=None, min_ram=int(option(options, 'min-ram', 0)), min_disk=int(option(options, 'min-disk', 0)), disk_format=option(options, 'disk-format'), container_format=option(options, 'container-format'))
+        sim.save()
+        return image_show(image, config, now), image['vm']
+
+def read_stdin():
+    while True:
+        chunk = sys.stdin.buffer.read(1024 * 1024)
+        if not chunk:
+            break
+        yield chunk
+
+def run_cmd(cloud_name, cmd, options, positionals, config):
+    result = None
+    vm = None
+
+    if cmd == 'image save':
+        with SimState() as sim:
+            now = time.time()
+            image = find(sim.state['clouds'][cloud_name], 'images', 'image', positionals[0], config, now)
+        vm = image.get('vm')
+        filename = option(options, 'file')
+        out = open(filename, 'wb') if filename is not None else sys.stdout.buffer
+        broken = random.random() < config['stream_breaks']
+        written = 0
+        for chunk in throttle(image_data(image, config), config['bandwidth']):
+            if broken and written >= image['size'] // 2:
+                out.flush()
+                raise SimError('Connection broken: IncompleteRead(%s bytes read)' %(written))
+            out.write(chunk)
+            written += len(chunk)
+        out.flush()
+        if filename is not None:
+            out.close()
+        return result, vm
+
+    if cmd == 'image create' and 'volume' not in options:
+        if 'file' in options:
+            f = open(option(options, 'file'), 'rb')
+            data = iter(lambda: f.read(1024 * 1024), b'')
+        else:
+            data = read_stdin()
+        return upload_image(cloud_name, positionals[0], options, data, config)
+
+    with SimState() as sim:
+        state = sim.state
+        cloud = state['clouds'][cloud_name]
+        now = time.time()
+
+        if cmd == 'server show':
+            server = find(cloud, 'servers', 'server', positionals[0], config, now)
+            vm = server.get('vm')
+            result = server_show(cloud, server, config, now)
+        elif cmd == 'server stop':
+            server = find(cloud, 'servers', 'server', positionals[0], config, now)
+            vm = server.get('vm')
+            if server.get('stop_at') is None:
+                server['stop_at'] = now + config['delay'].get('server stop', 0)
+        elif cmd == 'server list':
+            result = [{'ID': s['id'], 'Name': s['name'], 'Status': status(s, 'server', config, now), 'Networks': s['addresses'], 'Image': '', 'Flavor': s['flavor']} for s in cloud['servers'].values() if status(s, 'server', config, now) is not None]
+        elif cmd == 'server create':
+            vm = positionals[0]
+            flavor = option(options, 'flavor')
+            if flavor not in cloud['flavors']:
+                raise SimError("No flavor with a name or ID of '%s' exists." %(flavor))
+            volume = find(cloud, 'volumes', 'volume', option(options, 'volume'), config, now)
+            key_name = option(options, 'key-name')
+            if key_name not in cloud['keypairs']:
+                raise SimError('Invalid key_name provided. (HTTP 400)')
+            for sg in options.get('security-group', []):
+                if sg not in cloud['security_groups']:
+                    raise SimError("Security group %s not found for project. (HTTP 400)" %(sg))
+            addresses = {}
+            nics = []
+            for nic in options.get('nic', []):
+                nic = dict([item.split('=', 1) for item in nic.split(',')])
+                network = nic['net-id']
+                if network not in cloud['networks']:
+                    raise SimError("No network found for %s" %(network))
+                ip = nic.get('v4-fixed-ip')
+                for port in cloud['ports'].values():
+                    if port['network'] == network and port['ip'] == ip:
+                        raise SimError('Fixed IP address %s is already in use on instance. (HTTP 400)' %(ip))
+                if ip is None:
+                    ip = '10.1.%s.%s' %(state['next_id'] // 250, state['next_id'] % 250 + 2)
+                addresses.setdefault(network, []).append(ip)
+                nics.append((network, ip))
+            server = new_resource(state, cloud, 'servers', 'server', config, now, name=vm, vm=vm, status='ACTIVE', key_name=key_name, flavor=flavor, security_groups=options.get('security-group', []), addresses=addresses, volumes=[volume['id']])
+            volume['attached_to'] = server['id']
+            for network, ip in nics:
+                port_id = new_id(state, 'port')
+                cloud['ports'][port_id] = {'id': port_id, 'server': server['id'], 'network': network, 'ip': ip}
+            result = {'id': server['id'], 'name': server['name'], 'status': 'BUILD'}
+        elif cmd == 'server add volume':
+            server = find(cloud, 'servers', 'server', positionals[0], config, now)
+            vm = server.get('vm')
+            volume = find(cloud, 'volumes', 'volume', positionals[1], config, now)
+            if status(volume, 'volume', config, now) != 'available':
+                raise SimError('Invalid volume: volume %s status must be available, but current status is: %s. (HTTP 400)' %(volume['id'], status(volume, 'volume', config, now)))
+            volume['attached_to'] = server['id']
+            server['volumes'].append(volume['id'])
+        elif cmd == 'flavor show':
+            if positionals[0] not in cloud['flavors']:
+                raise SimError("No flavor with a name or ID of '%s' exists." %(positionals[0]))
+            result = dict(cloud['flavors'][positionals[0]])
+        elif cmd == 'flavor list':
+            result = [{'ID': f['id'], 'Name': f['name'], 'RAM': f['ram'], 'Disk': f['disk'], 'VCPUs': f['vcpus']} for f in cloud['flavors'].values()]
+        elif cmd == 'volume show':
+            volume = find(cloud, 'volumes', 'volume', positionals[0], config, now)
+            vm = volume.get('vm')
+            result = volume_show(volume, config, now)
+        elif cmd == 'volume create':
+            vm = vm_of(positionals[0])
+            fields = {'name': positionals[0], 'vm': vm, 'size': int(option(options, 'size', 1)), 'bootable': 'bootable' in options}
+            if 'snapshot' in options:
+                snapshot = find(cloud, 'snapshots', 'snapshot', option(options, 'snapshot'), config, now)
+                fields['snapshot_id'] = snapshot['id']
+                fields['data_seed'] = snapshot['data_seed']
+            elif 'image' in options:
+                image = find(cloud, 'images', 'image', option(options, 'image'), config, now)
+                fields['data_seed'] = image.get('data_seed') or image['id']
+            else:
+                fields['data_seed'] = None
+            volume = new_resource(state, cloud, 'volumes', 'volume', config, now, **fields)
+            result = volume_show(volume, config, now)
+        elif cmd == 'volume delete':
+            volume = find(cloud, 'volumes', 'volume', positionals[0], config, now)
+            vm = volume.get('vm')
+            delete(volume, config, now)
+        elif cmd == 'volume list':
+            result = [{'ID': v['id'], 'Name': v['name'], 'Status': status(v, 'volume', config, now), 'Size': v['size'], 'Attached to': ''} for v in cloud['volumes'].values() if status(v, 'volume', config, now) is not None]
+        elif cmd == 'volume snapshot create':
+            vm = vm_of(positionals[0])
+            volume = find(cloud, 'volumes', 'volume', option(options, 'volume'), config, now)
+            if volume.get('attached_to') is not None and 'force' not in options:
+                raise SimError('Invalid volume: Volume %s status must be available, but current status is: in-use. (HTTP 400)' %(volume['id']))
+            snapshot = new_resource(state, cloud, 'snapshots', 'snapshot', config, now, name=positionals[0], vm=vm, size=volume['size'], volume_id=volume['id'], data_seed=volume['data_seed'])
+            # The running VM goes on writing after the snapshot
+            server = cloud['servers'].get(volume.get('attached_to'))
+            if server is not None and status(server, 'server', config, now) == 'ACTIVE' and server.get('stop_at') is None:
+                volume['data_seed'] = seed_generation(volume['data_seed'], 1)
+            result = snapshot_show(snapshot, config, now)
+        elif cmd == 'volume snapshot show':
+            snapshot = find(cloud, 'snapshots', 'snapshot', positionals[0], config, now)
+            vm = snapshot.get('vm')
+            result = snapshot_show(snapshot, config, now)
+        elif cmd == 'volume snapshot delete':
+            snapshot = find(cloud, 'snapshots', 'snapshot', positionals[0], config, now)
+            vm = snapshot.get('vm')
+            delete(snapshot, config, now)
+        elif cmd == 'volume snapshot list':
+            result = [{'ID': s['id'], 'Name': s['name'], 'Status': status(s, 'snapshot', config, now), 'Size': s['size']} for s in cloud['snapshots'].values() if status(s, 'snapshot', config, now) is not None]
+        elif cmd == 'image create':
+            # Cinder upload-to-image
+            volume = find(cloud, 'volumes', 'volume', option(options, 'volume'), config, now)
+            vm = vm_of(positionals[0])
+            md5, sha512, size = payload_hashes(payload_chunks(volume['data_seed'], config['image_size'], config['zero_percent'], config['block_size'], config['change_percent'], config['shared_percent']))
+            image = new_resource(state, cloud, 'images', 'image', config, now, name=positionals[0], vm=vm, data_seed=volume['data_seed'], checksum=md5, sha512=sha512, size=size, disk_format=option(options, 'disk-format'), container_format=option(options, 'container-format'))
+            result = {'id': volume['id'], 'image_id': image['id'], 'image_name': image['name'], 'container_format': image['container_format'], 'disk_format': image['disk_format'], 'status': 'uploading', 'size': volume['size']}
+        elif cmd == 'image show':
+            image = find(cloud, 'images', 'image', positionals[0], config, now)
+            vm = image.get('vm')
+            result = image_show(image, config, now)
+        elif cmd == 'image delete':
+            image = find(cloud, 'images', 'image', positionals[0], config, now)
+            vm = image.get('vm')
+            image['deleted_at'] = now
+            if image.get('blob') is not None:
+                os.remove(os.path.join(get_sim_dir(), 'blobs', image['blob']))
+                image['blob'] = None
+        elif cmd == 'image list':
+            result = [{'ID': i['id'], 'Name': i['name'], 'Status': status(i, 'image', config, now)} for i in cloud['images'].values() if status(i, 'image', config, now) is not None]
+        elif cmd == 'network list':
+            result = [{'ID': n['id'], 'Name': n['name'], 'Subnets': [n['id']]} for n in cloud['networks'].values()]
+        elif cmd == 'security group list':
+            result = [{'ID': sg, 'Name': sg, 'Description': '', 'Project': cloud_name} for sg in cloud['security_groups']]
+        elif cmd == 'keypair list':
+            result = [{'Name': keypair, 'Fingerprint': ''} for keypair in cloud['keypairs']]
+        elif cmd == 'port list':
+            result = []
+            for port in cloud['ports'].values():
+                if 'server' in options and port['server'] != option(options, 'server'):
+                    continue
+                if 'network' in options and port['network'] != option(options, 'network'):
+                    continue
+                server = cloud['servers'].get(port['server'])
+                if server is not None:
+                    vm = server.get('vm')
+                result.append({'ID': port['id'], 'Name': '', 'MAC Address': '', 'Fixed IP Addresses': [{'ip_address': port['ip']}], 'Status': 'ACTIVE'})
+        elif cmd == 'floating ip list':
+            result = []
+            for fip in cloud['floating_ips'].values():
+                fip_status = 'ACTIVE' if fip['port'] is not None else 'DOWN'
+                if 'status' in options and option(options, 'status') != fip_status:
+                    continue
+                if 'fixed-ip-address' in options and option(options, 'fixed-ip-address') != fip['fixed_ip']:
+                    continue
+                result.append({'ID': fip['id'], 'Floating IP Address': fip['address'], 'Fixed IP Address': fip['fixed_ip'], 'Port': fip['port'], 'Floating Network': 'ext-net1', 'Project': cloud_name})
+        elif cmd == 'floating ip create':
+            if positionals[0] not in cloud['networks']:
+                raise SimError('No network found for %s' %(positionals[0]))
+            fip_id = new_id(state, 'fip')
+            address = '198.51.100.%s' %(len(cloud['floating_ips']) % 250 + 2)
+            cloud['floating_ips'][fip_id] = {'id': fip_id, 'address': address, 'port': None, 'fixed_ip': None}
+            result = {'id': fip_id, 'floating_ip_address': address, 'fixed_ip_address': None, 'port_id': None, 'status': 'DOWN'}
+        elif cmd == 'floating ip set':
+            fip = None
+            for item in cloud['floating_ips'].values():
+                if item['address'] == positionals[0] or item['id'] == positionals[0]:
+                    fip = item
+            if fip is None:
+                raise SimError('No FloatingIP found for %s' %(positionals[0]))
+            if fip['port'] is not None:
+                raise SimError('Floating IP %s is already associated with a port. (HTTP 409)' %(fip['address']))
+            fip['port'] = option(options, 'port')
+            fip['fixed_ip'] = option(options, 'fixed-ip-address')
+        elif cmd == 'token issue':
+            result = {'id': 'sim-token-%s' %(cloud_name), 'project_id': cloud_name, 'expires': time.strftime('%Y-%m-%dT%H:%M:%S+0000', time.gmtime(now + 3600))}
+        elif cmd == 'catalog show':
+            if positionals[0] != 'image' or config['image_url'] is None:
+                raise SimError("No service with a type, name or ID of '%s' exists." %(positionals[0]))
+            result = {'name': 'glance', 'type': 'image', 'endpoints': [{'id': 'endpoint-%s' %(cloud_name), 'interface': 'public', 'region': 'RegionOne', 'region_id': 'RegionOne', 'url': config['image_url']}]}
+        elif cmd == 'floating ip delete':
+            fip_id = None
+            for item in cloud['floating_ips'].values():
+                if item['address'] == positionals[0] or item['id'] == positionals[0]:
+                    fip_id = item['id']
+            if fip_id is None:
+                raise SimError('No FloatingIP found for %s' %(positionals[0]))
+            del cloud['floating_ips'][fip_id]
+        else:
+            raise SimError('openstack: \'%s\' is not an openstack command.' %(cmd))
+
+        sim.save()
+
+    return result, vm
+
+def image_range(image, config, start, end):
+    # Bytes start to end (included) of the image data
+    offset = 0
+    for chunk in image_data(image, config):
+        if offset + len(chunk) > start:
+            yield chunk[max(0, start - offset):end + 1 - offset]
+        offset += len(chunk)
+        if offset > end:
+            break
+
+class ImageRequestHandler(http.server.BaseHTTPRequestHandler):
+    # GET /v2/images/<ID>/file, like Glance, with or without Range support
+    def do_GET(self):
+        start_time = time.time()
+        config = load_config()
+        cloud_name = None
+        vm = None
+        error = None
+        try:
+            match = re.match(r'^/v2/images/([^/]+)/file$', self.path)
+            if match is None:
+                error = 'Not Found'
+                self.send_error(404)
+                return
+            if self.headers.get('X-Auth-Token') is None:
+                error = 'Unauthorized'
+                self.send_error(401)
+                return
+
+            image = None
+            with SimState() as sim:
+                now = time.time()
+                for name, cloud in sim.state['clouds'].items():
+                    if match.group(1) in cloud['images'] and status(cloud['images'][match.group(1)], 'image', config, now) == 'active':
+                        image = cloud['images'][match.group(1)]
+                        cloud_name = name
+            if image is None:
+                error = 'No Image found for %s' %(match.group(1))
+                self.send_error(404)
+                return
+            vm = image.get('vm')
+
+            size = image['size']
+            start = 0
+            end = size - 1
+            partial = False
+            match = re.match(r'^bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+            if match is not None and config['http_ranges']:
+                start = int(match.group(1))
+                if match.group(2) != '':
+                    end = min(end, int(match.group(2)))
+                if start >= size:
+                    error = 'Range Not Satisfiable'
+                    self.send_error(416)
+                    return
+                partial = True
+
+            self.send_response(206 if partial else 200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(end - start + 1))
+            if config['http_ranges']:
+                self.send_header('Accept-Ranges', 'bytes')
+            if partial:
+                self.send_header('Content-Range', 'bytes %s-%s/%s' %(start, end, size))
+            self.end_headers()
+            # The bandwidth is per connection, as a single TCP stream would be limited
+            for chunk in throttle(image_range(image, config, start, end), config['bandwidth']):
+                self.wfile.write(chunk)
+        except (BrokenPipeError, ConnectionResetError) as e:
+            error = str(e)
+        finally:
+            log_call(cloud_name, 'GET image file', vm, start_time, error)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port=0):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), ImageRequestHandler)
+    server.daemon_threads = True
+
+    # Makes catalog show return this endpoint
+    filename = os.path.join(get_sim_dir(), 'config.json')
+    config = {}
+    if os.path.isfile(filename):
+        with open(filename, 'r') as f:
+            config = json.load(f)
+    config['image_url'] = 'http://127.0.0.1:%s' %(server.server_address[1])
+    with open('%s.tmp' %(filename), 'w') as f:
+        json.dump(config, f, indent=4)
+    os.replace('%s.tmp' %(filename), filename)
+    print(config['image_url'])
+    sys.stdout.flush()
+
+    server.serve_forever()
+
+def log_call(cloud, cmd, vm, start, error):
+    entry = {'time': start, 'duration': time.time() - start, 'cloud': cloud, 'cmd': cmd, 'vm': vm, 'error': error}
+    # One small write in append mode, the lines of concurrent calls don't get mixed up
+    with open(os.path.join(get_sim_dir(), 'calls.log'), 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+def main():
+    argv = sys.argv[1:]
+    if len(argv) >= 1 and argv[0] == '--serve':
+        serve(int(argv[1]) if len(argv) > 1 else 0)
+        return
+    if len(argv) < 3 or argv[0] != '--os-cloud':
+        sys.exit('usage: os_sim.py --os-cloud <CLOUD> <COMMAND> [options]\n       os_sim.py --serve [<PORT>]')
+    cloud = argv[1]
+    argv = argv[2:]
+
+    cmd = None
+    for candidate in sorted(commands, key=len, reverse=True):
+        words = candidate.split()
+        if argv[:len(words)] == words:
+            cmd = candidate
+            argv = argv[len(words):]
+            break
+
+    start = time.time()
+    config = load_config()
+    vm = None
+    error = None
+    try:
+        if cmd is None:
+            raise SimError('openstack: \'%s\' is not an openstack command.' %(' '.join(argv)))
+        options, positionals = parse_params(argv)
+        time.sleep(config['latency'].get(cmd, config['latency'].get('default', 0)))
+        if random.random() < config['errors'].get(cmd, 0):
+            raise SimError('Internal Server Error (HTTP 500)')
+        result, vm = run_cmd(cloud, cmd, options, positionals, config)
+        if cmd not in no_format_cmds and result is not None:
+            print(json.dumps(result, indent=2))
+    except SimError as e:
+        error = str(e)
+        sys.stderr.write(error + '\n')
+    finally:
+        log_call(cloud, cmd, vm, start, error)
+
+    if error is not None:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+# Benchmarks os_vm_transfer.py against the simulated clouds of os_sim.py, e.g.:
+#   ./os_vm_bench.py --vms 16 --workers 1,4,16 --polling list,show --latency 0.2
+
+default_vms = 8
+default_workers = '1,4'
+default_polling = 'list'
+default_image_size = 16 * 1024 * 1024
+export_cloud = 'pollux'
+import_cloud = 'castor'
+
+import os
+import sys
+import argparse
+import subprocess
+import json
+import time
+import glob
+import shutil
+import tempfile
+import resource
+
+import os_sim
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--vms', dest='vms', type=int, default=default_vms, help='Number of VMs transferred by each run [default %s]' %(default_vms))
+parser.add_argument('--workers', dest='workers', type=str, default=default_workers, help='Worker counts to compare (comma-separated) [default %s]' %(default_workers))
+parser.add_argument('--polling', dest='polling', type=str, default=default_polling, help='Polling strategies to compare (comma-separated): list (shared list calls), show (one show call per resource) [default %s]' %(default_polling))
+parser.add_argument('--repeat', dest='repeat', type=int, default=1, help='Number of runs for each combination [default 1]')
+parser.add_argument('--image-size', dest='image_size', type=int, default=default_image_size, help='Size (bytes) of the synthetic images [default %s]' %(default_image_size))
+parser.add_argument('--data-volumes', dest='data_volumes', type=int, default=0, help='Number of data volumes attached to each VM besides its boot volume [default 0]')
+parser.add_argument('--shared-percent', dest='shared_percent', type=int, default=0, help='Share (%%) of the blocks that all the synthetic images have in common [default 0]')
+parser.add_argument('--zero-percent', dest='zero_percent', type=int, default=0, help='Share (%%) of zero blocks in the synthetic images [default 0]')
+parser.add_argument('--bandwidth', dest='bandwidth', type=int, default=0, help='Simulated image download/upload bandwidth (bytes/s), 0 for unlimited [default 0]')
+parser.add_argument('--latency', dest='latency', type=float, default=0.0, help='Simulated latency (seconds) of each API call [default 0]')
+parser.add_argument('--delay-scale', dest='delay_scale', type=float, default=1.0, help='Factor applied to the simulated state transition delays [default 1]')
+parser.add_argument('--error-rate', dest='error_rate', type=float, default=0.0, help='Probability for show/list calls to fail with an API error [default 0]')
+parser.add_argument('--http', action='store_true', help='Serve the images over HTTP like Glance (os_sim.py --serve), for the ranged downloads of --download-connections')
+parser.add_argument('--no-http-ranges', dest='no_http_ranges', action='store_true', help='With --http, do not support HTTP ranges')
+parser.add_argument('--transfer-args', dest='transfer_args', type=str, default='', help='Extra arguments passed to os_vm_transfer.py, e.g. "--stream"')
+parser.add_argument('--work-dir', dest='work_dir', type=str, help='Directory for the simulated clouds and staging files [default: system temporary directory]')
+parser.add_argument('--keep', action='store_true', help='Keep the work directory of each run')
+parser.add_argument('--json', dest='json_file', type=str, help='Write all the results to this JSON file')
+args = parser.parse_args()
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+
+def get_config():
+    config = {'image_size': args.image_size, 'data_volumes': args.data_volumes, 'zero_percent': args.zero_percent, 'shared_percent': args.shared_percent, 'bandwidth': args.bandwidth, 'latency': {'default': args.latency}, 'delay': {}, 'errors': {}, 'http_ranges': not args.no_http_ranges}
+    for key, value in os_sim.default_config['delay'].items():
+        config['delay'][key] = value * args.delay_scale
+    if args.error_rate > 0:
+        for cmd in os_sim.commands:
+            if cmd.endswith(' show') or cmd.endswith(' list'):
+                config['errors'][cmd] = args.error_rate
+    return config
+
+def run_once(workers, polling):
+    result = {'workers': workers, 'polling': polling, 'vms': args.vms}
+
+    work_dir = tempfile.mkdtemp(prefix='os_vm_bench.', dir=args.work_dir)
+    sim_dir = os.path.join(work_dir, 'sim')
+    metrics_dir = os.path.join(work_dir, 'metrics')
+    os.makedirs(metrics_dir)
+    vm_names = ['bench%03d' %(i) for i in range(args.vms)]
+    os_sim.init_state(sim_dir, [export_cloud, import_cloud], vm_names, get_config(), export_cloud)
+
+    cmd = [sys.executable, os.path.join(base_dir, 'os_vm_transfer.py'), '--export-cloud', export_cloud, '--import-cloud', import_cloud, '--vms', ','.join(vm_names), '--workers', str(workers), '--openstack-cmd', '%s %s' %(sys.executable, os.path.join(base_dir, 'os_sim.py')), '--metrics-dir', metrics_dir, '--journal-dir', work_dir, '--verbose-level', '0']
+    if polling == 'show':
+        cmd.append('--no-batch-polling')
+    cmd += args.transfer_args.split()
+
+    env = dict(os.environ)
+    env['OS_SIM_DIR'] = sim_dir
+
+    server = None
+    if args.http:
+        server = subprocess.Popen([sys.executable, os.path.join(base_dir, 'os_sim.py'), '--serve'], env=env, stdout=subprocess.PIPE, universal_newlines=True)
+        # Serving once the URL is printed
+        server.stdout.readline()
+
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    try:
+        proc = subprocess.run(cmd, cwd=work_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    finally:
+        if server is not None:
+            server.kill()
+            server.wait()
+    result['wall_time'] = time.time() - start
+    usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result['returncode'] = proc.returncode
+
+    # Block I/O of the transfer and all the simulated CLI calls, in 512-byte blocks
+    result['disk_read'] = (usage_after.ru_inblock - usage_before.ru_inblock) * 512
+    result['disk_written'] = (usage_after.ru_oublock - usage_before.ru_oublock) * 512
+    result['cpu_time'] = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+
+    calls = []
+    with open(os.path.join(sim_dir, 'calls.log'), 'r') as f:
+        for line in f:
+            calls.append(json.loads(line))
+    result['api_calls'] = len(calls)
+    result['api_errors'] = len([c for c in calls if c['error'] is not None])
+    # Most API calls running at the same time, i.e. openstack CLI processes
+    events = sorted([(c['time'], 1) for c in calls] + [(c['time'] + c['duration'], -1) for c in calls])
+    running = 0
+    result['peak_api_calls'] = 0
+    for event_time, delta in events:
+        running += delta
+        result['peak_api_calls'] = max(result['peak_api_calls'], running)
+    result['api_calls_by_cmd'] = {}
+    for call in calls:
+        result['api_calls_by_cmd'][call['cmd']] = result['api_calls_by_cmd'].get(call['cmd'], 0) + 1
+    # Calls that belong to no VM (shared list calls) are spread over all the VMs
+    shared_calls = len([c for c in calls if c['vm'] not in vm_names])
+
+    result['vm_results'] = {}
+    for vm in vm_names:
+        vm_result = {'api_calls': len([c for c in calls if c['vm'] == vm]) + shared_calls / len(vm_names), 'success': False, 'duration': None, 'bytes': 0, 'phases': {}}
+        filename = os.path.join(metrics_dir, '%s.metrics.json' %(vm))
+        if os.path.isfile(filename):
+            with open(filename, 'r') as f:
+                metrics = json.load(f)
+            vm_result['success'] = metrics['success']
+            vm_result['duration'] = metrics['duration']
+            vm_result['bytes'] = metrics['bytes']
+            for phase in metrics['phases']:
+                vm_result['phases'][phase['phase']] = vm_result['phases'].get(phase['phase'], 0) + phase['duration']
+        # The data volumes of the VM have their own metrics, <VM>-disk<N>.metrics.json
+        for filename in sorted(glob.glob(os.path.join(metrics_dir, '%s-disk*.metrics.json' %(glob.escape(vm))))):
+            with open(filename, 'r') as f:
+                metrics = json.load(f)
+            vm_result['bytes'] += metrics['bytes']
+            for phase in metrics['phases']:
+                vm_result['phases'][phase['phase']] = vm_result['phases'].get(phase['phase'], 0) + phase['duration']
+        result['vm_results'][vm] = vm_result
+
+    succeeded = [r for r in result['vm_results'].values() if r['success']]
+    result['succeeded'] = len(succeeded)
+    result['vms_per_hour'] = len(succeeded) * 3600 / result['wall_time']
+    result['api_calls_per_vm'] = result['api_calls'] / len(vm_names)
+    result['bytes_per_vm'] = sum([r['bytes'] for r in result['vm_results'].values()]) / len(vm_names)
+
+    if proc.returncode != 0 and len(succeeded) == 0:
+        result['output'] = proc.stdout[-2000:]
+
+    if args.keep:
+        result['work_dir'] = work_dir
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return result
+
+def print_results(results):
+    print('%7s  %7s  %4s  %9s  %8s  %9s  %9s  %10s  %11s  %11s  %7s' %('WORKERS', 'POLLING', 'OK', 'WALL', 'VMS/H', 'CALLS/VM', 'ERRORS', 'PEAK CALLS', 'MIB/VM', 'DISK MIB', 'CPU'))
+    for r in results:
+        print('%7s  %7s  %4s  %8.1fs  %8.1f  %9.1f  %9s  %10s  %11.1f  %11.1f  %6.1fs' %(r['workers'], r['polling'], '%s/%s' %(r['succeeded'], r['vms']), r['wall_time'], r['vms_per_hour'], r['api_calls_per_vm'], r['api_errors'], r['peak_api_calls'], r['bytes_per_vm'] / 1024 / 1024, (r['disk_read'] + r['disk_written']) / 1024 / 1024, r['cpu_time']))
+        if 'output' in r:
+            print(r['output'])
+
+def main():
+    results = []
+    for workers in [int(w) for w in args.workers.split(',')]:
+        for polling in args.polling.split(','):
+            for i in range(args.repeat):
+                results.append(run_once(workers, polling))
+                print_results(results[-1:])
+
+    print('')
+    print_results(results)
+
+    if args.json_file is not None:
+        with open(args.json_file, 'w') as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,46 @@
 #!/usr/bin/env python3
 
 image_format = 'qcow2'
+openstack_cmd = 'openstack'
+polling_min_sleep_time = 1
 polling_sleep_time = 10
+polling_long_sleep_time = 60
+polling_backoff = 1.5
 polling_timeout = 600
+polling_long_timeout = 6 * 3600
+polling_error_statuses = ['error', 'error_deleting', 'error_restoring', 'error_extending', 'error_managing', 'killed']
 default_min_ram = 2048
 default_min_disk = 40
 external_network = 'ext-net1'
+default_workers = 4
+default_cleanup_workers = 4
+floating_ip_tries = 3
+checksum_chunk_size = 4 * 1024 * 1024
+default_download_connections = 1
+range_segment_size = 16 * 1024 * 1024
+range_tries = 3
+# Sleep before the second try of a range request that got nothing, doubling before each next one
+range_retry_sleep_time = 1
+http_timeout = 60
+sparse_block_size = 64 * 1024
+# qcow2 clusters are 64 KiB aligned, so the same clusters in two images are the same chunks whatever their position
+chunk_store_chunk_size = 64 * 1024
+# Block size of the --delta manifests, dividing checksum_chunk_size and range_segment_size
+delta_block_size = 1024 * 1024
+# API calls that move image data on the cloud side, capped apart from the others
+heavy_api_calls = ['image save', 'volume create']
+# Sleep between two attempts to get a call slot shared with other processes
+api_lock_sleep_time = 0.1
+# Tries of the image save, create and import steps, the waits between them doubling up to retry_max_sleep_time
+default_max_tries = 5
+default_retry_sleep_time = 5
+retry_max_sleep_time = 300
+# Free space (GiB) left on the staging disk by --check-staging-space
+default_staging_margin = 1
+# Time between two checks of the staging space while a VM waits for it
+staging_sleep_time = 10
+# Glance default os_hash_algo, computed along with MD5 whatever the export image reports
+hash_algos = ['sha512']
 
 import os
 import sys
@@ -16,11 +51,33 @@ import time
 from datetime import timezone
 import datetime
 import hashlib
+import threading
+import tempfile
+import concurrent.futures
+import asyncio
+import shlex
+import shutil
+import errno
+import fcntl
+import urllib.request
+import urllib.error
+try:
+    import openstack
+except ImportError:
+    openstack = None
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--export-cloud', dest='export_cloud', type=str, help='Export cloud configuration name')
 parser.add_argument('--import-cloud', dest='import_cloud', type=str, help='Import cloud configuration name')
 parser.add_argument('--vm', dest='vm', type=str, help='VM name')
+parser.add_argument('--vms', dest='vms', type=str, help='VM names (comma-separated), transferred concurrently')
+parser.add_argument('--vms-file', dest='vms_file', type=str, help='File containing VM names (one per line), transferred concurrently')
+parser.add_argument('--workers', dest='workers', type=int, help='Number of VMs processed at the same time in batch mode [default %s]' %(default_workers))
+parser.add_argument('--engine', dest='engine', choices=['thread', 'asyncio'], default='thread', help='Engine driving the VMs in flight: one thread per VM, or one asyncio event loop running the VMs as coroutines, with asynchronous openstack CLI processes and waits, threads being only used to move the image data [default thread]')
+parser.add_argument('--pipeline', action='store_true', help='Batch transfer mode: export the next VMs while the previous ones are imported')
+parser.add_argument('--import-workers', dest='import_workers', type=int, help='Pipeline mode: number of VMs imported at the same time [default: same as --workers]')
+parser.add_argument('--pipeline-depth', dest='pipeline_depth', type=int, help='Pipeline mode: maximum number of VMs between the start of their export and the end of their import, i.e. of staged images [default: --workers + --import-workers]')
+parser.add_argument('--cleanup-workers', dest='cleanup_workers', type=int, help='Number of cleanups run at the same time in the background while the VMs go on, 0 to clean up before going on [default %s]' %(default_cleanup_workers))
 parser.add_argument('--volume-id', dest='volume_id', type=str, help='Volume ID')
 parser.add_argument('--volume-snapshot-id', dest='snap_id', type=str, help='Volume snapshot ID')
 parser.add_argument('--new-volume-id', dest='newvol_id', type=str, help='New volume ID (generated from volume snapshot)')
@@ -35,20 +92,1893 @@ parser.add_argument('--subnet-names', dest='subnet_names', type=str, help='Subne
 parser.add_argument('--ips', dest='ips', type=str, help='VM IP addresses (comma-separated, must match subnet-names in the same order)')
 parser.add_argument('--min-ram', dest='min_ram', type=str, help='Min RAM (MiB) [default %s]' %(default_min_ram))
 parser.add_argument('--min-disk', dest='min_disk', type=str, help='Min disk (GiB) [default %s]' %(default_min_disk))
+parser.add_argument('--poll-timeout', dest='poll_timeout', type=int, help='Timeout (seconds) when waiting for a server or a deletion [default %s]' %(polling_timeout))
+parser.add_argument('--poll-long-timeout', dest='poll_long_timeout', type=int, help='Timeout (seconds) when waiting for a snapshot, a volume or an image [default %s]' %(polling_long_timeout))
+parser.add_argument('--journal-dir', dest='journal_dir', type=str, default='.', help='Directory of the per-VM journals used to resume an interrupted run [default .]')
+parser.add_argument('--no-journal', dest='no_journal', action='store_true', help='Neither read nor write the per-VM journal')
+parser.add_argument('--metrics-dir', dest='metrics_dir', type=str, help='Directory where a JSON report with the duration, bytes and throughput of each phase is written for each VM')
+parser.add_argument('--prometheus-textfile', dest='prometheus_textfile', type=str, help='Prometheus textfile (node_exporter textfile collector) updated with the metrics of each VM')
 parser.add_argument('--keep', action='store_true', help='Keep temporary items')
+parser.add_argument('--download-connections', dest='download_connections', type=int, help='Number of HTTP connections downloading parts of an image from Glance at the same time, 1 for a single image save stream [default %s]' %(default_download_connections))
+parser.add_argument('--stream', action='store_true', help='Transfer mode only: stream the image from the export cloud to the import cloud, without any local file')
+parser.add_argument('--delta', action='store_true', help='Keep a manifest of block hashes next to each saved image file, and when the file was saved by a previous export of the VM (e.g. a rehearsal, with its journal deleted), only rewrite the blocks that changed')
+parser.add_argument('--chunk-store', dest='chunk_store', type=str, help='Directory of a content-addressed store where the saved images are split in chunks, each distinct chunk being stored once whatever the images it belongs to; the image file is then a recipe <FILE>.chunks')
+parser.add_argument('--max-tries', dest='max_tries', type=int, help='Maximum number of tries of the image creation, image save and image upload of a VM before it fails [default %s]' %(default_max_tries))
+parser.add_argument('--retry-sleep-time', dest='retry_sleep_time', type=float, help='Seconds before the second try of a failed step, doubled before each next try up to %s seconds [default %s]' %(retry_max_sleep_time, default_retry_sleep_time))
+parser.add_argument('--no-sparse', dest='no_sparse', action='store_true', help='Write the saved image files in full instead of leaving holes for the zero blocks')
+parser.add_argument('--check-staging-space', dest='check_staging_space', action='store_true', help='Only start the export of a VM, before it is stopped, once the size of its volumes fits in the free space of the staging disk (current directory, or --chunk-store) that the other exports in flight have not reserved yet; the reservation is given back once the VM is imported')
+parser.add_argument('--staging-margin', dest='staging_margin', type=float, help='Space (GiB) always left free on the staging disk by --check-staging-space [default %s]' %(default_staging_margin))
+parser.add_argument('--remove-image-files', dest='remove_image_files', action='store_true', help='Transfer mode: delete each saved image file (and its --delta manifest) once the VM is created from it, so that its staging space is reused by the next VMs')
+parser.add_argument('--os-backend', dest='os_backend', choices=['cli', 'sdk'], default='cli', help='OpenStack client backend: one openstack CLI process per call, or in-process openstacksdk reusing one session per cloud [default cli]')
+parser.add_argument('--max-api-calls', dest='max_api_calls', type=int, help='Maximum number of OpenStack API calls (e.g. openstack CLI processes) running at the same time, whatever the number of VMs in flight; image downloads and uploads are not counted [default: unlimited]')
+parser.add_argument('--max-heavy-calls', dest='max_heavy_calls', type=int, help='Maximum number of heavy OpenStack API calls (%s, image create from a file) running at the same time on each cloud, image save streams included [default: unlimited]' %(', '.join(heavy_api_calls)))
+parser.add_argument('--max-light-calls', dest='max_light_calls', type=int, help='Maximum number of the other OpenStack API calls (show, list...) running at the same time on each cloud [default: unlimited]')
+parser.add_argument('--heavy-calls-per-second', dest='heavy_calls_per_second', type=float, help='Maximum number of heavy OpenStack API calls started per second on each cloud [default: unlimited]')
+parser.add_argument('--light-calls-per-second', dest='light_calls_per_second', type=float, help='Maximum number of the other OpenStack API calls started per second on each cloud [default: unlimited]')
+parser.add_argument('--api-lock-dir', dest='api_lock_dir', type=str, help='Directory of the lock files sharing the --max-heavy-calls, --max-light-calls, --heavy-calls-per-second and --light-calls-per-second limits with the other os_vm_transfer.py processes using the same directory [default: limits for this process only]')
+parser.add_argument('--api-profile', dest='api_profile', type=str, help='Profile the OpenStack API calls: print the count, errors, retries and latency percentiles of each command on each cloud at the end, and write them to this JSON file')
+parser.add_argument('--api-slow-call', dest='api_slow_call', type=float, help='Print the OpenStack API calls that take more than this number of seconds (profiles the calls too, see --api-profile)')
+parser.add_argument('--openstack-cmd', dest='openstack_cmd', type=str, help='OpenStack CLI command used by the cli backend, e.g. a simulator [default %s]' %(openstack_cmd))
+parser.add_argument('--no-preflight', dest='no_preflight', action='store_true', help='Skip the checks, before any VM is stopped, that the flavors, networks, security groups and key pairs exist on the import cloud and that the fixed IPs are free')
+parser.add_argument('--no-batch-polling', dest='no_batch_polling', action='store_true', help='Batch mode: poll each resource with its own show call instead of shared list calls')
 parser.add_argument('--verbose-level', dest='verbose_level', type=int, help='Verbose level [default 1]')
 args = parser.parse_args()
 
+if args.vms is not None or args.vms_file is not None:
+    if args.vm is not None:
+        parser.error('--vm cannot be combined with --vms/--vms-file')
+    for dest, option in [('volume_id', '--volume-id'), ('snap_id', '--volume-snapshot-id'), ('newvol_id', '--new-volume-id'), ('image_id', '--image-id'), ('image_filename', '--image-filename'), ('vm_size', '--size'), ('ips', '--ips')]:
+        if getattr(args, dest) is not None:
+            parser.error('%s is VM specific and cannot be used with --vms/--vms-file' %(option))
+
+if args.chunk_store is not None and (args.delta or (args.download_connections is not None and args.download_connections > 1)):
+    parser.error('--chunk-store saves the images with one image save stream and cannot be combined with --delta or --download-connections')
+
+if args.remove_image_files and args.delta:
+    parser.error('--delta needs the image files of the previous run and cannot be combined with --remove-image-files')
+
+for dest, option in [('max_heavy_calls', '--max-heavy-calls'), ('max_light_calls', '--max-light-calls'), ('heavy_calls_per_second', '--heavy-calls-per-second'), ('light_calls_per_second', '--light-calls-per-second')]:
+    if getattr(args, dest) is not None and getattr(args, dest) <= 0:
+        parser.error('%s must be greater than 0' %(option))
+
+if args.os_backend == 'sdk' and openstack is None:
+    parser.error('--os-backend sdk requires the openstacksdk Python package')
+
 verbose_level = 1
 if args.verbose_level is not None:
     verbose_level = args.verbose_level
 
+max_tries = default_max_tries
+if args.max_tries is not None and args.max_tries > 0:
+    max_tries = args.max_tries
+retry_sleep_time = default_retry_sleep_time
+if args.retry_sleep_time is not None and args.retry_sleep_time >= 0:
+    retry_sleep_time = args.retry_sleep_time
+
+zero_block = bytes(sparse_block_size)
+zero_chunk = bytes(checksum_chunk_size)
+
+def write_sparse(f, chunk):
+    # Zero blocks are skipped instead of written, leaving holes: the caller has to truncate the file to its size at the end
+    view = memoryview(chunk)
+    start = 0
+    offset = 0
+    while offset < len(view):
+        # Comparing bytes is much faster than comparing memoryviews
+        block = bytes(view[offset:offset + sparse_block_size])
+        if block == zero_block[:len(block)]:
+            if start < offset:
+                f.write(view[start:offset])
+            f.seek(len(block), os.SEEK_CUR)
+            start = offset + len(block)
+        offset += len(block)
+    if start < offset:
+        f.write(view[start:offset])
+
+def is_sparse(filename):
+    st = os.stat(filename)
+    return st.st_blocks * 512 < st.st_size
+
+def read_sparse(filename, chunk_size=checksum_chunk_size):
+    # Yields the content of the file, the holes being returned as zeros without reading them from the disk
+    with open(filename, 'rb') as f:
+        fd = f.fileno()
+        size = os.fstat(fd).st_size
+        seek_data = hasattr(os, 'SEEK_DATA')
+        offset = 0
+        while offset < size:
+            data = offset
+            hole = size
+            if seek_data:
+                try:
+                    data = os.lseek(fd, offset, os.SEEK_DATA)
+                    hole = os.lseek(fd, data, os.SEEK_HOLE)
+                except OSError as e:
+                    if e.errno == errno.ENXIO:
+                        # Only a hole up to the end of the file
+                        data = size
+                    else:
+                        # Not supported by the file system
+                        seek_data = False
+                        data = offset
+                        hole = size
+            while offset < data:
+                length = min(chunk_size, data - offset, len(zero_chunk))
+                yield zero_chunk[:length]
+                offset += length
+            if offset < hole:
+                f.seek(offset)
+            while offset < hole:
+                chunk = f.read(min(chunk_size, hole - offset))
+                if not chunk:
+                    raise Exception('Unexpected end of file %s' %(filename))
+                yield chunk
+                offset += len(chunk)
+
+def block_digest(block):
+    return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+def load_block_manifest(filename):
+    # Block digests of the file as written by a previous export, or None if the file changed since
+    result = None
+
+    manifest_filename = '%s.blocks' %(filename)
+    if os.path.isfile(manifest_filename) and os.path.isfile(filename):
+        with open(manifest_filename, 'r') as f:
+            manifest = json.load(f)
+        st = os.stat(filename)
+        if manifest['block_size'] == delta_block_size and manifest['size'] == st.st_size and manifest['mtime'] == st.st_mtime_ns:
+            result = manifest['blocks']
+
+    return result
+
+def save_block_manifest(filename, blocks):
+    manifest_filename = '%s.blocks' %(filename)
+    st = os.stat(filename)
+    with open('%s.tmp' %(manifest_filename), 'w') as f:
+        json.dump({'block_size': delta_block_size, 'size': st.st_size, 'mtime': st.st_mtime_ns, 'blocks': blocks}, f)
+    os.replace('%s.tmp' %(manifest_filename), manifest_filename)
+
+def write_blocks(f, offset, data, previous, sparse):
+    # Writes the blocks of data (offset being a block boundary) that differ from the previous manifest, returns the digests of all the blocks and the bytes written
+    digests = []
+    written = 0
+    view = memoryview(data)
+    for start in range(0, len(view), delta_block_size):
+        block = view[start:start + delta_block_size]
+        digest = block_digest(block)
+        index = (offset + start) // delta_block_size
+        if previous is None or index >= len(previous) or previous[index] != digest:
+            f.seek(offset + start)
+            if sparse:
+                write_sparse(f, block)
+            else:
+                # A hole would leave the previous data of the block
+                f.write(block)
+            written += len(block)
+        digests.append(digest)
+    return digests, written
+
+def print_delta(filename, written, size):
+    if verbose_level >= 1:
+        dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+        print('    %s: %.1f MiB of %.1f MiB rewritten in %s since its previous export' %(dt, written / 1024 / 1024, size / 1024 / 1024, filename))
+
+class BlockWriter:
+    # Writes a stream to a file block by block, see write_blocks()
+    __f = None
+    __previous = None
+    __sparse = False
+    __buffer = None
+    __offset = 0
+    __digests = None
+    __written = 0
+
+    def __init__(self, f, previous):
+        self.__f = f
+        self.__previous = previous
+        # The holes of a new file are zeros, not those of an updated one
+        self.__sparse = previous is None and not args.no_sparse
+        self.__buffer = bytearray()
+        self.__digests = []
+
+    def __flush(self, length):
+        digests, written = write_blocks(self.__f, self.__offset, self.__buffer[:length], self.__previous, self.__sparse)
+        self.__digests += digests
+        self.__written += written
+        self.__offset += length
+        del self.__buffer[:length]
+
+    def write(self, chunk):
+        self.__buffer += chunk
+        length = len(self.__buffer) - len(self.__buffer) % delta_block_size
+        if length > 0:
+            self.__flush(length)
+
+    def close(self):
+        if len(self.__buffer) > 0:
+            self.__flush(len(self.__buffer))
+        self.__f.truncate(self.__offset)
+
+    def get_digests(self):
+        return self.__digests
+
+    def get_written(self):
+        return self.__written
+
+def is_chunk_recipe(filename):
+    return filename.endswith('.chunks')
+
+def read_image_file(filename):
+    # Content of a staged image, from the file itself or from the chunk store of its recipe
+    if is_chunk_recipe(filename):
+        with open(filename, 'r') as f:
+            recipe = json.load(f)
+        return OSChunkStore(recipe['store']).read(recipe)
+    return read_sparse(filename)
+
+def remove_image_file(filename):
+    size = os.path.getsize(filename)
+    # The chunks of a recipe that no other image uses are freed by sweep_chunk_stores() at the end of the run
+    if is_chunk_recipe(filename):
+        with open(filename, 'r') as f:
+            recipe = json.load(f)
+        OSChunkStore(recipe['store']).remove(filename)
+        with chunk_stores_lock:
+            chunk_stores_to_sweep.add(recipe['store'])
+        return size
+    os.remove(filename)
+    return size
+
+def is_partial_image_file(filename):
+    # Still being saved, by a single stream or by ranges
+    return os.path.isfile('%s.save' %(filename)) or os.path.isfile('%s.ranges' %(filename))
+
+def image_file_size(filename):
+    if is_chunk_recipe(filename):
+        with open(filename, 'r') as f:
+            return json.load(f)['size']
+    return os.path.getsize(filename)
+
+def image_file_url(endpoint, image_id):
+    endpoint = endpoint.rstrip('/')
+    if not endpoint.endswith('/v2'):
+        endpoint += '/v2'
+    return '%s/images/%s/file' %(endpoint, image_id)
+
+def http_open(url, headers, start, end=None):
+    # Up to the end of the image without an end
+    request = urllib.request.Request(url, headers=headers)
+    request.add_header('Range', 'bytes=%s-%s' %(start, end if end is not None else ''))
+    return urllib.request.urlopen(request, timeout=http_timeout)
+
+def http_chunks(response):
+    try:
+        chunk = response.read(checksum_chunk_size)
+        while chunk:
+            yield chunk
+            chunk = response.read(checksum_chunk_size)
+    finally:
+        response.close()
+
+def download_ranges(url, headers, filename, connections, hashes):
+    # Returns the size of the file, or None if the server does not support ranges (nothing is written then)
+    size = None
+    try:
+        response = http_open(url, headers, 0, 0)
+    except urllib.error.HTTPError as e:
+        # An empty image has no range to return
+        if e.code == 416:
+            return None
+        raise
+    try:
+        content_range = response.headers.get('Content-Range')
+        if response.status == 206 and content_range is not None and not content_range.endswith('/*'):
+            size = int(content_range.split('/')[-1])
+    finally:
+        response.close()
+    if size is None:
+        return None
+
+    # Only the blocks that changed since the previous export are written, see --delta
+    blocks = None
+    if args.delta:
+        blocks = load_block_manifest(filename)
+
+    # Segments already downloaded by an interrupted run are kept, see the .ranges file
+    count = (size + range_segment_size - 1) // range_segment_size
+    state_filename = '%s.ranges' %(filename)
+    state = {'url': url, 'size': size, 'segment_size': range_segment_size, 'done': [], 'blocks': {}}
+    fresh = True
+    if os.path.isfile(state_filename) and os.path.isfile(filename):
+        with open(state_filename, 'r') as f:
+            previous = json.load(f)
+        if previous['url'] == url and previous['size'] == size and previous['segment_size'] == range_segment_size:
+            state = previous
+            state.setdefault('blocks', {})
+            fresh = False
+    previous_done = list(state['done'])
+    if fresh:
+        with open(filename, 'wb' if blocks is None else 'r+b') as f:
+            if args.no_sparse:
+                os.posix_fallocate(f.fileno(), 0, size)
+            f.truncate(size)
+
+    def save_state():
+        with open('%s.tmp' %(state_filename), 'w') as f:
+            json.dump(state, f)
+        os.replace('%s.tmp' %(state_filename), state_filename)
+    save_state()
+
+    condition = threading.Condition()
+    segments = {}
+    shared = {'next': 0, 'hashed': 0, 'error': None, 'written': 0}
+    # Downloaded segments wait in memory until all the previous ones are hashed, so only a few are allowed ahead
+    window = 2 * connections
+
+    def fetch(index):
+        start = index * range_segment_size
+        end = min(size, start + range_segment_size) - 1
+        data = bytearray()
+        tries = 0
+        while start + len(data) <= end:
+            received = len(data)
+            error = None
+            try:
+                # Resumes after the bytes already received when a connection breaks
+                response = http_open(url, headers, start + len(data), end)
+                try:
+                    if response.status != 206:
+                        raise Exception('Range request returned HTTP status %s' %(response.status))
+                    chunk = response.read(checksum_chunk_size)
+                    while chunk:
+                        data += chunk
+                        chunk = response.read(checksum_chunk_size)
+                finally:
+                    response.close()
+            except Exception as e:
+                error = e
+            if len(data) > end - start + 1:
+                raise Exception('Segment %s of %s is larger than requested' %(index, url))
+            # A short answer that brought some bytes goes on right away, an error or an answer without any byte counts as a try
+            if start + len(data) <= end and (error is not None or len(data) == received):
+                tries += 1
+                if tries >= range_tries:
+                    if error is not None:
+                        raise error
+                    raise Exception('Segment %s/%s of %s stalled at byte %s after %s tries' %(index + 1, count, url, start + len(data), tries))
+                if verbose_level >= 2:
+                    dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                    print('    %s: Segment %s/%s interrupted at byte %s, resuming: %s' %(dt, index + 1, count, start + len(data), str(error).strip() if error is not None else 'no data received'))
+                time.sleep(range_retry_sleep_time * 2**(tries - 1))
+        with open(filename, 'r+b') as f:
+            # A resumed file may hold stale data, only the holes of a new one are known to be zeros
+            sparse = fresh and blocks is None and not args.no_sparse
+            if args.delta:
+                digests, written = write_blocks(f, start, data, blocks, sparse)
+                with condition:
+                    state['blocks'][str(index)] = digests
+                    shared['written'] += written
+            else:
+                f.seek(start)
+                if sparse:
+                    write_sparse(f, data)
+                else:
+                    f.write(data)
+        return bytes(data)
+
+    def worker():
+        while True:
+            with condition:
+                while shared['error'] is None and shared['next'] < count and (shared['next'] in previous_done or shared['next'] >= shared['hashed'] + window):
+                    if shared['next'] in previous_done:
+                        shared['next'] += 1
+                    else:
+                        condition.wait()
+                if shared['error'] is not None or shared['next'] >= count:
+                    return
+                index = shared['next']
+                shared['next'] += 1
+            try:
+                data = fetch(index)
+            except Exception as e:
+                with condition:
+                    shared['error'] = e
+                    condition.notify_all()
+                return
+            with condition:
+                segments[index] = data
+                state['done'].append(index)
+                save_state()
+                condition.notify_all()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+        try:
+            for i in range(connections):
+                executor.submit(worker)
+
+            # The hashes need the data in order, whatever the order of the segments
+            for index in range(count):
+                if index in previous_done:
+                    with open(filename, 'rb') as f:
+                        f.seek(index * range_segment_size)
+                        remaining = min(size, (index + 1) * range_segment_size) - index * range_segment_size
+                        while remaining > 0:
+                            chunk = f.read(min(checksum_chunk_size, remaining))
+                            if not chunk:
+                                raise Exception('Unexpected end of file %s' %(filename))
+                            hashes.update(chunk)
+                            remaining -= len(chunk)
+                else:
+                    with condition:
+                        while index not in segments and shared['error'] is None:
+                            condition.wait()
+                        if shared['error'] is not None:
+                            raise shared['error']
+                        data = segments.pop(index)
+                    hashes.update(data)
+                with condition:
+                    shared['hashed'] = index + 1
+                    condition.notify_all()
+        except BaseException as e:
+            with condition:
+                if shared['error'] is None:
+                    shared['error'] = e
+                condition.notify_all()
+            raise
+
+    # Segments of an interrupted run without --delta have no digests
+    if args.delta and all([str(index) in state['blocks'] for index in range(count)]):
+        save_block_manifest(filename, [digest for index in range(count) for digest in state['blocks'][str(index)]])
+        if blocks is not None:
+            print_delta(filename, shared['written'], size)
+    os.remove(state_filename)
+
+    return size
+
+def is_not_found(error):
+    # "No Image found for X" (images, servers) or "No volume with a name or ID of 'X' exists." (volumes, snapshots)
+    error = str(error).strip()
+    return error.startswith('No ') and (' found' in error or error.endswith(' exists.'))
+
+class MultiHash:
+    __hashes = None
+
+    def __init__(self, algos=[]):
+        self.__hashes = {'md5': hashlib.md5()}
+        for algo in hash_algos + algos:
+            if algo is not None and algo not in self.__hashes and algo in hashlib.algorithms_available:
+                self.__hashes[algo] = hashlib.new(algo)
+
+    def update(self, chunk):
+        for h in self.__hashes.values():
+            h.update(chunk)
+
+    def hexdigests(self):
+        result = {}
+        for algo, h in self.__hashes.items():
+            result[algo] = h.hexdigest()
+        return result
+
+class OSCLIBackend:
+    __no_format_cmds = ['server stop', 'server add volume', 'volume delete', 'volume snapshot delete', 'image save', 'image delete', 'floating ip set', 'floating ip delete']
+    __command = None
+
+    def __init__(self, command):
+        self.__command = command
+
+    def __get_command(self, cloud, cmd, params):
+        tmp_params = []
+        if cmd not in self.__no_format_cmds:
+            tmp_params.append('-f json')
+        tmp_params += params
+        params = tmp_params
+
+        if verbose_level >= 4:
+            print('        %s --os-cloud %s %s %s' %(self.__command, cloud, cmd, ' '.join(params)))
+        return '%s --os-cloud %s %s %s' %(self.__command, cloud, cmd, ' '.join(params))
+
+    def __parse_result(self, cmd, stdout, stderr):
+        result = None
+
+        if stderr != '':
+            raise Exception(stderr)
+
+        try:
+            if cmd not in self.__no_format_cmds:
+                result = json.loads(stdout)
+        except Exception as e:
+            raise Exception(e)
+
+        return result
+
+    def get_result(self, cloud, cmd, params):
+        proc = subprocess.run([self.__get_command(cloud, cmd, params)], shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        return self.__parse_result(cmd, proc.stdout, proc.stderr)
+
+    async def get_result_async(self, cloud, cmd, params):
+        # Same process, waited for by the event loop instead of a thread
+        proc = await asyncio.create_subprocess_shell(self.__get_command(cloud, cmd, params), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = await proc.communicate()
+        return self.__parse_result(cmd, stdout.decode(errors='replace'), stderr.decode(errors='replace'))
+
+    def get_stream(self, cloud, cmd, params):
+        if verbose_level >= 4:
+            print('        %s --os-cloud %s %s %s > (stream)' %(self.__command, cloud, cmd, ' '.join(params)))
+        # stderr goes to a temporary file, a PIPE could fill up and block the command while we only read stdout
+        with tempfile.TemporaryFile() as stderr:
+            proc = subprocess.Popen(['%s --os-cloud %s %s %s' %(self.__command, cloud, cmd, ' '.join(params))], shell=True, stdout=subprocess.PIPE, stderr=stderr)
+            complete = False
+            try:
+                chunk = proc.stdout.read(checksum_chunk_size)
+                while chunk:
+                    yield chunk
+                    chunk = proc.stdout.read(checksum_chunk_size)
+                complete = True
+            finally:
+                if not complete:
+                    proc.kill()
+                proc.stdout.close()
+                proc.wait()
+
+            stderr.seek(0)
+            err = stderr.read().decode(errors='replace')
+            if err != '' or proc.returncode != 0:
+                raise Exception(err if err != '' else '%s returned %s' %(cmd, proc.returncode))
+
+    def get_image_download(self, cloud, image_id):
+        result = None
+
+        token = self.get_result(cloud, 'token issue', [])['id']
+        endpoints = self.get_result(cloud, 'catalog show', ['image'])['endpoints']
+        url = None
+        if isinstance(endpoints, str):
+            # Older clients: "<region>\n  <interface>: <url>" lines
+            for line in endpoints.splitlines():
+                line = line.strip()
+                if url is None and line.startswith('public: '):
+                    url = line[len('public: '):]
+        else:
+            for endpoint in endpoints:
+                if url is None and endpoint.get('interface') == 'public':
+                    url = endpoint['url']
+        if url is None:
+            raise Exception('No public image endpoint found for cloud %s' %(cloud))
+        result = (image_file_url(url, image_id), {'X-Auth-Token': token})
+
+        return result
+
+    def put_stream(self, cloud, cmd, params, chunks):
+        result = None
+
+        params = ['-f json'] + params
+
+        if verbose_level >= 4:
+            print('        (stream) | %s --os-cloud %s %s %s' %(self.__command, cloud, cmd, ' '.join(params)))
+        with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+            proc = subprocess.Popen(['%s --os-cloud %s %s %s' %(self.__command, cloud, cmd, ' '.join(params))], shell=True, stdin=subprocess.PIPE, stdout=stdout, stderr=stderr)
+            try:
+                for chunk in chunks:
+                    proc.stdin.write(chunk)
+            except BrokenPipeError:
+                # The upload died, its stderr tells why
+                pass
+            except BaseException:
+                # Never let a truncated stream end up as a complete image
+                proc.kill()
+                proc.wait()
+                raise
+            finally:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+            proc.wait()
+
+            stderr.seek(0)
+            err = stderr.read().decode(errors='replace')
+            if err != '' or proc.returncode != 0:
+                raise Exception(err if err != '' else '%s returned %s' %(cmd, proc.returncode))
+
+            stdout.seek(0)
+            try:
+                result = json.loads(stdout.read().decode())
+            except Exception as e:
+                raise Exception(e)
+
+        return result
+
+class OSSDKBackend:
+    __connections = None
+    __lock = None
+    __flag_options = ['--unprotected', '--protected', '--bootable', '--force', '--all']
+
+    def __init__(self):
+        self.__connections = {}
+        self.__lock = threading.Lock()
+
+    def __get_connection(self, cloud):
+        # One authenticated session per cloud, shared by all the calls and all the VMs
+        with self.__lock:
+            if cloud not in self.__connections:
+                self.__connections[cloud] = openstack.connect(cloud=cloud)
+            return self.__connections[cloud]
+
+    def __parse_params(self, params):
+        options = {}
+        positionals = []
+
+        tokens = shlex.split(' '.join(params))
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            if token.startswith('--'):
+                value = True
+                if token not in self.__flag_options:
+                    i += 1
+                    value = tokens[i]
+                options.setdefault(token[2:], []).append(value)
+            else:
+                positionals.append(token)
+            i += 1
+
+        return options, positionals
+
+    def __check_response(self, response):
+        openstack.exceptions.raise_from_response(response)
+        return response
+
+    def __server_to_dict(self, server):
+        addresses = {}
+        for network, ips in (server.addresses or {}).items():
+            addresses[network] = [ip['addr'] for ip in ips]
+
+        flavor = server.flavor or {}
+        flavor_name = flavor.get('original_name') or flavor.get('name') or flavor.get('id') or ''
+
+        return {'id': server.id, 'name': server.name, 'status': server.status, 'key_name': server.key_name, 'flavor': '%s (%s)' %(flavor_name, flavor.get('id') or flavor_name), 'security_groups': [{'name': sg['name']} for sg in (server.security_groups or [])], 'addresses': addresses, 'volumes_attached': [{'id': v['id']} for v in (server.attached_volumes or [])]}
+
+    def __volume_to_dict(self, volume):
+        return {'id': volume.id, 'name': volume.name, 'status': volume.status, 'size': volume.size}
+
+    def __snapshot_to_dict(self, snapshot):
+        return {'id': snapshot.id, 'name': snapshot.name, 'status': snapshot.status, 'size': snapshot.size}
+
+    def __image_to_dict(self, image):
+        return {'id': image.id, 'name': image.name, 'status': image.status, 'checksum': image.checksum, 'size': image.size, 'os_hash_algo': image.hash_algo, 'os_hash_value': image.hash_value}
+
+    def __floating_ip_to_dict(self, ip):
+        return {'ID': ip.id, 'Floating IP Address': ip.floating_ip_address, 'Fixed IP Address': ip.fixed_ip_address, 'Port': ip.port_id, 'floating_ip_address': ip.floating_ip_address, 'id': ip.id}
+
+    def __find_server(self, conn, name_or_id):
+        server = conn.compute.find_server(name_or_id, ignore_missing=True)
+        if server is None:
+            raise Exception('No server found for %s' %(name_or_id))
+        return conn.compute.get_server(server.id)
+
+    def __create_image_record(self, conn, options, positionals):
+        image = {'name': positionals[0], 'container_format': options.get('container-format', ['bare'])[0], 'disk_format': options.get('disk-format', [image_format])[0]}
+        if 'min-ram' in options:
+            image['min_ram'] = int(options['min-ram'][0])
+        if 'min-disk' in options:
+            image['min_disk'] = int(options['min-disk'][0])
+        return self.__check_response(conn.image.post('/images', json=image)).json()['id']
+
+    def __upload_image_data(self, conn, image_id, data):
+        try:
+            self.__check_response(conn.image.put('/images/%s/file' %(image_id), data=data, headers={'Content-Type': 'application/octet-stream'}))
+        except BaseException:
+            # Do not leave a queued image without data behind
+            conn.image.delete_image(image_id, ignore_missing=True)
+            raise
+        return self.__image_to_dict(conn.image.get_image(image_id))
+
+    def get_result(self, cloud, cmd, params):
+        result = None
+
+        if verbose_level >= 4:
+            print('        sdk --os-cloud %s %s %s' %(cloud, cmd, ' '.join(params)))
+
+        conn = self.__get_connection(cloud)
+        options, positionals = self.__parse_params(params)
+        try:
+            if cmd == 'server show':
+                result = self.__server_to_dict(self.__find_server(conn, positionals[0]))
+            elif cmd == 'server stop':
+                conn.compute.stop_server(self.__find_server(conn, positionals[0]))
+            elif cmd == 'server create':
+                networks = []
+                for nic in options.get('nic', []):
+                    nic = dict([item.split('=', 1) for item in nic.split(',')])
+                    network = {'uuid': conn.network.find_network(nic['net-id'], ignore_missing=False).id}
+                    if 'v4-fixed-ip' in nic:
+                        network['fixed_ip'] = nic['v4-fixed-ip']
+                    networks.append(network)
+                server = conn.compute.create_server(name=positionals[0], flavor_id=conn.compute.find_flavor(options['flavor'][0], ignore_missing=False).id, block_device_mapping=[{'boot_index': 0, 'uuid': options['volume'][0], 'source_type': 'volume', 'destination_type': 'volume', 'delete_on_termination': False}], networks=networks, security_groups=[{'name': sg} for sg in options.get('security-group', [])], key_name=options['key-name'][0])
+                result = {'id': server.id, 'name': server.name, 'status': server.status}
+            elif cmd == 'server add volume':
+                conn.compute.create_volume_attachment(self.__find_server(conn, positionals[0]), volume_id=positionals[1])
+            elif cmd == 'flavor show':
+                flavor = conn.compute.find_flavor(positionals[0], ignore_missing=False)
+                result = {'id': flavor.id, 'name': flavor.name, 'disk': flavor.disk, 'ram': flavor.ram, 'vcpus': flavor.vcpus}
+            elif cmd == 'volume show':
+                result = self.__volume_to_dict(conn.block_storage.get_volume(positionals[0]))
+            elif cmd == 'volume create':
+                volume = {'name': positionals[0], 'size': int(options['size'][0])}
+                if 'snapshot' in options:
+                    volume['snapshot_id'] = options['snapshot'][0]
+                if 'image' in options:
+                    volume['image_id'] = options['image'][0]
+                result = self.__volume_to_dict(conn.block_storage.create_volume(**volume))
+            elif cmd == 'volume delete':
+                conn.block_storage.delete_volume(positionals[0], ignore_missing=False)
+            elif cmd == 'volume snapshot create':
+                result = self.__snapshot_to_dict(conn.block_storage.create_snapshot(volume_id=options['volume'][0], name=positionals[0], is_forced='force' in options))
+            elif cmd == 'volume snapshot show':
+                result = self.__snapshot_to_dict(conn.block_storage.get_snapshot(positionals[0]))
+            elif cmd == 'volume snapshot delete':
+                conn.block_storage.delete_snapshot(positionals[0], ignore_missing=False)
+            elif cmd == 'image create' and 'volume' in options:
+                # Same call as the CLI: Cinder uploads the volume to a new Glance image
+                upload = {'image_name': positionals[0], 'force': False, 'disk_format': options.get('disk-format', [image_format])[0], 'container_format': options.get('container-format', ['bare'])[0], 'protected': 'protected' in options}
+                result = self.__check_response(conn.block_storage.post('/volumes/%s/action' %(options['volume'][0]), json={'os-volume_upload_image': upload})).json()['os-volume_upload_image']
+            elif cmd == 'image create' and 'file' in options:
+                image_id = self.__create_image_record(conn, options, positionals)
+                with open(options['file'][0], 'rb') as f:
+                    result = self.__upload_image_data(conn, image_id, f)
+            elif cmd == 'image show':
+                result = self.__image_to_dict(conn.image.get_image(positionals[0]))
+            elif cmd == 'image delete':
+                conn.image.delete_image(positionals[0], ignore_missing=False)
+            elif cmd == 'server list':
+                result = [{'ID': server.id, 'Name': server.name, 'Status': server.status} for server in conn.compute.servers()]
+            elif cmd == 'volume list':
+                result = [{'ID': volume.id, 'Name': volume.name, 'Status': volume.status, 'Size': volume.size} for volume in conn.block_storage.volumes()]
+            elif cmd == 'volume snapshot list':
+                result = [{'ID': snapshot.id, 'Name': snapshot.name, 'Status': snapshot.status, 'Size': snapshot.size} for snapshot in conn.block_storage.snapshots()]
+            elif cmd == 'image list':
+                result = [{'ID': image.id, 'Name': image.name, 'Status': image.status} for image in conn.image.images()]
+            elif cmd == 'flavor list':
+                result = [{'ID': flavor.id, 'Name': flavor.name, 'RAM': flavor.ram, 'Disk': flavor.disk, 'VCPUs': flavor.vcpus} for flavor in conn.compute.flavors(is_public=None if 'all' in options else True)]
+            elif cmd == 'network list':
+                result = [{'ID': network.id, 'Name': network.name, 'Subnets': network.subnet_ids} for network in conn.network.networks()]
+            elif cmd == 'security group list':
+                result = [{'ID': sg.id, 'Name': sg.name, 'Description': sg.description, 'Project': sg.project_id} for sg in conn.network.security_groups()]
+            elif cmd == 'keypair list':
+                result = [{'Name': keypair.name, 'Fingerprint': keypair.fingerprint} for keypair in conn.compute.keypairs()]
+            elif cmd == 'port list':
+                ports = {}
+                if 'server' in options:
+                    ports['device_id'] = options['server'][0]
+                if 'network' in options:
+                    ports['network_id'] = conn.network.find_network(options['network'][0], ignore_missing=False).id
+                result = [{'ID': port.id, 'Name': port.name, 'Fixed IP Addresses': port.fixed_ips} for port in conn.network.ports(**ports)]
+            elif cmd == 'floating ip list':
+                ips = {}
+                if 'status' in options:
+                    ips['status'] = options['status'][0]
+                if 'fixed-ip-address' in options:
+                    ips['fixed_ip_address'] = options['fixed-ip-address'][0]
+                result = [self.__floating_ip_to_dict(ip) for ip in conn.network.ips(**ips)]
+            elif cmd == 'floating ip create':
+                result = self.__floating_ip_to_dict(conn.network.create_ip(floating_network_id=conn.network.find_network(positionals[0], ignore_missing=False).id))
+            elif cmd == 'floating ip set':
+                ip = next(iter(conn.network.ips(floating_ip_address=positionals[0])), None)
+                if ip is None:
+                    raise Exception('No floating IP found for %s' %(positionals[0]))
+                conn.network.update_ip(ip, port_id=options['port'][0], fixed_ip_address=options['fixed-ip-address'][0])
+            elif cmd == 'floating ip delete':
+                ip = next(iter(conn.network.ips(floating_ip_address=positionals[0])), None)
+                if ip is None:
+                    raise Exception('No floating IP found for %s' %(positionals[0]))
+                conn.network.delete_ip(ip, ignore_missing=False)
+            else:
+                raise Exception('Command %s is not supported by the sdk backend' %(cmd))
+        except openstack.exceptions.NotFoundException:
+            # Same wording as the CLI, so that __poll can still detect deleted resources
+            raise Exception('No %s found for %s' %(cmd.split()[0], ' '.join(positionals)))
+        except openstack.exceptions.SDKException as e:
+            raise Exception(str(e))
+
+        return result
+
+    async def get_result_async(self, cloud, cmd, params):
+        # openstacksdk has no asyncio API, the call runs in the default executor of the event loop
+        return await asyncio.to_thread(self.get_result, cloud, cmd, params)
+
+    def get_stream(self, cloud, cmd, params):
+        if cmd != 'image save':
+            raise Exception('Command %s cannot be streamed by the sdk backend' %(cmd))
+        options, positionals = self.__parse_params(params)
+
+        if verbose_level >= 4:
+            print('        sdk --os-cloud %s %s %s > (stream)' %(cloud, cmd, ' '.join(params)))
+        conn = self.__get_connection(cloud)
+        response = self.__check_response(conn.image.get('/images/%s/file' %(positionals[0]), stream=True))
+        try:
+            for chunk in response.iter_content(checksum_chunk_size):
+                yield chunk
+        finally:
+            response.close()
+
+    def get_image_download(self, cloud, image_id):
+        conn = self.__get_connection(cloud)
+        return (image_file_url(conn.image.get_endpoint(), image_id), {'X-Auth-Token': conn.image.get_token()})
+
+    def put_stream(self, cloud, cmd, params, chunks):
+        if cmd != 'image create':
+            raise Exception('Command %s cannot be streamed by the sdk backend' %(cmd))
+        options, positionals = self.__parse_params(params)
+
+        if verbose_level >= 4:
+            print('        (stream) | sdk --os-cloud %s %s %s' %(cloud, cmd, ' '.join(params)))
+        conn = self.__get_connection(cloud)
+        try:
+            image_id = self.__create_image_record(conn, options, positionals)
+            return self.__upload_image_data(conn, image_id, chunks)
+        except openstack.exceptions.SDKException as e:
+            raise Exception(str(e))
+
+def is_heavy_api_call(cmd, params):
+    # An option and its value are a single parameter, e.g. '--file <FILE>'
+    result = cmd in heavy_api_calls or (cmd == 'image create' and any([param.startswith('--file') for param in params]))
+    return result
+
+class OSCallGovernor:
+    # Caps the calls of one kind on one cloud, across processes when they share a lock directory
+    __name = None
+    __max_calls = None
+    __calls_per_second = None
+    __lock_dir = None
+    __semaphore = None
+    __lock = None
+    __next_call = 0.0
+
+    def __init__(self, name, max_calls, calls_per_second, lock_dir):
+        self.__name = name
+        self.__max_calls = max_calls
+        self.__calls_per_second = calls_per_second
+        self.__lock_dir = lock_dir
+        self.__lock = threading.Lock()
+        if max_calls is not None and lock_dir is None:
+            self.__semaphore = threading.BoundedSemaphore(max_calls)
+
+    def __try_slot(self):
+        result = None
+
+        # One lock file per slot: flock() locks are held per open file, by the threads of this process as well as by the other processes
+        for i in range(self.__max_calls):
+            if result is None:
+                f = open(os.path.join(self.__lock_dir, '%s.%s.lock' %(self.__name, i)), 'a')
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    result = f
+                except BlockingIOError:
+                    f.close()
+
+        return result
+
+    def __acquire_slot(self):
+        result = self.__try_slot()
+        while result is None:
+            time.sleep(api_lock_sleep_time)
+            result = self.__try_slot()
+        return result
+
+    def __book_turn(self):
+        # The calls are spaced out: each one books the next free time, the caller waits for the delay returned
+        interval = 1.0 / self.__calls_per_second
+        if self.__lock_dir is None:
+            with self.__lock:
+                call_time = max(time.time(), self.__next_call)
+                self.__next_call = call_time + interval
+        else:
+            with open(os.path.join(self.__lock_dir, '%s.next' %(self.__name)), 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                try:
+                    next_call = float(f.read())
+                except ValueError:
+                    next_call = 0.0
+                call_time = max(time.time(), next_call)
+                f.truncate(0)
+                f.write('%s' %(call_time + interval))
+        return call_time - time.time()
+
+    def acquire(self):
+        result = None
+
+        if self.__max_calls is not None:
+            if self.__semaphore is not None:
+                self.__semaphore.acquire()
+            else:
+                result = self.__acquire_slot()
+        if self.__calls_per_second is not None:
+            delay = self.__book_turn()
+            if delay > 0:
+                time.sleep(delay)
+
+        return result
+
+    async def acquire_async(self):
+        # Same as acquire(), retried between sleeps of the event loop instead of blocking it
+        result = None
+
+        if self.__max_calls is not None:
+            if self.__semaphore is not None:
+                while not self.__semaphore.acquire(blocking=False):
+                    await asyncio.sleep(api_lock_sleep_time)
+            else:
+                result = self.__try_slot()
+                while result is None:
+                    await asyncio.sleep(api_lock_sleep_time)
+                    result = self.__try_slot()
+        if self.__calls_per_second is not None:
+            delay = self.__book_turn()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        return result
+
+    def release(self, slot):
+        if self.__max_calls is not None:
+            if self.__semaphore is not None:
+                self.__semaphore.release()
+            else:
+                slot.close()
+
+class OSBackendLimiter:
+    # The VMs in flight wait for their turn instead of each running its own API calls, hence openstack CLI processes
+    __backend = None
+    __semaphore = None
+    __governors = None
+    __governors_lock = None
+    __held = None
+
+    def __init__(self, backend, max_calls):
+        self.__backend = backend
+        if max_calls is not None and max_calls > 0:
+            self.__semaphore = threading.BoundedSemaphore(max_calls)
+        self.__governors = {}
+        self.__governors_lock = threading.Lock()
+        self.__held = threading.local()
+
+    def __get_governor(self, cloud, heavy):
+        result = None
+
+        with self.__governors_lock:
+            if (cloud, heavy) not in self.__governors:
+                if heavy:
+                    self.__governors[(cloud, heavy)] = OSCallGovernor('%s.heavy' %(cloud), args.max_heavy_calls, args.heavy_calls_per_second, args.api_lock_dir)
+                else:
+                    self.__governors[(cloud, heavy)] = OSCallGovernor('%s.light' %(cloud), args.max_light_calls, args.light_calls_per_second, args.api_lock_dir)
+            result = self.__governors[(cloud, heavy)]
+
+        return result
+
+    def __acquire(self, cloud, heavy, counted):
+        result = None
+
+        if not hasattr(self.__held, 'clouds'):
+            self.__held.clouds = set()
+        # An image save streamed into an image create on the same cloud runs in the same thread: one slot for both
+        if not heavy or (cloud not in self.__held.clouds):
+            governor = self.__get_governor(cloud, heavy)
+            slot = governor.acquire()
+            if heavy:
+                self.__held.clouds.add(cloud)
+            result = (governor, slot, self.__held.clouds if heavy else None)
+        if counted and self.__semaphore is not None:
+            self.__semaphore.acquire()
+
+        return result
+
+    async def __acquire_async(self, cloud, heavy, counted):
+        # A coroutine never holds a stream slot: its streams run in threads of their own, through __acquire()
+        governor = self.__get_governor(cloud, heavy)
+        result = (governor, await governor.acquire_async(), None)
+        if counted and self.__semaphore is not None:
+            while not self.__semaphore.acquire(blocking=False):
+                await asyncio.sleep(api_lock_sleep_time)
+
+        return result
+
+    def __release(self, cloud, counted, turn):
+        if counted and self.__semaphore is not None:
+            self.__semaphore.release()
+        if turn is not None:
+            governor, slot, held_clouds = turn
+            governor.release(slot)
+            if held_clouds is not None:
+                held_clouds.discard(cloud)
+
+    def get_result(self, cloud, cmd, params):
+        turn = self.__acquire(cloud, is_heavy_api_call(cmd, params), True)
+        try:
+            return self.__backend.get_result(cloud, cmd, params)
+        finally:
+            self.__release(cloud, True, turn)
+
+    async def get_result_async(self, cloud, cmd, params):
+        turn = await self.__acquire_async(cloud, is_heavy_api_call(cmd, params), True)
+        try:
+            return await self.__backend.get_result_async(cloud, cmd, params)
+        finally:
+            self.__release(cloud, True, turn)
+
+    def get_stream(self, cloud, cmd, params):
+        # Image transfers last for hours, they are bounded by the number of VMs and --max-heavy-calls instead of --max-api-calls
+        turn = self.__acquire(cloud, is_heavy_api_call(cmd, params), False)
+        try:
+            for chunk in self.__backend.get_stream(cloud, cmd, params):
+                yield chunk
+        finally:
+            self.__release(cloud, False, turn)
+
+    def get_image_download(self, cloud, image_id):
+        turn = self.__acquire(cloud, False, True)
+        try:
+            return self.__backend.get_image_download(cloud, image_id)
+        finally:
+            self.__release(cloud, True, turn)
+
+    def put_stream(self, cloud, cmd, params, chunks):
+        turn = self.__acquire(cloud, True, False)
+        try:
+            return self.__backend.put_stream(cloud, cmd, params, chunks)
+        finally:
+            self.__release(cloud, False, turn)
+
+class OSAPIProfiler:
+    __backend = None
+    __lock = None
+    __calls = None
+    __last_errors = None
+
+    def __init__(self, backend):
+        self.__backend = backend
+        self.__lock = threading.Lock()
+        self.__calls = {}
+        self.__last_errors = {}
+
+    def __record(self, cloud, cmd, params, start, error):
+        duration = time.time() - start
+        with self.__lock:
+            key = (cloud, cmd)
+            if key not in self.__calls:
+                self.__calls[key] = {'latencies': [], 'errors': 0, 'retries': 0, 'repeats': 0}
+            stats = self.__calls[key]
+            stats['latencies'].append(duration)
+            if error is not None:
+                stats['errors'] += 1
+            # The same call again: after an error it is a retry, otherwise a poll
+            call_key = (cloud, cmd, ' '.join(params))
+            if call_key in self.__last_errors:
+                if self.__last_errors[call_key]:
+                    stats['retries'] += 1
+                else:
+                    stats['repeats'] += 1
+            self.__last_errors[call_key] = error is not None
+
+        if args.api_slow_call is not None and duration > args.api_slow_call:
+            dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+            print('    %s: Slow API call (%.1fs): %s on cloud %s %s%s' %(dt, duration, cmd, cloud, ' '.join(params), ' (failed)' if error is not None else ''))
+
+    def get_result(self, cloud, cmd, params):
+        error = None
+        start = time.time()
+        try:
+            return self.__backend.get_result(cloud, cmd, params)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.__record(cloud, cmd, params, start, error)
+
+    async def get_result_async(self, cloud, cmd, params):
+        error = None
+        start = time.time()
+        try:
+            return await self.__backend.get_result_async(cloud, cmd, params)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.__record(cloud, cmd, params, start, error)
+
+    def get_stream(self, cloud, cmd, params):
+        error = None
+        start = time.time()
+        try:
+            for chunk in self.__backend.get_stream(cloud, cmd, params):
+                yield chunk
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.__record(cloud, cmd, params, start, error)
+
+    def get_image_download(self, cloud, image_id):
+        error = None
+        start = time.time()
+        try:
+            return self.__backend.get_image_download(cloud, image_id)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.__record(cloud, 'image download url', [image_id], start, error)
+
+    def put_stream(self, cloud, cmd, params, chunks):
+        error = None
+        start = time.time()
+        try:
+            return self.__backend.put_stream(cloud, cmd, params, chunks)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.__record(cloud, cmd, params, start, error)
+
+    def get_stats(self):
+        result = []
+
+        with self.__lock:
+            for (cloud, cmd), stats in sorted(self.__calls.items()):
+                latencies = sorted(stats['latencies'])
+                def percentile(p):
+                    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+                result.append({'cloud': cloud, 'cmd': cmd, 'calls': len(latencies), 'errors': stats['errors'], 'retries': stats['retries'], 'repeats': stats['repeats'], 'total': sum(latencies), 'p50': percentile(50), 'p90': percentile(90), 'p99': percentile(99), 'max': latencies[-1]})
+
+        return result
+
+    def report(self):
+        stats = self.get_stats()
+        if len(stats) == 0:
+            return
+
+        # Slowest commands overall first
+        stats.sort(key=lambda s: s['total'], reverse=True)
+        cloud_width = max([len('CLOUD')] + [len(s['cloud']) for s in stats])
+        cmd_width = max([len('COMMAND')] + [len(s['cmd']) for s in stats])
+        print('')
+        print('%-*s  %-*s  %6s  %6s  %7s  %7s  %8s  %8s  %8s  %8s  %9s' %(cloud_width, 'CLOUD', cmd_width, 'COMMAND', 'CALLS', 'ERRORS', 'RETRIES', 'REPEATS', 'P50', 'P90', 'P99', 'MAX', 'TOTAL'))
+        for s in stats:
+            print('%-*s  %-*s  %6s  %6s  %7s  %7s  %7.2fs  %7.2fs  %7.2fs  %7.2fs  %8.1fs' %(cloud_width, s['cloud'], cmd_width, s['cmd'], s['calls'], s['errors'], s['retries'], s['repeats'], s['p50'], s['p90'], s['p99'], s['max'], s['total']))
+
+        if args.api_profile is not None:
+            with open('%s.tmp' %(args.api_profile), 'w') as f:
+                json.dump(stats, f, indent=4)
+            os.replace('%s.tmp' %(args.api_profile), args.api_profile)
+
+os_backend = None
+if args.os_backend == 'sdk':
+    os_backend = OSSDKBackend()
+else:
+    if args.openstack_cmd is not None and args.openstack_cmd != '':
+        openstack_cmd = args.openstack_cmd
+    os_backend = OSCLIBackend(openstack_cmd)
+# Inside the limiter, the time spent waiting for a turn is not part of the latency of the calls
+api_profiler = None
+if args.api_profile is not None or args.api_slow_call is not None:
+    api_profiler = OSAPIProfiler(os_backend)
+    os_backend = api_profiler
+if (args.max_api_calls is not None and args.max_api_calls > 0) or args.max_heavy_calls is not None or args.max_light_calls is not None or args.heavy_calls_per_second is not None or args.light_calls_per_second is not None:
+    if args.api_lock_dir is not None:
+        os.makedirs(args.api_lock_dir, exist_ok=True)
+    os_backend = OSBackendLimiter(os_backend, args.max_api_calls)
+
+def wake_up(future):
+    # Run by the event loop: the coroutine may have stopped waiting meanwhile
+    if not future.done():
+        future.set_result(None)
+
+class OSStatusWatcher:
+    __list_cmds = {'server show': 'server list', 'volume show': 'volume list', 'volume snapshot show': 'volume snapshot list', 'image show': 'image list'}
+    __condition = None
+    __groups = None
+
+    def __init__(self):
+        self.__condition = threading.Condition()
+        self.__groups = {}
+
+    def supports(self, cmd):
+        return cmd in self.__list_cmds
+
+    def __refresh(self, group_key):
+        cloud, list_cmd = group_key
+        sleep_time = polling_min_sleep_time
+
+        while True:
+            with self.__condition:
+                group = self.__groups[group_key]
+                if group['waiters'] == 0:
+                    group['thread'] = None
+                    return
+                group['in_flight'] = True
+
+            rows = None
+            try:
+                rows = os_backend.get_result(cloud, list_cmd, [])
+            except Exception as e:
+                if verbose_level >= 3:
+                    dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                    print('    %s: %s on cloud %s failed: %s' %(dt, list_cmd, cloud, str(e).strip()))
+
+            with self.__condition:
+                group['in_flight'] = False
+                # On failure, the waiters keep waiting for the next successful list (or their deadline)
+                if rows is not None:
+                    group['ids'] = {}
+                    group['names'] = {}
+                    for row in rows:
+                        row = dict([(k.lower(), v) for k, v in row.items()])
+                        group['ids'][row['id']] = row
+                        if row.get('name') is not None and row['name'] not in group['names']:
+                            group['names'][row['name']] = row
+                    group['generation'] += 1
+                    self.__condition.notify_all()
+                    for loop, future in group['futures']:
+                        loop.call_soon_threadsafe(wake_up, future)
+                    group['futures'] = []
+
+                if group['wakeup']:
+                    sleep_time = polling_min_sleep_time
+                    group['wakeup'] = False
+                else:
+                    sleep_time = min(sleep_time * polling_backoff, polling_sleep_time)
+                group['event'].clear()
+
+            group['event'].wait(sleep_time)
+
+    def __start_wait(self, cloud, cmd, generation):
+        # Called with the condition held
+        group_key = (cloud, self.__list_cmds[cmd])
+        if group_key not in self.__groups:
+            self.__groups[group_key] = {'waiters': 0, 'generation': 0, 'in_flight': False, 'wakeup': False, 'event': threading.Event(), 'thread': None, 'ids': {}, 'names': {}, 'futures': []}
+        group = self.__groups[group_key]
+
+        if generation is None:
+            # First call of a wait: only trust a list started after now, and ask for it soon
+            generation = group['generation']
+            if group['in_flight']:
+                generation += 1
+            group['wakeup'] = True
+            group['event'].set()
+
+        group['waiters'] += 1
+        if group['thread'] is None:
+            group['thread'] = threading.Thread(target=self.__refresh, args=(group_key,), daemon=True)
+            group['thread'].start()
+
+        return (group, generation)
+
+    def __end_wait(self, group, resource, generation):
+        # Called with the condition held
+        group['waiters'] -= 1
+        fresh = group['generation'] > generation
+        row = None
+        if fresh:
+            row = group['ids'].get(resource, group['names'].get(resource))
+        return (group['generation'], row, fresh)
+
+    def get(self, cloud, cmd, resource, generation, deadline):
+        result = None
+
+        with self.__condition:
+            group, generation = self.__start_wait(cloud, cmd, generation)
+            try:
+                while group['generation'] <= generation:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.__condition.wait(remaining)
+            finally:
+                result = self.__end_wait(group, resource, generation)
+
+        return result
+
+    async def get_async(self, cloud, cmd, resource, generation, deadline):
+        # Same as get() for a coroutine, woken up by the refresh thread through the event loop
+        result = None
+
+        loop = asyncio.get_running_loop()
+        with self.__condition:
+            group, generation = self.__start_wait(cloud, cmd, generation)
+        try:
+            while True:
+                with self.__condition:
+                    remaining = deadline - time.time()
+                    if group['generation'] > generation or remaining <= 0:
+                        break
+                    future = loop.create_future()
+                    group['futures'].append((loop, future))
+                try:
+                    await asyncio.wait_for(future, remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self.__condition:
+                result = self.__end_wait(group, resource, generation)
+
+        return result
+
+status_watcher = None
+
+class OSMetadataCache:
+    __list_cmds = {'flavor': ('flavor list', ['--all']), 'volume': ('volume list', []), 'network': ('network list', []), 'security group': ('security group list', []), 'keypair': ('keypair list', []), 'port': ('port list', [])}
+    __lock = None
+    __entries = None
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__entries = {}
+
+    def get(self, cloud, resource, params=[]):
+        result = None
+
+        key = (cloud, resource, ' '.join(params))
+        with self.__lock:
+            entry = self.__entries.setdefault(key, {'lock': threading.Lock(), 'rows': None})
+        # One list call per cloud and resource type, whatever the number of VMs asking for it at the same time
+        with entry['lock']:
+            if entry['rows'] is None:
+                cmd, list_params = self.__list_cmds[resource]
+                entry['rows'] = os_backend.get_result(cloud, cmd, list_params + params)
+            result = entry['rows']
+
+        return result
+
+    def find(self, cloud, resource, name_or_id, params=[]):
+        result = None
+
+        for row in self.get(cloud, resource, params):
+            if row.get('ID') == name_or_id or row.get('Name') == name_or_id:
+                result = row
+                break
+
+        return result
+
+metadata_cache = OSMetadataCache()
+
+class OSFloatingIPPool:
+    __lock = None
+    __clouds = None
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__clouds = {}
+
+    def __get_cloud(self, cloud):
+        with self.__lock:
+            return self.__clouds.setdefault(cloud, {'lock': threading.Lock(), 'free': None, 'created': [], 'demand': 0})
+
+    def reserve(self, cloud, count):
+        # Number of addresses the batch is going to ask for, allocated at once when the free ones run out
+        pool = self.__get_cloud(cloud)
+        with pool['lock']:
+            pool['demand'] += count
+
+    def acquire(self, cloud):
+        result = None
+
+        pool = self.__get_cloud(cloud)
+        with pool['lock']:
+            if pool['free'] is None:
+                pool['free'] = [ip['Floating IP Address'] for ip in os_backend.get_result(cloud, 'floating ip list', ['--status DOWN'])]
+            if len(pool['free']) == 0:
+                count = max(1, pool['demand'])
+                if verbose_level >= 2:
+                    dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                    print('    %s: Allocating %s floating IPs on cloud %s...' %(dt, count, cloud))
+                for i in range(count):
+                    ip = os_backend.get_result(cloud, 'floating ip create', [external_network])['floating_ip_address']
+                    pool['free'].append(ip)
+                    pool['created'].append(ip)
+            result = pool['free'].pop(0)
+            pool['demand'] = max(0, pool['demand'] - 1)
+
+        return result
+
+    def release(self, cloud, ip):
+        pool = self.__get_cloud(cloud)
+        with pool['lock']:
+            pool['free'].insert(0, ip)
+
+    def release_unused(self):
+        # Only the addresses allocated by this run, the ones that were already free are left as they were
+        for cloud, pool in list(self.__clouds.items()):
+            with pool['lock']:
+                for ip in pool['created']:
+                    if ip in pool['free']:
+                        try:
+                            os_backend.get_result(cloud, 'floating ip delete', [ip])
+                            pool['free'].remove(ip)
+                            if verbose_level >= 2:
+                                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                                print('%s: Unused floating IP %s released on cloud %s.' %(dt, ip, cloud))
+                        except Exception as e:
+                            print(e)
+                pool['created'] = []
+
+floating_ip_pool = OSFloatingIPPool()
+
+class OSCleanupQueue:
+    __executor = None
+    __semaphore = None
+    __lock = None
+    __futures = None
+    __failures = None
+
+    def __init__(self, workers):
+        if event_loop is not None:
+            # Coroutines of the event loop, like the VMs
+            self.__semaphore = asyncio.Semaphore(workers)
+        else:
+            self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.__lock = threading.Lock()
+        self.__futures = []
+        self.__failures = []
+
+    def __record(self, vm, cloud, resources, done, error):
+        if error is None and not done:
+            error = 'Resources not deleted'
+        if error is not None:
+            with self.__lock:
+                self.__failures.append({'vm': vm, 'cloud': cloud, 'resources': resources, 'error': error})
+
+    def submit(self, vm, cloud, resources, steps):
+        def run():
+            done = False
+            error = None
+            try:
+                done = drive_steps(steps)
+            except Exception as e:
+                error = str(e).strip()
+            self.__record(vm, cloud, resources, done, error)
+
+        async def run_async():
+            done = False
+            error = None
+            async with self.__semaphore:
+                try:
+                    done = await drive_steps_async(steps)
+                except Exception as e:
+                    error = str(e).strip()
+            self.__record(vm, cloud, resources, done, error)
+
+        with self.__lock:
+            if self.__semaphore is not None:
+                self.__futures.append(event_loop.create_task(run_async()))
+            else:
+                self.__futures.append(self.__executor.submit(run))
+
+    def wait(self):
+        result = []
+
+        # A cleanup may still queue another one while we wait
+        pending = True
+        while pending:
+            with self.__lock:
+                futures = [f for f in self.__futures if not f.done()]
+            pending = len(futures) > 0
+            if pending:
+                if self.__semaphore is not None:
+                    event_loop.run_until_complete(asyncio.wait(futures))
+                else:
+                    concurrent.futures.wait(futures)
+        if self.__executor is not None:
+            self.__executor.shutdown()
+
+        with self.__lock:
+            result = list(self.__failures)
+
+        return result
+
+cleanup_queue = None
+# Event loop of --engine asyncio, running the VMs and their cleanups
+event_loop = None
+
+class OSChunkStore:
+    __directory = None
+    __zero_digest = block_digest(bytes(chunk_store_chunk_size))
+
+    def __init__(self, directory):
+        self.__directory = os.path.abspath(directory)
+        # Also the staging disk for --check-staging-space, before anything is stored
+        os.makedirs(self.__directory, exist_ok=True)
+
+    def __get_path(self, digest):
+        return os.path.join(self.__directory, digest[:2], digest)
+
+    def __get_registry_path(self, filename):
+        # The recipes can be anywhere, the store keeps track of them to know which chunks are still used
+        return os.path.join(self.__directory, 'recipes', hashlib.md5(os.path.abspath(filename).encode()).hexdigest())
+
+    def __open_lock(self):
+        # Shared by the saves, exclusive for the removals, see remove()
+        return open(os.path.join(self.__directory, 'gc.lock'), 'a')
+
+    def __put(self, chunk):
+        # Returns the digest of the chunk and the bytes actually written
+        written = 0
+        digest = block_digest(chunk)
+        # Zero chunks are not stored at all, like holes
+        if digest != self.__zero_digest:
+            path = self.__get_path(digest)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Other VMs and processes may store the same chunk at the same time
+                tmp_path = '%s.%s.%s.tmp' %(path, os.getpid(), threading.get_ident())
+                with open(tmp_path, 'wb') as f:
+                    f.write(chunk)
+                os.replace(tmp_path, path)
+                written = len(chunk)
+        return digest, written
+
+    def save(self, filename, chunks, on_written=None):
+        # Writes the recipe of the image made of chunks, returns its size and the bytes not already in the store, also given to on_written as they are written
+        size = 0
+        written = 0
+        digests = []
+        buffer = bytearray()
+
+        registry_path = self.__get_registry_path(filename)
+        os.makedirs(os.path.dirname(registry_path), exist_ok=True)
+        # The chunks of a recipe not written yet are used too: listed as they are stored, under the shared lock
+        with self.__open_lock() as lock, open('%s.pending' %(registry_path), 'w') as pending:
+            def put(chunk):
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                try:
+                    digest, chunk_written = self.__put(chunk)
+                    pending.write('%s\n' %(digest))
+                    pending.flush()
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+                if on_written is not None and chunk_written > 0:
+                    on_written(chunk_written)
+                return digest, chunk_written
+
+            try:
+                for chunk in chunks:
+                    buffer += chunk
+                    while len(buffer) >= chunk_store_chunk_size:
+                        digest, chunk_written = put(bytes(buffer[:chunk_store_chunk_size]))
+                        digests.append(digest)
+                        written += chunk_written
+                        del buffer[:chunk_store_chunk_size]
+                    size += len(chunk)
+                if len(buffer) > 0:
+                    digest, chunk_written = put(bytes(buffer))
+                    digests.append(digest)
+                    written += chunk_written
+
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                with open('%s.tmp' %(filename), 'w') as f:
+                    json.dump({'store': self.__directory, 'chunk_size': chunk_store_chunk_size, 'size': size, 'chunks': digests}, f)
+                os.replace('%s.tmp' %(filename), filename)
+                with open('%s.tmp' %(registry_path), 'w') as f:
+                    f.write(os.path.abspath(filename))
+                os.replace('%s.tmp' %(registry_path), registry_path)
+            finally:
+                os.remove('%s.pending' %(registry_path))
+
+        return size, written
+
+    def remove(self, filename):
+        # Only removes the recipe, its chunks are freed by the next sweep()
+        with self.__open_lock() as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            for path in [filename, self.__get_registry_path(filename)]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def sweep(self):
+        # Removes the chunks that no recipe, written or being written, uses; returns the bytes freed
+        result = 0
+
+        with self.__open_lock() as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            registry_dir = os.path.join(self.__directory, 'recipes')
+            if not os.path.isdir(registry_dir):
+                # Written before the recipes were tracked, the chunks still used are unknown
+                return result
+
+            used = set()
+            for name in os.listdir(registry_dir):
+                path = os.path.join(registry_dir, name)
+                if name.endswith('.pending'):
+                    with open(path, 'r') as f:
+                        used.update(f.read().split())
+                elif not name.endswith('.tmp'):
+                    with open(path, 'r') as f:
+                        recipe_filename = f.read()
+                    try:
+                        with open(recipe_filename, 'r') as f:
+                            used.update(json.load(f)['chunks'])
+                    except FileNotFoundError:
+                        # Recipe deleted by hand
+                        os.remove(path)
+
+            for prefix in os.listdir(self.__directory):
+                directory = os.path.join(self.__directory, prefix)
+                if len(prefix) != 2 or not os.path.isdir(directory):
+                    continue
+                for digest in os.listdir(directory):
+                    if digest not in used and not digest.endswith('.tmp'):
+                        path = os.path.join(directory, digest)
+                        result += os.path.getsize(path)
+                        os.remove(path)
+
+        return result
+
+    def read(self, recipe):
+        remaining = recipe['size']
+        for digest in recipe['chunks']:
+            length = min(recipe['chunk_size'], remaining)
+            if digest == self.__zero_digest and length == chunk_store_chunk_size:
+                yield zero_chunk[:length]
+            else:
+                with open(self.__get_path(digest), 'rb') as f:
+                    chunk = f.read()
+                if len(chunk) != length:
+                    raise Exception('Chunk %s of the store %s is corrupted' %(digest, self.__directory))
+                yield chunk
+            remaining -= length
+
+chunk_store = None
+if args.chunk_store is not None:
+    chunk_store = OSChunkStore(args.chunk_store)
+# The stores whose recipes were removed during the run, see sweep_chunk_stores()
+chunk_stores_to_sweep = set()
+chunk_stores_lock = threading.Lock()
+
+class OSStagingSpace:
+    __directory = None
+    __margin = None
+    __condition = None
+    __reservations = None
+
+    def __init__(self, directory, margin):
+        self.__directory = directory
+        self.__margin = margin
+        self.__condition = threading.Condition()
+        self.__reservations = {}
+
+    def __get_available(self):
+        # The files being saved are already out of the free space for what they have written, in the files or in the chunk store
+        pending = 0
+        for reservation in self.__reservations.values():
+            written = reservation['written']
+            for filename in reservation['files']:
+                if os.path.exists(filename):
+                    written += os.stat(filename).st_blocks * 512
+            pending += max(0, reservation['size'] - written)
+        result = shutil.disk_usage(self.__directory).free - self.__margin - pending
+        return result
+
+    def __try_reserve(self, vm, size, files, waiting):
+        # Called with the condition held: True once reserved, False if it never will be, None to wait
+        result = None
+
+        available = self.__get_available()
+        if available >= size:
+            self.__reservations[vm] = {'size': size, 'files': [os.path.abspath(filename) for filename in files], 'written': 0}
+            result = True
+        elif len(self.__reservations) == 0:
+            # Nothing else will give space back
+            result = False
+            if verbose_level >= 1:
+                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                print('    %s: Not enough staging space for VM %s: %.1f GiB needed, %.1f GiB available!' %(dt, vm, size / 1024**3, max(0, available) / 1024**3))
+        elif verbose_level >= 1 and not waiting:
+            dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+            print('    %s: Waiting for %.1f GiB of staging space for VM %s (%.1f GiB available)...' %(dt, size / 1024**3, vm, max(0, available) / 1024**3))
+
+        return result
+
+    def reserve(self, vm, size, files):
+        result = None
+
+        with self.__condition:
+            result = self.__try_reserve(vm, size, files, False)
+            while result is None:
+                self.__condition.wait(staging_sleep_time)
+                result = self.__try_reserve(vm, size, files, True)
+
+        return result
+
+    async def reserve_async(self, vm, size, files):
+        # Same as reserve() for a coroutine, checked again every staging_sleep_time
+        result = None
+
+        with self.__condition:
+            result = self.__try_reserve(vm, size, files, False)
+        while result is None:
+            await asyncio.sleep(staging_sleep_time)
+            with self.__condition:
+                result = self.__try_reserve(vm, size, files, True)
+
+        return result
+
+    def add_written(self, filename, size):
+        # The chunks a recipe adds to the store are not in the recipe file itself
+        with self.__condition:
+            for reservation in self.__reservations.values():
+                if os.path.abspath(filename) in reservation['files']:
+                    reservation['written'] += size
+
+    def release(self, vm):
+        with self.__condition:
+            if vm in self.__reservations:
+                del self.__reservations[vm]
+                self.__condition.notify_all()
+
+staging_space = None
+if args.check_staging_space:
+    staging_margin = default_staging_margin
+    if args.staging_margin is not None:
+        staging_margin = args.staging_margin
+    staging_space = OSStagingSpace(args.chunk_store if args.chunk_store is not None else '.', int(staging_margin * 1024**3))
+
+# The steps of OSVM are generators yielding the operations they wait for, so that the same step sequence runs
+# in a thread (drive_steps) or as a coroutine of the event loop of --engine asyncio (drive_steps_async):
+#   ('call', cloud, cmd, params)                           API call, returns its result
+#   ('sleep', seconds)
+#   ('watch', cloud, cmd, resource, generation, deadline)  status from status_watcher, see OSStatusWatcher.get()
+#   ('staging', vm, size, files)                           staging space reservation, see OSStagingSpace.reserve()
+#   ('blocking', func, arg...)                             anything else that blocks, e.g. an image transfer, returns func(arg...)
+#   ('start', [steps...])                                  starts other step sequences along this one, returns their handles
+#   ('join', handle)                                       waits for a started step sequence, returns its result
+# An operation that fails raises its exception in the generator, where it yielded it.
+def run_operation(operation):
+    result = None
+
+    kind = operation[0]
+    if kind == 'call':
+        result = os_backend.get_result(*operation[1:])
+    elif kind == 'sleep':
+        time.sleep(operation[1])
+    elif kind == 'watch':
+        result = status_watcher.get(*operation[1:])
+    elif kind == 'staging':
+        result = staging_space.reserve(*operation[1:])
+    elif kind == 'blocking':
+        result = operation[1](*operation[2:])
+    elif kind == 'start':
+        result = []
+        if len(operation[1]) > 0:
+            # One thread per step sequence, none of them waits for the other VMs
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(operation[1]))
+            result = [executor.submit(drive_steps, steps) for steps in operation[1]]
+            # The threads end with their step sequence
+            executor.shutdown(wait=False)
+    elif kind == 'join':
+        result = operation[1].result()
+    else:
+        raise Exception('Unknown operation %s' %(kind))
+
+    return result
+
+def drive_steps(steps):
+    result = None
+
+    value = None
+    error = None
+    while True:
+        try:
+            if error is not None:
+                operation = steps.throw(error)
+            else:
+                operation = steps.send(value)
+        except StopIteration as e:
+            result = e.value
+            break
+        value = None
+        error = None
+        try:
+            value = run_operation(operation)
+        except Exception as e:
+            error = e
+
+    return result
+
+async def run_blocking(func, *func_args):
+    # A thread for the time of the call only: the VMs that wait for OpenStack do not hold any
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    def run():
+        try:
+            loop.call_soon_threadsafe(future.set_result, func(*func_args))
+        except BaseException as e:
+            loop.call_soon_threadsafe(future.set_exception, e)
+    threading.Thread(target=run, daemon=True).start()
+    return await future
+
+async def run_operation_async(operation):
+    result = None
+
+    kind = operation[0]
+    if kind == 'call':
+        result = await os_backend.get_result_async(*operation[1:])
+    elif kind == 'sleep':
+        await asyncio.sleep(operation[1])
+    elif kind == 'watch':
+        result = await status_watcher.get_async(*operation[1:])
+    elif kind == 'staging':
+        result = await staging_space.reserve_async(*operation[1:])
+    elif kind == 'blocking':
+        result = await run_blocking(operation[1], *operation[2:])
+    elif kind == 'start':
+        result = [event_loop.create_task(drive_steps_async(steps)) for steps in operation[1]]
+    elif kind == 'join':
+        result = await operation[1]
+    else:
+        raise Exception('Unknown operation %s' %(kind))
+
+    return result
+
+async def drive_steps_async(steps):
+    result = None
+
+    value = None
+    error = None
+    while True:
+        try:
+            if error is not None:
+                operation = steps.throw(error)
+            else:
+                operation = steps.send(value)
+        except StopIteration as e:
+            result = e.value
+            break
+        value = None
+        error = None
+        try:
+            value = await run_operation_async(operation)
+        except Exception as e:
+            error = e
+
+    return result
+
+def run_all_steps(steps_list, workers):
+    # Results in the same order as the step sequences, workers of them running at the same time
+    result = []
+
+    if event_loop is not None:
+        semaphore = asyncio.Semaphore(workers)
+        async def drive(steps):
+            async with semaphore:
+                return await drive_steps_async(steps)
+        async def drive_all():
+            return await asyncio.gather(*[drive(steps) for steps in steps_list])
+        result = event_loop.run_until_complete(drive_all())
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            result = [future.result() for future in [executor.submit(drive_steps, steps) for steps in steps_list]]
+
+    return result
+
+def run_steps(steps):
+    result = None
+
+    if event_loop is not None:
+        result = event_loop.run_until_complete(drive_steps_async(steps))
+    else:
+        result = drive_steps(steps)
+
+    return result
+
 class OSVM:
     __action = None
     __export_cloud = None
     __import_cloud = None
     __polling_sleep_time = None
+    __polling_long_sleep_time = None
     __polling_timeout = None
+    __polling_long_timeout = None
     __vm_name = None
     __volume_id = None
     __snap_id = None
@@ -61,6 +1991,9 @@ class OSVM:
     __image_format = None
     __image_checksum = None
     __image_file_checksum = None
+    __image_hash_algo = None
+    __image_hash_value = None
+    __image_file_hashes = None
     __export_checksum_ok = False
     __import_checksum_ok = False
     __key_name = None
@@ -73,8 +2006,33 @@ class OSVM:
     __min_ram = None
     __min_disk = None
     __keep = False
+    __stream = False
+    __streamed_image_id = None
+    __floating_done = False
+    __data_volume = False
+    __data_volumes = None
+    __data_volume_osvms = None
+    __data_volumes_attached = False
+    __metrics = None
+    __metrics_run = None
+    __pending_cleanups = None
+    __cleanups_resumed = False
+    __submitted_cleanups = None
+    __lock = None
+    __run_start = None
+    __phase_bytes = None
+    __journal_filename = None
+    __journal_phase = None
+    __journal_steps = None
+    __journal_attrs = ['volume_id', 'snap_id', 'newvol_id', 'image_id', 'image_checksum', 'vm_id', 'vm_size', 'key_name', 'security_groups', 'flavor_name', 'subnet_names', 'ips', 'has_floating', 'floating_subnet', 'image_hash_algo', 'image_hash_value', 'image_file', 'image_file_checksum', 'image_file_hashes', 'export_checksum_ok', 'import_checksum_ok', 'streamed_image_id', 'floating_done', 'data_volumes', 'data_volumes_attached', 'pending_cleanups']
+
+    def __init__(self, export_cloud=None, import_cloud=None, vm_name=None, volume_id=None, snap_id=None, vm_size=None, newvol_id=None, image_id=None, image_filename=None, key_name=None, security_groups=None, flavor_name=None, subnet_names=None, ips=None, min_ram=None, min_disk=None, poll_sleep_time=None, poll_timeout=None, poll_long_timeout=None, data_volume=None):
+        # A data volume of a VM takes nothing specific to the VM from the command line
+        vm_args = args
+        if data_volume is not None:
+            vm_args = argparse.Namespace(**dict.fromkeys(['volume_id', 'snap_id', 'vm_size', 'newvol_id', 'image_id', 'image_filename', 'key_name', 'security_groups', 'flavor_name', 'subnet_names', 'ips', 'min_ram', 'min_disk']))
+            self.__data_volume = True
 
-    def __init__(self, export_cloud=None, import_cloud=None, vm_name=None, volume_id=None, snap_id=None, vm_size=None, newvol_id=None, image_id=None, image_filename=None, key_name=None, security_groups=None, flavor_name=None, subnet_names=None, ips=None, min_ram=None, min_disk=None, poll_sleep_time=None, poll_timeout=None):
         if export_cloud is not None and export_cloud != '':
             self.__export_cloud = export_cloud
         elif args.export_cloud is not None and args.export_cloud != '':
@@ -92,34 +2050,35 @@ class OSVM:
 
         if volume_id is not None and volume_id != '':
             self.__volume_id = volume_id
-        elif args.volume_id is not None and args.volume_id != '':
-            self.__volume_id = args.volume_id
+        elif vm_args.volume_id is not None and vm_args.volume_id != '':
+            self.__volume_id = vm_args.volume_id
 
         if snap_id is not None and snap_id != '':
             self.__snap_id = snap_id
-        elif args.snap_id is not None and args.snap_id != '':
-            self.__snap_id = args.snap_id
+        elif vm_args.snap_id is not None and vm_args.snap_id != '':
+            self.__snap_id = vm_args.snap_id
 
         if vm_size is not None and vm_size != '':
             self.__vm_size = vm_size
-        elif args.vm_size is not None and args.vm_size != '':
-            self.__vm_size = args.vm_size
+        elif vm_args.vm_size is not None and vm_args.vm_size != '':
+            self.__vm_size = vm_args.vm_size
 
         if newvol_id is not None and newvol_id != '':
             self.__newvol_id = newvol_id
-        elif args.newvol_id is not None and args.newvol_id != '':
-            self.__newvol_id = args.newvol_id
+        elif vm_args.newvol_id is not None and vm_args.newvol_id != '':
+            self.__newvol_id = vm_args.newvol_id
 
         if image_id is not None and image_id != '':
             self.__image_id = image_id
-        elif args.image_id is not None and args.image_id != '':
-            self.__image_id = args.image_id
+        elif vm_args.image_id is not None and vm_args.image_id != '':
+            self.__image_id = vm_args.image_id
 
         if image_filename is not None and image_filename != '':
             self.__image_filename = image_filename
-        elif args.image_filename is not None and args.image_filename != '':
-            self.__image_filename = args.image_filename
-        if self.__image_filename is not None and os.path.isfile(self.__image_filename):
+        elif vm_args.image_filename is not None and vm_args.image_filename != '':
+            self.__image_filename = vm_args.image_filename
+        # With --delta, the file left by a previous export is brought up to date instead, and an interrupted save is resumed
+        if self.__image_filename is not None and os.path.isfile(self.__image_filename) and not (args.delta and self.__export_cloud is not None) and not is_partial_image_file(self.__image_filename):
             self.__image_file = self.__image_filename
 
         if args.image_format is not None and args.image_format != '':
@@ -130,40 +2089,40 @@ class OSVM:
 
         if key_name is not None and key_name != '':
             self.__key_name = key_name
-        elif args.key_name is not None and args.key_name != '':
-            self.__key_name = args.key_name
+        elif vm_args.key_name is not None and vm_args.key_name != '':
+            self.__key_name = vm_args.key_name
 
         if security_groups is not None and security_groups != '':
             self.__security_groups = security_groups
-        elif args.security_groups is not None and args.security_groups != '':
-            self.__security_groups = args.security_groups
+        elif vm_args.security_groups is not None and vm_args.security_groups != '':
+            self.__security_groups = vm_args.security_groups
 
         if flavor_name is not None and flavor_name != '':
             self.__flavor_name = flavor_name
-        elif args.flavor_name is not None and args.flavor_name != '':
-            self.__flavor_name = args.flavor_name
+        elif vm_args.flavor_name is not None and vm_args.flavor_name != '':
+            self.__flavor_name = vm_args.flavor_name
 
         if subnet_names is not None and subnet_names != '':
             self.__subnet_names = subnet_names
-        elif args.subnet_names is not None and args.subnet_names != '':
-            self.__subnet_names = args.subnet_names
+        elif vm_args.subnet_names is not None and vm_args.subnet_names != '':
+            self.__subnet_names = vm_args.subnet_names
 
         if ips is not None and ips != '':
             self.__ips = ips
-        elif args.ips is not None and args.ips != '':
-            self.__ips = args.ips
+        elif vm_args.ips is not None and vm_args.ips != '':
+            self.__ips = vm_args.ips
 
         if min_ram is not None and min_ram != '':
             self.__min_ram = min_ram
-        elif args.min_ram is not None and args.min_ram != '':
-            self.__min_ram = args.min_ram
+        elif vm_args.min_ram is not None and vm_args.min_ram != '':
+            self.__min_ram = vm_args.min_ram
         else:
             self.__min_ram = default_min_ram
 
         if min_disk is not None and min_disk != '':
             self.__min_disk = min_disk
-        elif args.min_disk is not None and args.min_disk != '':
-            self.__min_disk = args.min_disk
+        elif vm_args.min_disk is not None and vm_args.min_disk != '':
+            self.__min_disk = vm_args.min_disk
         else:
             self.__min_disk = default_min_disk
 
@@ -173,15 +2132,52 @@ class OSVM:
             global polling_sleep_time
             self.__polling_sleep_time = polling_sleep_time
 
+        global polling_long_sleep_time
+        self.__polling_long_sleep_time = max(polling_long_sleep_time, self.__polling_sleep_time)
+
         if poll_timeout is not None and poll_timeout != '':
             self.__polling_timeout = poll_timeout
+        elif args.poll_timeout is not None:
+            self.__polling_timeout = args.poll_timeout
         else:
             global polling_timeout
             self.__polling_timeout = polling_timeout
 
+        if poll_long_timeout is not None and poll_long_timeout != '':
+            self.__polling_long_timeout = poll_long_timeout
+        elif args.poll_long_timeout is not None:
+            self.__polling_long_timeout = args.poll_long_timeout
+        else:
+            global polling_long_timeout
+            self.__polling_long_timeout = polling_long_timeout
+
         if args.keep:
             self.__keep = True
 
+        if args.stream:
+            self.__stream = True
+
+        self.__metrics = {'vm': self.__vm_name, 'export_cloud': self.__export_cloud, 'import_cloud': self.__import_cloud, 'phases': []}
+        # Background cleanups update the journal and the metrics too
+        self.__lock = threading.RLock()
+
+        self.__journal_steps = []
+        if self.__vm_name is not None and not args.no_journal:
+            self.__journal_filename = os.path.join(args.journal_dir, '%s.journal.json' %(self.__vm_name))
+            self.__load_journal()
+        if self.__pending_cleanups is None:
+            self.__pending_cleanups = []
+        self.__submitted_cleanups = []
+
+        # Until its export is done, a data volume is the one attached to the VM, imported with its own size
+        if data_volume is not None:
+            if self.__journal_phase in [None, 'export']:
+                if self.__volume_id is None:
+                    self.__volume_id = data_volume['id']
+                if self.__vm_size is None:
+                    self.__vm_size = data_volume['size']
+            self.__min_disk = data_volume['size']
+
         if self.__vm_name is not None:
             if self.__export_cloud is not None:
                 if self.__import_cloud is not None:
@@ -191,63 +2187,342 @@ class OSVM:
             elif self.__import_cloud is not None and self.__key_name is not None and self.__flavor_name is not None and self.__subnet_names is not None:
                 self.__action = 'import'
 
-    def __get_file_checksum(self, filename):
+    def __load_journal(self):
+        if not os.path.isfile(self.__journal_filename):
+            return
+
+        with open(self.__journal_filename, 'r') as f:
+            journal = json.load(f)
+
+        # A journal of another action or other clouds, e.g. of an export only run before an import: its phase and resources are not ours
+        action = None
+        if self.__export_cloud is not None:
+            action = 'transfer' if self.__import_cloud is not None else 'export'
+        elif self.__import_cloud is not None:
+            action = 'import'
+        if journal.get('action') != action or journal.get('export_cloud') != self.__export_cloud or journal.get('import_cloud') != self.__import_cloud:
+            # Its cleanups name their cloud, they are still done by this run
+            self.__pending_cleanups = journal['state'].get('pending_cleanups')
+            if verbose_level >= 1:
+                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                print('%s: Ignoring journal %s of a previous %s of VM %s (export cloud %s, import cloud %s)' %(dt, self.__journal_filename, journal.get('action'), self.__vm_name, journal.get('export_cloud'), journal.get('import_cloud')))
+            return
+
+        self.__journal_phase = journal['phase']
+        self.__journal_steps = journal['steps']
+
+        # Values given on the command line win over the journal
+        for attr in self.__journal_attrs:
+            value = journal['state'].get(attr)
+            if value is not None and value is not False and getattr(self, '_OSVM__%s' %(attr)) in [None, False]:
+                setattr(self, '_OSVM__%s' %(attr), value)
+
+        if self.__image_file is not None and not os.path.isfile(self.__image_file):
+            self.__image_file = None
+            self.__image_file_checksum = None
+            self.__image_file_hashes = None
+            self.__export_checksum_ok = False
+
+        if verbose_level >= 1:
+            dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+            print('%s: Resuming VM %s from journal %s (phase %s, done: %s)' %(dt, self.__vm_name, self.__journal_filename, self.__journal_phase, ', '.join(self.__journal_steps)))
+
+    def __checkpoint(self, step, phase=None):
+        if self.__journal_filename is None:
+            return
+
+        with self.__lock:
+            if phase is not None:
+                self.__journal_phase = phase
+            if step is not None and step not in self.__journal_steps:
+                self.__journal_steps.append(step)
+
+            journal = {'vm': self.__vm_name, 'action': self.__action, 'export_cloud': self.__export_cloud, 'import_cloud': self.__import_cloud, 'phase': self.__journal_phase, 'steps': self.__journal_steps, 'state': {}}
+            for attr in self.__journal_attrs:
+                journal['state'][attr] = getattr(self, '_OSVM__%s' %(attr))
+
+            # Write then rename, a crash while writing must not corrupt the previous journal
+            tmp_filename = '%s.tmp' %(self.__journal_filename)
+            with open(tmp_filename, 'w') as f:
+                json.dump(journal, f, indent=4)
+            os.replace(tmp_filename, self.__journal_filename)
+
+    def __record_phase(self, phase, cloud, start, end, success, size=None):
+        duration = end - start
+        throughput = None
+        if size is not None and duration > 0:
+            throughput = size / duration
+        self.__metrics['phases'].append({'phase': phase, 'cloud': cloud, 'start': start, 'duration': duration, 'bytes': size, 'throughput': throughput, 'success': bool(success)})
+
+        if verbose_level >= 2:
+            dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+            if throughput is not None:
+                print('    %s: Phase %s took %.1fs (%s bytes, %.1f MiB/s)' %(dt, phase, duration, size, throughput / 1024 / 1024))
+            else:
+                print('    %s: Phase %s took %.1fs' %(dt, phase, duration))
+
+    def __timed(self, phase, cloud, func, *func_args):
+        result = False
+
+        self.__phase_bytes = None
+        start = time.time()
+        try:
+            result = yield from func(*func_args)
+        finally:
+            self.__record_phase(phase, cloud, start, time.time(), result, self.__phase_bytes)
+
+        return result
+
+    def __write_metrics(self, success, start, end):
+        with self.__lock:
+            # Written again with their phase by the cleanups that end later
+            self.__metrics_run = (success, start, end)
+            self.__metrics['action'] = self.__action
+            self.__metrics['success'] = bool(success)
+            self.__metrics['start'] = start
+            self.__metrics['duration'] = end - start
+            self.__metrics['bytes'] = sum([phase['bytes'] for phase in self.__metrics['phases'] if phase['bytes'] is not None])
+
+            if args.metrics_dir is not None:
+                filename = os.path.join(args.metrics_dir, '%s.metrics.json' %(self.__vm_name))
+                with open('%s.tmp' %(filename), 'w') as f:
+                    json.dump(self.__metrics, f, indent=4)
+                os.replace('%s.tmp' %(filename), filename)
+
+            if args.prometheus_textfile is not None:
+                write_prometheus_textfile(args.prometheus_textfile, self.__metrics)
+
+    def __get_file_hashes(self, filename, algos=[]):
         result = None
+        start = time.time()
 
         if verbose_level >= 2:
             dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-            print('    %s: Calculating %s checksum...' %(dt, filename))
-        res = hashlib.md5(open(filename, 'rb').read()).hexdigest()
-        if res != '':
+            print('    %s: Calculating %s checksums...' %(dt, filename))
+        hashes = MultiHash(algos)
+        for chunk in read_image_file(filename):
+            hashes.update(chunk)
+        res = hashes.hexdigests()
+        if res['md5'] != '':
             result = res
             if verbose_level >= 3:
                 dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-                print('    %s: %s checksum: %s' %(dt, filename, result))
+                print('    %s: %s checksum: %s' %(dt, filename, result['md5']))
             elif verbose_level >= 2:
                 print('')
+        self.__record_phase('checksum', None, start, time.time(), result is not None, image_file_size(filename))
 
         return result
 
     def __get_os_cmd_result(self, cloud, cmd, params):
+        return (yield ('call', cloud, cmd, params))
+
+    def __get_image_resume(self, cloud, image_id, offset):
         result = None
 
-        no_format_cmds = ['server stop', 'volume delete', 'volume snapshot delete', 'image save', 'image delete', 'floating ip set']
+        try:
+            url, headers = os_backend.get_image_download(cloud, image_id)
+            response = http_open(url, headers, offset)
+            if response.status == 206:
+                result = http_chunks(response)
+            else:
+                response.close()
+        except Exception as e:
+            if verbose_level >= 2:
+                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                print('    %s: Cannot resume image ID %s at byte %s: %s' %(dt, image_id, offset, str(e).strip()))
+        if result is None and verbose_level >= 1:
+            dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+            print('    %s: Image ID %s cannot be resumed from a ranged download, saving it again from the start' %(dt, image_id))
 
-        tmp_params = []
-        if cmd not in no_format_cmds:
-            tmp_params.append('-f json')
-        tmp_params += params
-        params = tmp_params
+        return result
 
-        if verbose_level >= 4:
-            print('        openstack --os-cloud %s %s %s' %(cloud, cmd, ' '.join(params)))
-        proc = subprocess.run(['openstack --os-cloud %s %s %s' %(cloud, cmd, ' '.join(params))], shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    def __get_os_cmd_stream(self, cloud, cmd, params, filename, algos=[], progress=None):
+        result = None
 
-        if proc.stderr != '':
-            raise Exception(proc.stderr)
+        # A save interrupted by a crash or by a previous run goes on after the bytes of the file, hashed again, see the .save file
+        state_filename = '%s.save' %(filename)
+        if progress is not None and progress['offset'] == 0 and not args.delta and os.path.isfile(state_filename) and os.path.isfile(filename):
+            with open(state_filename, 'r') as f:
+                previous = json.load(f)
+            if previous['image_id'] == params[0]:
+                progress['hashes'] = MultiHash(algos)
+                for chunk in read_sparse(filename):
+                    progress['hashes'].update(chunk)
+                    progress['offset'] += len(chunk)
+
+        # A try that broke off is resumed after the bytes it wrote, with the hashes of these bytes (not with --delta, whose blocks are written from the start)
+        offset = 0
+        chunks = None
+        if progress is not None and progress['offset'] > 0 and not args.delta:
+            chunks = self.__get_image_resume(cloud, params[0], progress['offset'])
+            if chunks is not None:
+                offset = progress['offset']
+                hashes = progress['hashes']
+                if verbose_level >= 1:
+                    dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                    print('    %s: Resuming the save of %s at byte %s...' %(dt, filename, offset))
+        if chunks is None:
+            chunks = os_backend.get_stream(cloud, cmd, params)
+            hashes = MultiHash(algos)
+            if progress is not None:
+                progress['offset'] = 0
+                progress['hashes'] = hashes
+                if not args.delta:
+                    with open('%s.tmp' %(state_filename), 'w') as f:
+                        json.dump({'image_id': params[0]}, f)
+                    os.replace('%s.tmp' %(state_filename), state_filename)
+
+        writer = None
+        blocks = None
+        if args.delta:
+            blocks = load_block_manifest(filename)
+        with open(filename, 'wb' if blocks is None and offset == 0 else 'r+b') as f:
+            if args.delta:
+                writer = BlockWriter(f, blocks)
+            f.seek(offset)
+            for chunk in chunks:
+                if writer is not None:
+                    writer.write(chunk)
+                elif args.no_sparse:
+                    f.write(chunk)
+                else:
+                    write_sparse(f, chunk)
+                # Only the bytes written are hashed, the next try goes on from there
+                hashes.update(chunk)
+                if progress is not None:
+                    progress['offset'] += len(chunk)
+            if writer is not None:
+                writer.close()
+            else:
+                # Materializes a trailing hole
+                f.truncate(f.tell())
+        if writer is not None:
+            save_block_manifest(filename, writer.get_digests())
+            if blocks is not None:
+                print_delta(filename, writer.get_written(), os.path.getsize(filename))
+        if os.path.isfile(state_filename):
+            os.remove(state_filename)
+        result = hashes.hexdigests()
+
+        return result
+
+    def __get_os_cmd_chunks(self, cloud, cmd, params, filename, algos=[]):
+        result = None
+
+        hashes = MultiHash(algos)
+        def chunks():
+            for chunk in os_backend.get_stream(cloud, cmd, params):
+                hashes.update(chunk)
+                yield chunk
+        on_written = None
+        if staging_space is not None:
+            on_written = lambda chunk_written: staging_space.add_written(filename, chunk_written)
+        size, written = chunk_store.save(filename, chunks(), on_written)
+        result = hashes.hexdigests()
+        if verbose_level >= 1:
+            dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+            print('    %s: %.1f MiB of %.1f MiB of %s were not in the chunk store yet' %(dt, written / 1024 / 1024, size / 1024 / 1024, filename))
+
+        return result
+
+    def __get_image_ranges(self, cloud, image_id, filename, algos=[]):
+        result = None
 
+        connections = default_download_connections
+        if args.download_connections is not None and args.download_connections > 0:
+            connections = args.download_connections
+        if connections <= 1:
+            return result
+
+        url = None
         try:
-            if cmd not in no_format_cmds:
-                result = json.loads(proc.stdout)
+            url, headers = os_backend.get_image_download(cloud, image_id)
         except Exception as e:
-            raise Exception(e)
+            if verbose_level >= 1:
+                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                print('    %s: No Glance endpoint for a ranged download, falling back to one stream: %s' %(dt, str(e).strip()))
+        if url is not None:
+            hashes = MultiHash(algos)
+            if download_ranges(url, headers, filename, connections, hashes) is not None:
+                result = hashes.hexdigests()
+            elif verbose_level >= 1:
+                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                print('    %s: Glance does not support ranges, falling back to one stream' %(dt))
+
+        return result
+
+    def __get_os_cmd_pipe(self, src_cloud, src_cmd, src_params, dst_cloud, dst_cmd, dst_params, algos=[]):
+        result = None
+
+        hashes = MultiHash(algos)
+        size = [0]
+        def chunks():
+            for chunk in os_backend.get_stream(src_cloud, src_cmd, src_params):
+                hashes.update(chunk)
+                size[0] += len(chunk)
+                yield chunk
+        res = os_backend.put_stream(dst_cloud, dst_cmd, dst_params, chunks())
+        result = (hashes.hexdigests(), res, size[0])
+
+        return result
+
+    def __check_multihash(self, image_id, image, hashes, source):
+        result = True
+
+        hash_algo = image.get('os_hash_algo')
+        hash_value = image.get('os_hash_value')
+        if hash_algo is None or hash_algo == '' or hash_value is None or hash_value == '':
+            # Older Glance releases only provide the MD5 checksum
+            if verbose_level >= 2:
+                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                print('    %s: Warning: image %s has no multihash! Only its checksum is compared with %s.' %(dt, image_id, source))
+        elif hashes is None or hash_algo not in hashes:
+            if verbose_level >= 1:
+                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                print('    %s: Warning: %s %s hash is not available! Cannot compare it with image %s hash!' %(dt, source, hash_algo, image_id))
+        elif hashes[hash_algo] == hash_value:
+            if verbose_level >= 2:
+                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                print('    %s: image %s %s hash verification OK' %(dt, image_id, hash_algo))
+        else:
+            result = False
+            if verbose_level >= 1:
+                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                print('    %s: Image %s %s hash does NOT match %s hash!' %(dt, image_id, hash_algo, source))
 
         return result
 
     def __poll(self, cloud, cmd, params, key, expected_value, timeout, polling_sleep_time=None, nonexistence=False):
         result = False
 
+        # Check quickly first, then back off up to polling_sleep_time, without ever going past the deadline
+        if polling_sleep_time is None:
+            polling_sleep_time = self.__polling_sleep_time
+        sleep_time = min(polling_min_sleep_time, polling_sleep_time)
+        deadline = time.time() + timeout
+
+        use_watcher = status_watcher is not None and status_watcher.supports(cmd) and len(params) == 1
+        generation = None
+
         while result is False:
             tmp_results = None
-            try:
-                tmp_results = self.__get_os_cmd_result(cloud, cmd, params)
-            except Exception as e:
-                e = str(e).strip()
-                if e.startswith('No ') and 'found' in e:
-                    if nonexistence:
-                        result = True
-                        break
+            if use_watcher:
+                # The shared watcher lists all the resources of this type at once, for all the pending waits
+                generation, tmp_results, fresh = yield ('watch', cloud, cmd, params[0], generation, deadline)
+                if fresh and tmp_results is None and nonexistence:
+                    result = True
+                    break
+            else:
+                try:
+                    tmp_results = yield from self.__get_os_cmd_result(cloud, cmd, params)
+                except Exception as e:
+                    if is_not_found(e):
+                        if nonexistence:
+                            result = True
+                            break
 
+            error_status = None
             if tmp_results is not None:
                 if not isinstance(tmp_results, list):
                     tmp_results = [tmp_results]
@@ -257,22 +2532,33 @@ class OSVM:
                         break
                     elif expected_value is None and (tmp_result[key] is None or tmp_result[key] == ''):
                         result = True
-                if nonexistence and result is False:
-                    result = True
-            elif expected_value is None and tmp_results is None:
+                    elif 'status' in tmp_result and str(tmp_result['status']).lower() in polling_error_statuses:
+                        error_status = tmp_result['status']
+            elif expected_value is None and tmp_results is None and not use_watcher:
                 result = True
 
             if not result:
-                if polling_sleep_time is None:
-                    polling_sleep_time = self.__polling_sleep_time
-                time.sleep(polling_sleep_time)
+                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                if error_status is not None:
+                    # No need to wait any longer, OpenStack will not recover from an error status by itself
+                    print('    %s: %s %s returned status %s!' %(dt, cmd, ' '.join(params), error_status))
+                    break
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    print('    %s: Timeout after %ss waiting for %s %s!' %(dt, timeout, cmd, ' '.join(params)))
+                    break
+
+                if not use_watcher:
+                    yield ('sleep', min(sleep_time, remaining))
+                    sleep_time = min(sleep_time * polling_backoff, polling_sleep_time)
 
         return result
 
     def __is_vm_active(self, cloud, vm):
         result = False
 
-        if self.__get_os_cmd_result(cloud, 'server show', [vm])['status'] == 'ACTIVE':
+        if (yield from self.__get_os_cmd_result(cloud, 'server show', [vm]))['status'] == 'ACTIVE':
             result = True
 
         return result
@@ -280,11 +2566,11 @@ class OSVM:
     def __vm_shutdown(self, cloud, vm):
         result = False
 
-        res = self.__get_os_cmd_result(cloud, 'server stop', [vm])
+        res = yield from self.__get_os_cmd_result(cloud, 'server stop', [vm])
         if verbose_level >= 2:
             dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
             print('    %s: Waiting for server %s to stop...' %(dt, vm))
-        res = self.__poll(cloud, 'server show', [vm], 'status', 'SHUTOFF', self.__polling_timeout)
+        res = yield from self.__poll(cloud, 'server show', [vm], 'status', 'SHUTOFF', self.__polling_timeout)
         if res:
             result = True
             if verbose_level >= 2:
@@ -299,7 +2585,7 @@ class OSVM:
         if verbose_level >= 2:
             dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
             print('    %s: Getting information about server %s' %(dt, vm))
-        vm_info = self.__get_os_cmd_result(cloud, 'server show', [vm])
+        vm_info = yield from self.__get_os_cmd_result(cloud, 'server show', [vm])
 
         if self.__key_name is None:
             key_name = None
@@ -384,6 +2670,9 @@ class OSVM:
             volumes = vm_info['volumes_attached']
             if volumes is not None and len(volumes) > 0:
                 vol_id = volumes[0]['id']
+                # The other volumes are transferred along the boot volume and attached again in the same order
+                if self.__data_volumes is None:
+                    self.__data_volumes = [{'id': volume['id'], 'size': None, 'new_id': None} for volume in volumes[1:]]
 
             if vol_id is not None and vol_id != '':
                 self.__volume_id = vol_id
@@ -393,10 +2682,21 @@ class OSVM:
                 if verbose_level >= 2:
                     print('    WARNING: This VM has no attached volume!')
                 if self.__flavor_name is not None and self.__vm_size is None:
-                    result = self.__get_flavor_info(cloud, vm, self.__flavor_name)
+                    result = yield from self.__get_flavor_info(cloud, vm, self.__flavor_name)
 
-        if result and self.__volume_id is not None:
-            result = self.__get_volume_info(cloud, vm, self.__volume_id)
+        if result and self.__volume_id is not None and self.__vm_size is None:
+            result = yield from self.__get_volume_info(cloud, vm, self.__volume_id)
+
+        if result and self.__data_volumes is not None:
+            for data_volume in self.__data_volumes:
+                if data_volume['size'] is None:
+                    volume_row = yield ('blocking', metadata_cache.find, cloud, 'volume', data_volume['id'])
+                    if volume_row is not None:
+                        data_volume['size'] = volume_row['Size']
+                    else:
+                        data_volume['size'] = (yield from self.__get_os_cmd_result(cloud, 'volume show', [data_volume['id']]))['size']
+                    if verbose_level >= 1:
+                        print('    Data volume ID %s, size %s' %(data_volume['id'], data_volume['size']))
 
         return result
 
@@ -406,7 +2706,12 @@ class OSVM:
         if verbose_level >= 2:
             dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
             print('    %s: Getting information about volume ID %s' %(dt, volume_id))
-        volume_info = self.__get_os_cmd_result(cloud, 'volume show', [volume_id])
+        # From the volume list shared by the VMs of the cloud, a volume created since then is shown on its own
+        volume_row = yield ('blocking', metadata_cache.find, cloud, 'volume', volume_id)
+        if volume_row is not None:
+            volume_info = {'size': volume_row['Size']}
+        else:
+            volume_info = yield from self.__get_os_cmd_result(cloud, 'volume show', [volume_id])
         if self.__vm_size is None:
             volume_size = None
             volume_size = volume_info['size']
@@ -425,7 +2730,11 @@ class OSVM:
         if verbose_level >= 2:
             dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
             print('    %s: Getting information about flavor ID %s' %(dt, flavor_id))
-        flavor_info = self.__get_os_cmd_result(cloud, 'flavor show', [flavor_id])
+        flavor_row = yield ('blocking', metadata_cache.find, cloud, 'flavor', flavor_id)
+        if flavor_row is not None:
+            flavor_info = {'disk': flavor_row['Disk']}
+        else:
+            flavor_info = yield from self.__get_os_cmd_result(cloud, 'flavor show', [flavor_id])
         if result and self.__vm_size is None:
             vm_size = None
             vm_size = flavor_info['disk']
@@ -441,17 +2750,25 @@ class OSVM:
     def __create_snapshot(self, cloud, vm, volume_id):
         result = True
 
-        if verbose_level >= 1:
+        snap_id = self.__snap_id
+        if snap_id is None:
+            if verbose_level >= 1:
+                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                print('    %s: Creating volume snapshot %s.bkp from volume ID %s...' %(dt, vm, volume_id))
+            snap_id = (yield from self.__get_os_cmd_result(cloud, 'volume snapshot create', ['--volume %s' %(volume_id), '--force', '%s.bkp' %(vm)]))['id']
+            if snap_id is not None and snap_id != '':
+                # Journaled before the wait, so that a crash meanwhile does not leave it behind
+                self.__snap_id = snap_id
+                self.__checkpoint(None)
+        elif verbose_level >= 1:
             dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-            print('    %s: Creating volume snapshot %s.bkp from volume ID %s...' %(dt, vm, volume_id))
-        snap_id = None
-        snap_id = self.__get_os_cmd_result(cloud, 'volume snapshot create', ['--volume %s' %(volume_id), '--force', '%s.bkp' %(vm)])['id']
+            print('    %s: Checking volume snapshot ID %s of a previous run...' %(dt, snap_id))
         if snap_id is not None and snap_id != '':
             if verbose_level >= 2:
                 dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
                 print('    Volume snapshot ID: %s' %(snap_id))
                 print('    %s: Waiting for volume snapshot ID %s to be available...' %(dt, snap_id))
-            res = self.__poll(cloud, 'volume snapshot show', [snap_id], 'status', 'available', self.__polling_timeout)
+            res = yield from self.__poll(cloud, 'volume snapshot show', [snap_id], 'status', 'available', self.__polling_long_timeout, self.__polling_long_sleep_time)
             if res:
                 if verbose_level >= 2:
                     dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
@@ -461,25 +2778,29 @@ class OSVM:
         else:
             result = False
 
-        if result:
-            self.__snap_id = snap_id
-
         return result
 
     def __create_snapshot_volume(self, cloud, vm, snap_id, volume_size):
         result = True
 
-        if verbose_level >= 1:
+        newvol_id = self.__newvol_id
+        if newvol_id is None:
+            if verbose_level >= 1:
+                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                print('    %s: Creating volume %s.bkp of size %s GiB from volume snapshot ID %s...' %(dt, vm, volume_size, snap_id))
+            newvol_id = (yield from self.__get_os_cmd_result(cloud, 'volume create', ['--snapshot %s' %(snap_id), '--size %s' %(volume_size), '%s.bkp' %(vm)]))['id']
+            if newvol_id is not None and newvol_id != '':
+                self.__newvol_id = newvol_id
+                self.__checkpoint(None)
+        elif verbose_level >= 1:
             dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-            print('    %s: Creating volume %s.bkp of size %s GiB from volume snapshot ID %s...' %(dt, vm, volume_size, snap_id))
-        newvol_id = None
-        newvol_id = self.__get_os_cmd_result(cloud, 'volume create', ['--snapshot %s' %(snap_id), '--size %s' %(volume_size), '%s.bkp' %(vm)])['id']
+            print('    %s: Checking volume ID %s of a previous run...' %(dt, newvol_id))
         if newvol_id is not None and newvol_id != '':
             if verbose_level >= 2:
                 dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
                 print('    Volume ID: %s' %(newvol_id))
                 print('    %s: Waiting for volume ID %s to be available...' %(dt, newvol_id))
-            res = self.__poll(cloud, 'volume show', [newvol_id], 'status', 'available', self.__polling_timeout)
+            res = yield from self.__poll(cloud, 'volume show', [newvol_id], 'status', 'available', self.__polling_long_timeout, self.__polling_long_sleep_time)
             if res:
                 if verbose_level >= 2:
                     dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
@@ -489,16 +2810,24 @@ class OSVM:
         else:
             result = False
 
-        if result:
-            self.__newvol_id = newvol_id
-
         return result
 
+    def __retry_sleep(self, tries):
+        # Exponential backoff between the tries of a step
+        sleep_time = min(retry_max_sleep_time, retry_sleep_time * 2 ** (tries - 1))
+        if verbose_level >= 2:
+            dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+            print('    %s: Waiting %ss before try #%s...' %(dt, sleep_time, tries))
+        yield ('sleep', sleep_time)
+
     def __create_image(self, cloud, vm, newvol_id=None):
         result = True
 
         dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-        if newvol_id is not None:
+        if self.__image_id is not None:
+            if verbose_level >= 1:
+                print('    %s: Checking image ID %s of a previous run...' %(dt, self.__image_id))
+        elif newvol_id is not None:
             if verbose_level >= 1:
                 print('    %s: Creating image %s.bkp from volume ID %s...' %(dt, vm, newvol_id))
         elif self.__volume_id is None and self.__vm_size is not None:
@@ -509,30 +2838,39 @@ class OSVM:
 
         image_id = None
         tries = 0
-        while image_id is None and tries < 2:
+        while image_id is None and tries < max_tries:
+            if tries > 0:
+                yield from self.__retry_sleep(tries)
             result = True
             image_id = None
             try:
                 if verbose_level >= 3:
                     dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
                     print('    - %s: Try #%s...' %(dt, tries))
-                cmd = ''
-                params = []
-                if newvol_id is None:
-                    cmd += 'server '
-                cmd = 'image create'
-                if newvol_id is not None:
-                    params.append('--volume %s' %(newvol_id))
-                    params.append('--unprotected')
-                    params.append('--container-format bare')
-                    params.append('--disk-format %s' %(self.__image_format))
+                if self.__image_id is not None:
+                    image_id = self.__image_id
                 else:
-                    params.append('--name')
-                params.append('%s.bkp' %(vm))
-                if newvol_id is None:
-                    params.append('%s' %(vm))
-
-                image_id = self.__get_os_cmd_result(cloud, cmd, params)['image_id']
+                    cmd = ''
+                    params = []
+                    if newvol_id is None:
+                        cmd += 'server '
+                    cmd = 'image create'
+                    if newvol_id is not None:
+                        params.append('--volume %s' %(newvol_id))
+                        params.append('--unprotected')
+                        params.append('--container-format bare')
+                        params.append('--disk-format %s' %(self.__image_format))
+                    else:
+                        params.append('--name')
+                    params.append('%s.bkp' %(vm))
+                    if newvol_id is None:
+                        params.append('%s' %(vm))
+
+                    image_id = (yield from self.__get_os_cmd_result(cloud, cmd, params))['image_id']
+                    if image_id is not None and image_id != '':
+                        # Journaled before the wait, so that a crash meanwhile does not leave it behind
+                        self.__image_id = image_id
+                        self.__checkpoint(None)
             except Exception as e:
                 print(e)
 
@@ -544,20 +2882,25 @@ class OSVM:
 
                 res = False
                 try:
-                    res = self.__poll(cloud, 'image show', [image_id], 'status', 'active', self.__polling_timeout)
+                    res = yield from self.__poll(cloud, 'image show', [image_id], 'status', 'active', self.__polling_long_timeout, self.__polling_long_sleep_time)
                 except Exception as e:
                     print(e)
 
                 if res:
-                    image_checksum = None
-                    image_checksum = self.__get_os_cmd_result(cloud, 'image show', [image_id])['checksum']
+                    image = yield from self.__get_os_cmd_result(cloud, 'image show', [image_id])
+                    image_checksum = image['checksum']
                     if image_checksum is not None and image_checksum != '':
                         self.__image_checksum = image_checksum
+                    self.__image_hash_algo = image.get('os_hash_algo')
+                    self.__image_hash_value = image.get('os_hash_value')
                     if verbose_level >= 2:
                         dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
                         print('    %s: Image ID %s available (checksum: %s).' %(dt, image_id, self.__image_checksum))
                 else:
                     result = False
+                    # The next try creates another image, this one would be left behind
+                    self.__image_id = None
+                    yield from self.__queue_clean_up('image_retry_cleanup', cloud, image_id)
                     image_id = None
             else:
                 result = False
@@ -570,57 +2913,81 @@ class OSVM:
 
         return result
 
+    def __get_save_filename(self, vm, filename=None):
+        result = filename
+        if result is None:
+            result = os.path.join('.', '%s.bkp.%s' %(vm, self.__image_format))
+        if chunk_store is not None:
+            result = '%s.chunks' %(result)
+        return result
+
     def __save_image(self, cloud, vm, image_id, filename=None):
         result = True
 
-        if filename is None:
-            filename = os.path.join('.', '%s.bkp.%s' %(vm, self.__image_format))
+        filename = self.__get_save_filename(vm, filename)
 
         if verbose_level >= 1:
             dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
             print('    %s: Saving image ID %s as file %s...' %(dt, image_id, filename))
         tries = 0
-        res = False
-        while res is not None:
+        file_checksum = None
+        progress = {'offset': 0, 'hashes': None}
+        while file_checksum is None and tries < max_tries:
+            if tries > 0:
+                yield from self.__retry_sleep(tries)
             try:
                 if verbose_level >= 3:
                     dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
                     print('    - %s: Try #%s...' %(dt, tries))
-                res = False
-                res = self.__get_os_cmd_result(cloud, 'image save', ['--file %s' %(filename), image_id])
+                # The checksum is calculated while the image is downloaded, no need to read the file again afterwards
+                if chunk_store is not None:
+                    file_hashes = yield ('blocking', self.__get_os_cmd_chunks, cloud, 'image save', [image_id], filename, [self.__image_hash_algo])
+                else:
+                    file_hashes = yield ('blocking', self.__get_image_ranges, cloud, image_id, filename, [self.__image_hash_algo])
+                    if file_hashes is None:
+                        file_hashes = yield ('blocking', self.__get_os_cmd_stream, cloud, 'image save', [image_id], filename, [self.__image_hash_algo], progress)
+                file_checksum = file_hashes['md5']
             except Exception as e:
                 print(e)
             tries += 1
 
-        if res is None:
-            if os.path.exists(filename):
-                if verbose_level >= 2:
-                    dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-                    print('    %s: Image ID %s saved successfully and available as file %s.' %(dt, image_id, filename))
-                file_checksum = self.__get_file_checksum(filename)
-                if file_checksum is not None and file_checksum != '':
-                    self.__image_file_checksum = file_checksum
-                    if self.__image_checksum is not None and self.__image_checksum != '':
-                        if self.__image_file_checksum == self.__image_checksum:
-                            self.__export_checksum_ok = True
-                            if verbose_level >= 1:
-                                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-                                print('    %s: file %s checksum verification OK' %(dt, filename))
-                        else:
+        if file_checksum is None:
+            result = False
+            if verbose_level >= 1:
+                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                print('    %s: Image ID %s could not be saved as file %s in %s tries!' %(dt, image_id, filename, tries))
+        elif os.path.exists(filename):
+            self.__phase_bytes = image_file_size(filename)
+            if verbose_level >= 2:
+                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                print('    %s: Image ID %s saved successfully and available as file %s.' %(dt, image_id, filename))
+            if verbose_level >= 3:
+                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                print('    %s: %s checksum: %s' %(dt, filename, file_checksum))
+            if file_checksum is not None and file_checksum != '':
+                self.__image_file_checksum = file_checksum
+                self.__image_file_hashes = file_hashes
+                if self.__image_checksum is not None and self.__image_checksum != '':
+                    if self.__image_file_checksum == self.__image_checksum:
+                        self.__export_checksum_ok = self.__check_multihash(image_id, {'os_hash_algo': self.__image_hash_algo, 'os_hash_value': self.__image_hash_value}, file_hashes, 'file %s' %(filename))
+                        if not self.__export_checksum_ok:
                             result = False
-                            if verbose_level >= 1:
-                                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-                                print('    %s: File %s checksum does NOT match image %s checksum!' %(dt, filename, image_id))
+                        elif verbose_level >= 1:
+                            dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                            print('    %s: file %s checksum verification OK' %(dt, filename))
                     else:
+                        result = False
                         if verbose_level >= 1:
                             dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-                            print('    %s: Warning: image %s checksum is not available! Cannot compare it with file %s checksum!' %(dt, image_id, filename))
+                            print('    %s: File %s checksum does NOT match image %s checksum!' %(dt, filename, image_id))
                 else:
                     if verbose_level >= 1:
                         dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-                        print('    %s: Warning: error while calculating checksum for file %s! Cannot compare it with image %s checksum!' %(dt, filename, image_id))
+                        print('    %s: Warning: image %s checksum is not available! Cannot compare it with file %s checksum!' %(dt, image_id, filename))
             else:
-                result = False
+                if verbose_level >= 1:
+                    dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                    print('    %s: Warning: error while calculating checksum for file %s! Cannot compare it with image %s checksum!' %(dt, filename, image_id))
         else:
             result = False
 
@@ -631,6 +2998,79 @@ class OSVM:
 
         return result
 
+    def __stream_image(self, export_cloud, import_cloud, vm, image_id, image_format, min_ram, min_disk):
+        result = True
+
+        if verbose_level >= 1:
+            dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+            print('    %s: Streaming image ID %s from cloud %s to image %s.rst on cloud %s...' %(dt, image_id, export_cloud, vm, import_cloud))
+
+        stream_checksum = None
+        stream_hashes = None
+        new_image_id = None
+        try:
+            stream_hashes, new_image, self.__phase_bytes = yield ('blocking', self.__get_os_cmd_pipe, export_cloud, 'image save', [image_id], import_cloud, 'image create', ['--container-format bare', '--disk-format %s' %(image_format), '--min-ram %s' %(min_ram), '--min-disk %s' %(min_disk), '%s.rst' %(vm)], [self.__image_hash_algo])
+            stream_checksum = stream_hashes['md5']
+            new_image_id = new_image['id']
+        except Exception as e:
+            print(e)
+            result = False
+
+        if result and new_image_id is not None and new_image_id != '':
+            if verbose_level >= 2:
+                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                print('    Image ID: %s' %(new_image_id))
+                print('    %s: Waiting for image ID %s to be active...' %(dt, new_image_id))
+            res = False
+            try:
+                res = yield from self.__poll(import_cloud, 'image show', [new_image_id], 'status', 'active', self.__polling_long_timeout, self.__polling_long_sleep_time)
+            except Exception as e:
+                print(e)
+
+            if res:
+                self.__image_file_checksum = stream_checksum
+                self.__image_file_hashes = stream_hashes
+                if self.__image_checksum is not None and self.__image_checksum != '':
+                    if stream_checksum == self.__image_checksum:
+                        self.__export_checksum_ok = self.__check_multihash(image_id, {'os_hash_algo': self.__image_hash_algo, 'os_hash_value': self.__image_hash_value}, stream_hashes, 'streamed data')
+                        if not self.__export_checksum_ok:
+                            result = False
+                    else:
+                        result = False
+                        if verbose_level >= 1:
+                            dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                            print('    %s: Streamed data checksum does NOT match image %s checksum!' %(dt, image_id))
+                else:
+                    if verbose_level >= 1:
+                        dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                        print('    %s: Warning: image %s checksum is not available! Cannot compare it with streamed data checksum!' %(dt, image_id))
+
+                new_image = yield from self.__get_os_cmd_result(import_cloud, 'image show', [new_image_id])
+                if result and new_image['checksum'] == stream_checksum:
+                    if not self.__check_multihash(new_image_id, new_image, stream_hashes, 'streamed data'):
+                        result = False
+                    else:
+                        self.__import_checksum_ok = True
+                    if result and verbose_level >= 1:
+                        dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                        print('    %s: image %s checksum verification OK' %(dt, new_image_id))
+                elif result:
+                    result = False
+                    if verbose_level >= 1:
+                        dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                        print('    %s: Image %s checksum does NOT match streamed data checksum!' %(dt, new_image_id))
+            else:
+                result = False
+        else:
+            result = False
+
+        if result:
+            self.__streamed_image_id = new_image_id
+        elif new_image_id is not None and new_image_id != '':
+            yield from self.__queue_clean_up('stream_cleanup', import_cloud, new_image_id)
+
+        return result
+
     def __import_image(self, cloud, vm, image_file, image_format, min_ram, min_disk):
         result = True
 
@@ -639,14 +3079,29 @@ class OSVM:
             print('    %s: Creating image %s.rst from image file %s...' %(dt, vm, image_file))
         image_id = None
         tries = 0
-        while image_id is None and tries < 2:
+        while image_id is None and tries < max_tries:
+            if tries > 0:
+                yield from self.__retry_sleep(tries)
             result = True
             image_id = None
             try:
                 if verbose_level >= 3:
                     dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
                     print('    - %s: Try #%s...' %(dt, tries))
-                image_id = self.__get_os_cmd_result(cloud, 'image create', ['--file %s' %(image_file), '--container-format bare', '--disk-format %s' %(image_format), '--min-ram %s' %(min_ram), '--min-disk %s' %(min_disk), '%s.rst' %(vm)])['id']
+                self.__phase_bytes = image_file_size(image_file)
+                if self.__image_id is not None:
+                    # Uploaded by a previous run, only waited for and checked
+                    image_id = self.__image_id
+                else:
+                    params = ['--container-format bare', '--disk-format %s' %(image_format), '--min-ram %s' %(min_ram), '--min-disk %s' %(min_disk), '%s.rst' %(vm)]
+                    if is_chunk_recipe(image_file) or (not args.no_sparse and is_sparse(image_file)):
+                        # Uploaded from the chunk store, or from the holes of the file as zeros without reading them
+                        image_id = (yield ('blocking', os_backend.put_stream, cloud, 'image create', params, read_image_file(image_file)))['id']
+                    else:
+                        image_id = (yield from self.__get_os_cmd_result(cloud, 'image create', ['--file %s' %(image_file)] + params))['id']
+                    if image_id is not None and image_id != '':
+                        self.__image_id = image_id
+                        self.__checkpoint(None)
             except Exception as e:
                 print(e)
 
@@ -658,13 +3113,13 @@ class OSVM:
 
                 res = False
                 try:
-                    res = self.__poll(cloud, 'image show', [image_id], 'status', 'active', self.__polling_timeout)
+                    res = yield from self.__poll(cloud, 'image show', [image_id], 'status', 'active', self.__polling_long_timeout, self.__polling_long_sleep_time)
                 except Exception as e:
                     print(e)
 
                 if res:
-                    image_checksum = None
-                    image_checksum = self.__get_os_cmd_result(cloud, 'image show', [image_id])['checksum']
+                    image = yield from self.__get_os_cmd_result(cloud, 'image show', [image_id])
+                    image_checksum = image['checksum']
                     if image_checksum is not None and image_checksum != '':
                         if self.__image_checksum is None:
                             self.__image_checksum = image_checksum
@@ -672,10 +3127,16 @@ class OSVM:
                         if verbose_level >= 3:
                             dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
                             print('    %s: image %s checksum: %s' %(dt, image_id, image_checksum))
-                        if self.__image_file_checksum is None:
-                            self.__image_file_checksum = self.__get_file_checksum(filename)
+                        hash_algo = image.get('os_hash_algo')
+                        if self.__image_file_checksum is None or (hash_algo in hashlib.algorithms_available and (self.__image_file_hashes is None or hash_algo not in self.__image_file_hashes)):
+                            # Only when the file was not hashed with the algorithm of this cloud while it was saved
+                            self.__image_file_hashes = yield ('blocking', self.__get_file_hashes, image_file, [hash_algo, self.__image_hash_algo])
+                            if self.__image_file_hashes is not None:
+                                self.__image_file_checksum = self.__image_file_hashes['md5']
                         if self.__image_file_checksum is not None and self.__image_file_checksum != '':
-                            if image_checksum == self.__image_file_checksum:
+                            if image_checksum == self.__image_file_checksum and not self.__check_multihash(image_id, image, self.__image_file_hashes, 'file %s' %(image_file)):
+                                result = False
+                            elif image_checksum == self.__image_file_checksum:
                                 self.__import_checksum_ok = True
                                 if verbose_level >= 1:
                                     dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
@@ -684,16 +3145,19 @@ class OSVM:
                                 result = False
                                 if verbose_level >= 1:
                                     dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-                                    print('    %s: Image %s checksum does NOT match file %s checksum!' %(dt, image_id, filename))
+                                    print('    %s: Image %s checksum does NOT match file %s checksum!' %(dt, image_id, image_file))
                         else:
                             if verbose_level >= 1:
                                 dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-                                print('    %s: Warning: file %s checksum is not available! Cannot compare it with image %s checksum!' %(dt, filename, image_id))
+                                print('    %s: Warning: file %s checksum is not available! Cannot compare it with image %s checksum!' %(dt, image_file, image_id))
                     if verbose_level >= 2:
                         dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
                         print('    %s: Image ID %s available.' %(dt, image_id))
                 else:
                     result = False
+                    # The next try creates another image, this one would be left behind
+                    self.__image_id = None
+                    yield from self.__queue_clean_up('import_retry_cleanup', cloud, image_id)
                     image_id = None
             else:
                 result = False
@@ -706,31 +3170,44 @@ class OSVM:
 
         return result
 
-    def __create_image_volume(self, cloud, vm, image_id, volume_size):
+    def __create_image_volume(self, cloud, vm, image_id, volume_size, bootable=True):
         result = True
 
-        if verbose_level >= 1:
+        params = ['--image %s' %(image_id), '--size %s' %(volume_size)]
+        if bootable:
+            params.append('--bootable')
+        params.append(vm)
+
+        volume_id = self.__volume_id
+        if volume_id is None:
+            if verbose_level >= 1:
+                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                print('    %s: Creating %svolume %s of size %s GB from image ID %s...' %(dt, 'bootable ' if bootable else '', vm, volume_size, image_id))
+            volume_id = (yield from self.__get_os_cmd_result(cloud, 'volume create', params))['id']
+            if volume_id != '':
+                self.__volume_id = volume_id
+                self.__checkpoint(None)
+        elif verbose_level >= 1:
             dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-            print('    %s: Creating bootable volume %s of size %s GB from image ID %s...' %(dt, vm, volume_size, image_id))
-        volume_id = self.__get_os_cmd_result(cloud, 'volume create', ['--image %s' %(image_id), '--size %s' %(volume_size), '--bootable', vm])['id']
+            print('    %s: Checking volume ID %s of a previous run...' %(dt, volume_id))
         if volume_id != '':
             if verbose_level >= 2:
                 dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
                 print('    Volume ID: %s' %(volume_id))
                 print('    %s: Waiting for volume ID %s to be available...' %(dt, volume_id))
-            res = self.__poll(cloud, 'volume show', [volume_id], 'status', 'available', self.__polling_timeout)
+            res = yield from self.__poll(cloud, 'volume show', [volume_id], 'status', 'available', self.__polling_long_timeout, self.__polling_long_sleep_time)
             if res:
                 if verbose_level >= 2:
                     dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
                     print('    %s: Volume ID %s available.' %(dt, volume_id))
             else:
                 result = False
+                # Created again from the image by the next run
+                self.__volume_id = None
+                yield from self.__queue_clean_up('image_volume_cleanup', cloud, newvol_id=volume_id)
         else:
             result = False
 
-        if result:
-            self.__volume_id = volume_id
-
         return result
 
     def __create_vm(self, cloud, vm, volume_id, key_name, security_groups, flavor_name, subnet_names, ips=None):
@@ -767,13 +3244,13 @@ class OSVM:
         params.append(vm)
 
         vm_id = None
-        vm_id = self.__get_os_cmd_result(cloud, 'server create', params)['id']
+        vm_id = (yield from self.__get_os_cmd_result(cloud, 'server create', params))['id']
         if vm_id is not None and vm_id != '':
             if verbose_level >= 2:
                 dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
                 print('    VM ID: %s' %(vm_id))
                 print('    %s: Waiting for VM ID %s to be available...' %(dt, vm_id))
-            res = self.__poll(cloud, 'server show', [vm_id], 'status', 'ACTIVE', self.__polling_timeout)
+            res = yield from self.__poll(cloud, 'server show', [vm_id], 'status', 'ACTIVE', self.__polling_timeout)
             if res:
                 if verbose_level >= 2:
                     dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
@@ -788,12 +3265,34 @@ class OSVM:
 
         return result
 
+    def __attach_volumes(self, cloud, vm_id, volume_ids):
+        result = True
+
+        # One at a time and in order, so that the volumes get the same devices as on the export cloud
+        for volume_id in volume_ids:
+            if not result:
+                break
+            # Already attached by an interrupted run
+            if (yield from self.__get_os_cmd_result(cloud, 'volume show', [volume_id]))['status'] == 'in-use':
+                continue
+
+            if verbose_level >= 1:
+                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                print('    %s: Attaching volume ID %s to VM %s...' %(dt, volume_id, self.__vm_name))
+            yield from self.__get_os_cmd_result(cloud, 'server add volume', [vm_id, volume_id])
+            result = yield from self.__poll(cloud, 'volume show', [volume_id], 'status', 'in-use', self.__polling_timeout)
+            if result and verbose_level >= 2:
+                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                print('    %s: Volume ID %s attached.' %(dt, volume_id))
+
+        return result
+
     def __assign_floating(self, cloud, vm_id, floating_subnet):
         result = False
 
         self.__subnet_names = None
         self.__ips = None
-        self.__get_vm_info(cloud, vm_id)
+        yield from self.__get_vm_info(cloud, vm_id)
 
         subnet_names = None
         ips = None
@@ -811,22 +3310,30 @@ class OSVM:
                 i += 1
         port_id = None
         if fixed_ip is not None and fixed_ip != '':
-            port_id = self.__get_os_cmd_result(cloud, 'port list', ['--server %s' %(vm_id), '--network %s' %(floating_subnet)])[0]['ID']
+            port_id = (yield from self.__get_os_cmd_result(cloud, 'port list', ['--server %s' %(vm_id), '--network %s' %(floating_subnet)]))[0]['ID']
 
         floating_ip = None
-        floating_ips = self.__get_os_cmd_result(cloud, 'floating ip list', ['--status DOWN'])
-        if len(floating_ips) > 0:
-            floating_ip = floating_ips[0]['Floating IP Address']
-        if floating_ip is None:
-            floating_ip = self.__get_os_cmd_result(cloud, 'floating ip create', [external_network])['floating_ip_address']
-
-        if floating_ip is not None and fixed_ip is not None and port_id is not None:
-            if verbose_level >= 1:
-                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-                print('    %s: Assigning floating IP %s to server %s, on its NIC %s (port ID %s), on subnet %s...' %(dt, floating_ip, self.__vm_name, fixed_ip, port_id, floating_subnet))
-            self.__get_os_cmd_result(cloud, 'floating ip set', ['--fixed-ip-address %s' %(fixed_ip), '--port %s' %(port_id), floating_ip])
+        if fixed_ip is not None and port_id is not None:
+            tries = 0
+            while floating_ip is None:
+                floating_ip = yield ('blocking', floating_ip_pool.acquire, cloud)
+                if verbose_level >= 1:
+                    dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                    print('    %s: Assigning floating IP %s to server %s, on its NIC %s (port ID %s), on subnet %s...' %(dt, floating_ip, self.__vm_name, fixed_ip, port_id, floating_subnet))
+                try:
+                    yield from self.__get_os_cmd_result(cloud, 'floating ip set', ['--fixed-ip-address %s' %(fixed_ip), '--port %s' %(port_id), floating_ip])
+                except Exception as e:
+                    tries += 1
+                    # Taken since the pool listed it, e.g. by another tool: try the next one
+                    if 'already associated' in str(e) and tries < floating_ip_tries:
+                        print(e)
+                        floating_ip = None
+                    else:
+                        floating_ip_pool.release(cloud, floating_ip)
+                        raise
 
-            check = self.__get_os_cmd_result(cloud, 'floating ip list', ['--fixed-ip-address %s' %(fixed_ip)])
+        if floating_ip is not None:
+            check = yield from self.__get_os_cmd_result(cloud, 'floating ip list', ['--fixed-ip-address %s' %(fixed_ip)])
             if check is not None and len(check) > 0:
                 result = True
                 if verbose_level >= 2:
@@ -835,6 +3342,36 @@ class OSVM:
 
         return result
 
+    def __delete(self, cloud, resource, resource_id, wait=True):
+        result = True
+
+        if verbose_level >= 2:
+            dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+            print('    %s: Deleting %s ID %s...' %(dt, resource, resource_id))
+        try:
+            yield from self.__get_os_cmd_result(cloud, '%s delete' %(resource), [resource_id])
+        except Exception as e:
+            # Already deleted, e.g. by an interrupted cleanup
+            if not is_not_found(e):
+                raise
+        if wait:
+            result = yield from self.__wait_deleted(cloud, resource, resource_id)
+
+        return result
+
+    def __wait_deleted(self, cloud, resource, resource_id):
+        result = True
+
+        res = yield from self.__poll(cloud, '%s show' %(resource), [resource_id], 'id', None, self.__polling_timeout, nonexistence=True)
+        if res:
+            if verbose_level >= 2:
+                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                print('    %s: %s ID %s successfully deleted.' %(dt, resource.capitalize(), resource_id))
+        else:
+            result = False
+
+        return result
+
     def __clean_up(self, cloud, image_id=None, newvol_id=None, snap_id=None):
         result = True
 
@@ -842,47 +3379,162 @@ class OSVM:
             dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
             print('%s: Cleaning up...' %(dt))
 
+        # The image does not depend on the volumes: it is deleted while the volume, then the snapshot it comes from, are
         if image_id is not None:
-            if verbose_level >= 2:
-                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-                print('    %s: Deleting image ID %s...' %(dt, image_id))
-            self.__get_os_cmd_result(cloud, 'image delete', [image_id])
-            res = self.__poll(cloud, 'image show', [image_id], 'id', None, self.__polling_timeout, True)
-            if res:
-                if verbose_level >= 2:
-                    dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-                    print('    %s: Image ID %s successfully deleted.' %(dt, image_id))
-            else:
-                result = False
+            yield from self.__delete(cloud, 'image', image_id, False)
 
         if newvol_id is not None:
-            if verbose_level >= 2:
-                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-                print('    %s: Deleting volume ID %s...' %(dt, newvol_id))
-            self.__get_os_cmd_result(cloud, 'volume delete', [newvol_id])
-            res = self.__poll(cloud, 'volume show', [newvol_id], 'id', None, self.__polling_timeout, True)
-            if res:
-                if verbose_level >= 2:
-                    dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-                    print('    %s: Volume ID %s successfully deleted.' %(dt, newvol_id))
-            else:
+            if not (yield from self.__delete(cloud, 'volume', newvol_id)):
                 result = False
 
         if snap_id is not None:
-            if verbose_level >= 2:
-                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-                print('    %s: Deleting volume snapshot ID %s...' %(dt, snap_id))
-            self.__get_os_cmd_result(cloud, 'volume snapshot delete', [snap_id])
-            res = self.__poll(cloud, 'volume snapshot show', [snap_id], 'id', None, self.__polling_timeout, True)
-            if res:
-                if verbose_level >= 2:
-                    dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-                    print('    %s: Volume snapshot ID %s successfully deleted.' %(dt, snap_id))
+            if not (yield from self.__delete(cloud, 'volume snapshot', snap_id)):
+                result = False
+
+        if image_id is not None and not (yield from self.__wait_deleted(cloud, 'image', image_id)):
+            result = False
+
+        return result
+
+    def __run_clean_up(self, cleanup):
+        result = False
+
+        start = time.time()
+        try:
+            result = yield from self.__clean_up(cleanup['cloud'], cleanup['image_id'], cleanup['newvol_id'], cleanup['snap_id'])
+        finally:
+            # Not __timed(): a background cleanup runs along with the phases of the VM
+            self.__record_phase('cleanup', cleanup['cloud'], start, time.time(), result)
+
+        if result:
+            with self.__lock:
+                if cleanup in self.__pending_cleanups:
+                    self.__pending_cleanups.remove(cleanup)
+                self.__checkpoint(cleanup['step'])
+                if self.__metrics_run is not None:
+                    self.__write_metrics(*self.__metrics_run)
+
+        return result
+
+    def __submit_clean_up(self, cleanup):
+        resources = []
+        for key, resource in [('image_id', 'image'), ('newvol_id', 'volume'), ('snap_id', 'volume snapshot')]:
+            if cleanup[key] is not None:
+                resources.append('%s %s' %(resource, cleanup[key]))
+        if verbose_level >= 2:
+            dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+            print('    %s: Cleanup of %s queued.' %(dt, ', '.join(resources)))
+        self.__submitted_cleanups.append(cleanup)
+        cleanup_queue.submit(self.__vm_name, cleanup['cloud'], ', '.join(resources), self.__run_clean_up(cleanup))
+
+    def __queue_clean_up(self, step, cloud, image_id=None, newvol_id=None, snap_id=None):
+        result = True
+
+        cleanup = {'step': step, 'cloud': cloud, 'image_id': image_id, 'newvol_id': newvol_id, 'snap_id': snap_id}
+        if cleanup_queue is None:
+            result = yield from self.__run_clean_up(cleanup)
+        else:
+            # Journaled first, so that a cleanup interrupted by a crash is done again by the next run
+            with self.__lock:
+                self.__pending_cleanups.append(cleanup)
+                self.__checkpoint(None)
+            self.__submit_clean_up(cleanup)
+
+        return result
+
+    def __resume_clean_ups(self):
+        # Once per run, whatever the stages of the run
+        if self.__cleanups_resumed:
+            return
+        self.__cleanups_resumed = True
+
+        for cleanup in list(self.__pending_cleanups):
+            # Already queued by this run
+            if cleanup in self.__submitted_cleanups:
+                continue
+            if cleanup_queue is None:
+                yield from self.__run_clean_up(cleanup)
             else:
+                self.__submit_clean_up(cleanup)
+
+    def __get_data_volume_osvms(self):
+        if self.__data_volume_osvms is None:
+            self.__data_volume_osvms = []
+            import_cloud = None
+            if self.__action == 'transfer':
+                import_cloud = self.__import_cloud
+            i = 0
+            for data_volume in self.__data_volumes:
+                i += 1
+                self.__data_volume_osvms.append(OSVM(self.__export_cloud, import_cloud, '%s-disk%s' %(self.__vm_name, i), poll_sleep_time=self.__polling_sleep_time, poll_timeout=self.__polling_timeout, poll_long_timeout=self.__polling_long_timeout, data_volume=data_volume))
+
+        return self.__data_volume_osvms
+
+    def __start_data_volumes(self, stage):
+        result = []
+
+        # Each data volume goes through its own export and import, next to the boot volume
+        pending = [(osvm, data_volume) for osvm, data_volume in zip(self.__get_data_volume_osvms(), self.__data_volumes) if data_volume['new_id'] is None]
+        # Started right away, none of them waits for the other VMs while the VM is down
+        handles = yield ('start', [getattr(osvm, stage)() for osvm, data_volume in pending])
+        for (osvm, data_volume), handle in zip(pending, handles):
+            result.append((osvm, data_volume, handle))
+
+        return result
+
+    def __wait_data_volumes(self, handles):
+        result = True
+
+        for osvm, data_volume, handle in handles:
+            done = False
+            try:
+                done = yield ('join', handle)
+            except Exception as e:
+                print(e)
+            if not done:
                 result = False
+                if verbose_level >= 1:
+                    dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                    print('    %s: Data volume ID %s of VM %s (%s) failed!' %(dt, data_volume['id'], self.__vm_name, osvm.get_vm_name()))
+
+        return result
+
+    def __reserve_staging(self):
+        result = True
+
+        # The sizes of the volumes bound the sizes of the saved images, whatever their format
+        size = 0
+        if self.__vm_size is not None:
+            size += int(self.__vm_size) * 1024**3
+        files = [self.get_image_filename()]
+        if self.__data_volumes:
+            for osvm, data_volume in zip(self.__get_data_volume_osvms(), self.__data_volumes):
+                if data_volume['new_id'] is None:
+                    size += int(data_volume['size']) * 1024**3
+                    files.append(osvm.get_image_filename())
+        result = yield ('staging', self.__vm_name, size, files)
 
         return result
 
+    def __release_staging(self):
+        if staging_space is not None and not self.__data_volume:
+            staging_space.release(self.__vm_name)
+
+    def __remove_image_file(self):
+        if verbose_level >= 2:
+            dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+            print('    %s: Removing imported file %s...' %(dt, self.__image_file))
+        freed = 0
+        for filename in [self.__image_file, '%s.blocks' %(self.__image_file)]:
+            try:
+                freed += remove_image_file(filename)
+            except FileNotFoundError:
+                pass
+        if verbose_level >= 2:
+            dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+            print('    %s: %.1f MiB freed.' %(dt, freed / 1024 / 1024))
+        self.__image_file = None
+
     def __export(self):
         if verbose_level >= 1:
             dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
@@ -890,32 +3542,76 @@ class OSVM:
 
         go_ahead = True
 
-        if self.__image_file is None and self.__image_id is None and self.__newvol_id is None and self.__snap_id is None and self.__is_vm_active(self.__export_cloud, self.__vm_name):
+        # Waiting for staging space before the VM is stopped keeps it running meanwhile
+        if staging_space is not None and not self.__data_volume and not self.__stream and self.__image_file is None:
+            if self.__needs_vm_info():
+                go_ahead = yield from self.__get_vm_info(self.__export_cloud, self.__vm_name)
+            if go_ahead:
+                self.__checkpoint('vm_info', 'export')
+                go_ahead = yield from self.__timed('staging_wait', None, self.__reserve_staging)
+
+        if go_ahead and self.__image_file is None and self.__image_id is None and self.__newvol_id is None and self.__snap_id is None and not self.__data_volume and (yield from self.__is_vm_active(self.__export_cloud, self.__vm_name)):
             if verbose_level >= 2:
                 dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
                 print('    %s: Server %s is ACTIVE! Stopping it...' %(dt, self.__vm_name))
-            go_ahead = self.__vm_shutdown(self.__export_cloud, self.__vm_name)
+            go_ahead = yield from self.__timed('shutdown', self.__export_cloud, self.__vm_shutdown, self.__export_cloud, self.__vm_name)
+            if go_ahead:
+                self.__checkpoint('shutdown', 'export')
 
         if go_ahead:
-            if self.__action == 'export' and self.__volume_id is None:
-                go_ahead = self.__get_vm_info(self.__export_cloud, self.__vm_name)
-            elif self.__action == 'transfer' and self.__volume_id is None and self.__key_name is None and self.__security_groups is None and self.__subnet_names is None:
-                go_ahead = self.__get_vm_info(self.__export_cloud, self.__vm_name)
-
-        if go_ahead and self.__image_file is None and self.__image_id is None and self.__newvol_id is None and self.__snap_id is None and self.__volume_id is not None:
-            go_ahead = self.__create_snapshot(self.__export_cloud, self.__vm_name, self.__volume_id)
-
-        if go_ahead and self.__image_file is None and self.__image_id is None and self.__newvol_id is None and self.__volume_id is not None:
-            go_ahead = self.__create_snapshot_volume(self.__export_cloud, self.__vm_name, self.__snap_id, self.__vm_size)
-
-        if go_ahead and self.__image_file is None and self.__image_id is None:
-            go_ahead = self.__create_image(self.__export_cloud, self.__vm_name, self.__newvol_id)
+            if self.__needs_vm_info():
+                go_ahead = yield from self.__get_vm_info(self.__export_cloud, self.__vm_name)
+            if go_ahead:
+                self.__checkpoint('vm_info', 'export')
+
+        # The data volumes are snapshotted once the VM is stopped too
+        data_volume_handles = []
+        if go_ahead and self.__data_volumes:
+            data_volume_handles = yield from self.__start_data_volumes('run_export' if self.__action == 'transfer' else 'run')
+
+        # The resources created by a previous run but not checked yet are waited for again
+        if go_ahead and self.__image_file is None and (self.__image_id is None or 'image' not in self.__journal_steps) and (self.__newvol_id is None or 'snapshot_volume' not in self.__journal_steps) and (self.__snap_id is None or 'snapshot' not in self.__journal_steps) and self.__volume_id is not None:
+            go_ahead = yield from self.__timed('snapshot', self.__export_cloud, self.__create_snapshot, self.__export_cloud, self.__vm_name, self.__volume_id)
+            if go_ahead:
+                self.__checkpoint('snapshot')
+
+        if go_ahead and self.__image_file is None and (self.__image_id is None or 'image' not in self.__journal_steps) and (self.__newvol_id is None or 'snapshot_volume' not in self.__journal_steps) and self.__volume_id is not None:
+            go_ahead = yield from self.__timed('snapshot_volume', self.__export_cloud, self.__create_snapshot_volume, self.__export_cloud, self.__vm_name, self.__snap_id, self.__vm_size)
+            if go_ahead:
+                self.__checkpoint('snapshot_volume')
+
+        if go_ahead and self.__image_file is None and (self.__image_id is None or 'image' not in self.__journal_steps):
+            go_ahead = yield from self.__timed('image_create', self.__export_cloud, self.__create_image, self.__export_cloud, self.__vm_name, self.__newvol_id)
+            if go_ahead:
+                self.__checkpoint('image')
+
+        if go_ahead and self.__image_file is None and self.__stream and self.__action == 'transfer':
+            go_ahead = yield from self.__timed('image_stream', self.__export_cloud, self.__stream_image, self.__export_cloud, self.__import_cloud, self.__vm_name, self.__image_id, self.__image_format, self.__min_ram, self.__min_disk)
+            if go_ahead:
+                self.__checkpoint('stream')
+            else:
+                if verbose_level >= 1:
+                    dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                    print('    %s: Streaming failed, falling back to a local image file...' %(dt))
+                go_ahead = True
 
-        if go_ahead and self.__image_file is None:
-            go_ahead = self.__save_image(self.__export_cloud, self.__vm_name, self.__image_id, self.__image_filename)
+        if go_ahead and self.__image_file is None and self.__streamed_image_id is None:
+            go_ahead = yield from self.__timed('image_save', self.__export_cloud, self.__save_image, self.__export_cloud, self.__vm_name, self.__image_id, self.__image_filename)
+            if go_ahead:
+                self.__checkpoint('save')
 
         if not self.__keep and (self.__image_id is not None or self.__newvol_id is not None or self.__snap_id is not None):
-            go_ahead = self.__clean_up(self.__export_cloud, self.__image_id, self.__newvol_id, self.__snap_id)
+            # A failed cleanup fails the export, but a done cleanup does not make a failed export succeed
+            if (yield from self.__queue_clean_up('export_cleanup', self.__export_cloud, self.__image_id, self.__newvol_id, self.__snap_id)):
+                self.__image_id = None
+                self.__newvol_id = None
+                self.__snap_id = None
+                self.__checkpoint(None)
+            else:
+                go_ahead = False
+
+        if not (yield from self.__wait_data_volumes(data_volume_handles)):
+            go_ahead = False
 
         return go_ahead
 
@@ -926,61 +3622,623 @@ class OSVM:
 
         go_ahead = True
 
-        if self.__image_file is not None and self.__image_format is not None and self.__min_ram is not None and self.__min_disk is not None and self.__vm_name is not None and self.__image_id is None:
-            go_ahead = self.__import_image(self.__import_cloud, self.__vm_name, self.__image_file, self.__image_format, self.__min_ram, self.__min_disk)
+        # Nothing left to import from, e.g. a file and an image both deleted by a previous run
+        if self.__image_file is None and self.__image_id is None and self.__volume_id is None and self.__vm_id is None:
+            if verbose_level >= 1:
+                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                print('    %s: No image file, image, volume or VM to import VM %s from!' %(dt, self.__vm_name))
+            return False
+
+        data_volume_handles = []
+        if self.__action == 'transfer' and self.__data_volumes:
+            data_volume_handles = yield from self.__start_data_volumes('run_import')
+
+        # An image created by a previous run but not checked yet is waited for and checked again
+        if self.__image_file is not None and self.__image_format is not None and self.__min_ram is not None and self.__min_disk is not None and self.__vm_name is not None and (self.__image_id is None or 'import_image' not in self.__journal_steps):
+            go_ahead = yield from self.__timed('import', self.__import_cloud, self.__import_image, self.__import_cloud, self.__vm_name, self.__image_file, self.__image_format, self.__min_ram, self.__min_disk)
+            if go_ahead:
+                self.__checkpoint('import_image', 'import')
             if go_ahead and self.__action == 'transfer':
                 if self.__export_checksum_ok and self.__import_checksum_ok:
                     if verbose_level >= 1:
                         dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
                         print('    %s: VM %s image transfer done successfully.' %(dt, self.__vm_name))
 
-        if go_ahead and self.__vm_name is not None and self.__min_disk is not None and self.__image_id is not None and self.__volume_id is None:
-            go_ahead = self.__create_image_volume(self.__import_cloud, self.__vm_name, self.__image_id, self.__min_disk)
+        if go_ahead and self.__vm_name is not None and self.__min_disk is not None and self.__image_id is not None and (self.__volume_id is None or 'image_volume' not in self.__journal_steps):
+            go_ahead = yield from self.__timed('boot_volume', self.__import_cloud, self.__create_image_volume, self.__import_cloud, self.__vm_name, self.__image_id, self.__min_disk, not self.__data_volume)
+            if go_ahead:
+                self.__checkpoint('image_volume', 'import')
 
-        if go_ahead and self.__vm_name is not None and self.__volume_id is not None and self.__key_name is not None and self.__security_groups is not None and self.__flavor_name is not None and self.__subnet_names is not None:
-            go_ahead = self.__create_vm(self.__import_cloud, self.__vm_name, self.__volume_id, self.__key_name, self.__security_groups, self.__flavor_name, self.__subnet_names, self.__ips)
+        if go_ahead and self.__vm_name is not None and self.__vm_id is None and self.__volume_id is not None and self.__key_name is not None and self.__security_groups is not None and self.__flavor_name is not None and self.__subnet_names is not None:
+            go_ahead = yield from self.__timed('server_create', self.__import_cloud, self.__create_vm, self.__import_cloud, self.__vm_name, self.__volume_id, self.__key_name, self.__security_groups, self.__flavor_name, self.__subnet_names, self.__ips)
+            if go_ahead:
+                self.__checkpoint('server', 'import')
 
-        if go_ahead and self.__vm_id is not None:
+        if go_ahead and self.__vm_id is not None and not self.__floating_done:
             if self.__has_floating and self.__floating_subnet is not None:
-                go_ahead = self.__assign_floating(self.__import_cloud, self.__vm_id, self.__floating_subnet)
+                go_ahead = yield from self.__timed('floating_ip', self.__import_cloud, self.__assign_floating, self.__import_cloud, self.__vm_id, self.__floating_subnet)
+                if go_ahead:
+                    self.__floating_done = True
+                    self.__checkpoint('floating', 'import')
+
+        if go_ahead and self.__action == 'transfer' and self.__vm_id is not None and self.__data_volumes and not self.__data_volumes_attached:
+            go_ahead = yield from self.__wait_data_volumes(data_volume_handles)
+            data_volume_handles = []
+            if go_ahead:
+                for osvm, data_volume in zip(self.__get_data_volume_osvms(), self.__data_volumes):
+                    if data_volume['new_id'] is None:
+                        data_volume['new_id'] = osvm.get_volume_id()
+                self.__checkpoint(None)
+                go_ahead = yield from self.__timed('volume_attach', self.__import_cloud, self.__attach_volumes, self.__import_cloud, self.__vm_id, [data_volume['new_id'] for data_volume in self.__data_volumes])
+                if go_ahead:
+                    self.__data_volumes_attached = True
+                    self.__checkpoint('attach', 'import')
 
         if not self.__keep and self.__image_id is not None:
-            go_ahead = self.__clean_up(self.__import_cloud, self.__image_id)
+            if (yield from self.__queue_clean_up('import_cleanup', self.__import_cloud, self.__image_id)):
+                self.__image_id = None
+                self.__checkpoint(None, 'import')
+            else:
+                go_ahead = False
+
+        if not (yield from self.__wait_data_volumes(data_volume_handles)):
+            go_ahead = False
 
         return go_ahead
 
+    def __needs_vm_info(self):
+        result = False
+
+        if self.__action == 'export' and self.__volume_id is None:
+            result = True
+        elif self.__action == 'transfer' and self.__volume_id is None and self.__key_name is None and self.__security_groups is None and self.__subnet_names is None:
+            result = True
+
+        return result
+
+    def preflight(self):
+        # Returns the problems that would make the VM fail, before anything is changed on either cloud
+        result = []
+
+        if self.__action is None:
+            result.append('No action can be done!')
+            return result
+        if self.__journal_phase == 'done':
+            return result
+
+        if self.__action in ['export', 'transfer'] and self.__journal_phase in [None, 'export'] and self.__needs_vm_info():
+            try:
+                if not (yield from self.__get_vm_info(self.__export_cloud, self.__vm_name)):
+                    result.append('Incomplete information about server %s on cloud %s' %(self.__vm_name, self.__export_cloud))
+            except Exception as e:
+                result.append(str(e).strip())
+
+        if len(result) == 0 and self.__action in ['import', 'transfer'] and self.__vm_id is None:
+            result += yield ('blocking', self.__get_import_problems, self.__import_cloud)
+
+        return result
+
+    def __get_import_problems(self, cloud):
+        # From the lists shared by the VMs of the batch
+        result = []
+
+        if self.__flavor_name is not None and metadata_cache.find(cloud, 'flavor', self.__flavor_name) is None:
+            result.append('Flavor %s not found on cloud %s' %(self.__flavor_name, cloud))
+        if self.__subnet_names is not None and self.__subnet_names != '':
+            for subnet_name in self.__subnet_names.split(','):
+                if metadata_cache.find(cloud, 'network', subnet_name) is None:
+                    result.append('Network %s not found on cloud %s' %(subnet_name, cloud))
+        if self.__security_groups is not None and self.__security_groups != '':
+            for security_group in self.__security_groups.split(','):
+                if metadata_cache.find(cloud, 'security group', security_group) is None:
+                    result.append('Security group %s not found on cloud %s' %(security_group, cloud))
+        if self.__key_name is not None and metadata_cache.find(cloud, 'keypair', self.__key_name) is None:
+            result.append('Key pair %s not found on cloud %s' %(self.__key_name, cloud))
+        if len(result) == 0:
+            for subnet_name, ip in self.get_fixed_ips():
+                for port in metadata_cache.get(cloud, 'port', ['--network %s' %(subnet_name)]):
+                    if ip in [fixed_ip['ip_address'] for fixed_ip in port['Fixed IP Addresses']]:
+                        result.append('IP %s already in use on network %s of cloud %s (port ID %s)' %(ip, subnet_name, cloud, port['ID']))
+
+        return result
+
+    def needs_floating_ip(self):
+        return self.__action in ['import', 'transfer'] and self.__has_floating and self.__floating_subnet is not None and not self.__floating_done
+
+    def get_fixed_ips(self):
+        result = []
+
+        # Same rule as __create_vm(): fixed IPs only with one IP per network
+        if self.__subnet_names is not None and self.__subnet_names != '' and self.__ips is not None and self.__ips != '':
+            subnet_names = self.__subnet_names.split(',')
+            ips = self.__ips.split(',')
+            if len(ips) == len(subnet_names):
+                result = list(zip(subnet_names, ips))
+
+        return result
+
+    def get_vm_name(self):
+        return self.__vm_name
+
+    def get_image_filename(self):
+        return self.__get_save_filename(self.__vm_name, self.__image_filename)
+
+    def get_volume_id(self):
+        return self.__volume_id
+
+    def get_action(self):
+        return self.__action
+
     def run(self):
         result = False
 
+        # Nothing is measured for a VM that the journal already marks as done
+        already_done = self.__journal_phase == 'done'
+        start = time.time()
+        try:
+            result = yield from self.__run()
+        finally:
+            self.__release_staging()
+            if self.__action is not None and not already_done:
+                self.__write_metrics(result, start, time.time())
+
+        return result
+
+    def run_export(self):
+        # First stage of a pipelined transfer, run_import() does the rest
+        result = False
+
+        self.__run_start = time.time()
+        yield from self.__resume_clean_ups()
+        if self.__journal_phase == 'done':
+            return True
+
+        try:
+            result = yield from self.__transfer_export()
+        finally:
+            if not result:
+                self.__release_staging()
+                self.__write_metrics(result, self.__run_start, time.time())
+
+        return result
+
+    def run_import(self):
+        result = False
+
+        if self.__journal_phase == 'done':
+            return (yield from self.__run())
+        # Export done by a previous run
+        if self.__run_start is None:
+            self.__run_start = time.time()
+
+        try:
+            result = yield from self.__import()
+            if result:
+                self.__done()
+        finally:
+            self.__release_staging()
+            self.__write_metrics(result, self.__run_start, time.time())
+
+        return result
+
+    def __transfer_export(self):
+        result = False
+
+        if self.__journal_phase == 'import':
+            # Export already done by a previous run
+            result = True
+        else:
+            result = yield from self.__export()
+
+            self.__volume_id = None
+            self.__snap_id = None
+            self.__newvol_id = None
+            self.__image_id = None
+
+            if result:
+                if self.__streamed_image_id is not None:
+                    self.__image_id = self.__streamed_image_id
+                self.__checkpoint('export', 'import')
+
+        return result
+
+    def __done(self):
+        self.__checkpoint(None, 'done')
+        # Only once the VM exists, the file is the last copy of the data until then
+        if self.__action == 'transfer' and args.remove_image_files and self.__image_file is not None:
+            self.__remove_image_file()
+            self.__checkpoint(None)
+        if verbose_level >= 1:
+            dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+            print('%s: %s of VM %s done successfully.' %(dt, self.__action.capitalize(), self.__vm_name))
+
+    def __run(self):
+        result = False
+
         if self.__action is not None:
+            yield from self.__resume_clean_ups()
+            if self.__journal_phase == 'done':
+                if verbose_level >= 1:
+                    dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+                    print('%s: VM %s already done according to journal %s, nothing to do.' %(dt, self.__vm_name, self.__journal_filename))
+                return True
+
             if self.__action == 'export':
-                result = self.__export()
+                result = yield from self.__export()
             elif self.__action == 'import':
-                result = self.__import()
+                result = yield from self.__import()
             elif self.__action == 'transfer':
-                result = self.__export()
-
-                self.__volume_id = None
-                self.__snap_id = None
-                self.__newvol_id = None
-                self.__image_id = None
-
+                result = yield from self.__transfer_export()
                 if result:
-                    result = self.__import()
+                    result = yield from self.__import()
         else:
-            sys.exit('No action can be done!')
+            raise Exception('No action can be done!')
 
         if result:
-            if verbose_level >= 1:
-                dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-                print('%s: %s done successfully.' %(dt, self.__action.capitalize()))
-        else:
+            self.__done()
+
+        return result
+
+prometheus_metrics = {}
+prometheus_lock = threading.Lock()
+
+def write_prometheus_textfile(filename, metrics):
+    def labels(**kwargs):
+        return ','.join(['%s="%s"' %(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in kwargs.items() if v is not None])
+
+    def phase_totals(m):
+        # A phase can run more than once (retries, one cleanup per resource), the collector rejects a file with the same series twice
+        result = {}
+        for phase in m['phases']:
+            key = (phase['phase'], phase['cloud'])
+            if key not in result:
+                result[key] = {'duration': 0, 'bytes': None}
+            result[key]['duration'] += phase['duration']
+            if phase['bytes'] is not None:
+                result[key]['bytes'] = (result[key]['bytes'] or 0) + phase['bytes']
+        return result
+
+    with prometheus_lock:
+        prometheus_metrics[metrics['vm']] = metrics
+
+        lines = []
+        lines.append('# HELP os_vm_transfer_success Whether the last run for the VM succeeded')
+        lines.append('# TYPE os_vm_transfer_success gauge')
+        for m in prometheus_metrics.values():
+            lines.append('os_vm_transfer_success{%s} %s' %(labels(vm=m['vm'], action=m['action']), 1 if m['success'] else 0))
+        lines.append('# HELP os_vm_transfer_duration_seconds Duration of the last run for the VM')
+        lines.append('# TYPE os_vm_transfer_duration_seconds gauge')
+        for m in prometheus_metrics.values():
+            lines.append('os_vm_transfer_duration_seconds{%s} %.3f' %(labels(vm=m['vm'], action=m['action']), m['duration']))
+        lines.append('# HELP os_vm_transfer_bytes Bytes moved during the last run for the VM')
+        lines.append('# TYPE os_vm_transfer_bytes gauge')
+        for m in prometheus_metrics.values():
+            lines.append('os_vm_transfer_bytes{%s} %s' %(labels(vm=m['vm'], action=m['action']), m['bytes']))
+        lines.append('# HELP os_vm_transfer_phase_duration_seconds Duration of each phase of the last run for the VM')
+        lines.append('# TYPE os_vm_transfer_phase_duration_seconds gauge')
+        for m in prometheus_metrics.values():
+            for (phase, cloud), totals in phase_totals(m).items():
+                lines.append('os_vm_transfer_phase_duration_seconds{%s} %.3f' %(labels(vm=m['vm'], phase=phase, cloud=cloud), totals['duration']))
+        lines.append('# HELP os_vm_transfer_phase_bytes Bytes moved by each phase of the last run for the VM')
+        lines.append('# TYPE os_vm_transfer_phase_bytes gauge')
+        for m in prometheus_metrics.values():
+            for (phase, cloud), totals in phase_totals(m).items():
+                if totals['bytes'] is not None:
+                    lines.append('os_vm_transfer_phase_bytes{%s} %s' %(labels(vm=m['vm'], phase=phase, cloud=cloud), totals['bytes']))
+
+        # The textfile collector may read at any time, only show it complete files
+        with open('%s.tmp' %(filename), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace('%s.tmp' %(filename), filename)
+
+def get_batch_vm_names():
+    result = []
+
+    if args.vms is not None:
+        for vm_name in args.vms.split(','):
+            vm_name = vm_name.strip()
+            if vm_name != '':
+                result.append(vm_name)
+
+    if args.vms_file is not None:
+        with open(args.vms_file, 'r') as f:
+            for line in f:
+                vm_name = line.split('#')[0].strip()
+                if vm_name != '':
+                    result.append(vm_name)
+
+    # Keep the first occurrence only, transferring the same VM twice at the same time would be a disaster
+    unique_names = []
+    for vm_name in result:
+        if vm_name not in unique_names:
+            unique_names.append(vm_name)
+
+    return unique_names
+
+def run_preflight(vm_names, workers, osvms):
+    result = True
+
+    if verbose_level >= 1:
+        dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+        print('%s: Checking %s VMs before starting...' %(dt, len(vm_names)))
+
+    # The VMs checked are the ones run afterwards, with the information already gathered
+    problems = {}
+    def check(vm_name):
+        try:
+            if vm_name not in osvms:
+                osvms[vm_name] = OSVM(vm_name=vm_name)
+            problems[vm_name] = yield from osvms[vm_name].preflight()
+        except Exception as e:
+            problems[vm_name] = [str(e).strip()]
+
+    run_all_steps([check(vm_name) for vm_name in vm_names], workers)
+
+    # Two VMs of the batch asking for the same fixed IP would make the second one fail at the very end
+    ip_vms = {}
+    for vm_name in vm_names:
+        if vm_name in osvms:
+            for subnet_name, ip in osvms[vm_name].get_fixed_ips():
+                ip_vms.setdefault((subnet_name, ip), []).append(vm_name)
+    for (subnet_name, ip), ip_vm_names in ip_vms.items():
+        if len(ip_vm_names) > 1:
+            for vm_name in ip_vm_names:
+                problems[vm_name].append('IP %s on network %s also requested by VM %s' %(ip, subnet_name, ', '.join([n for n in ip_vm_names if n != vm_name])))
+
+    for vm_name in vm_names:
+        for problem in problems[vm_name]:
+            result = False
             dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-            sys.exit('%s: FAILED!' %(dt))
+            print('%s: VM %s preflight FAILED: %s' %(dt, vm_name, problem.splitlines()[0] if problem != '' else ''))
+    if not result:
+        print('Nothing was done, fix the problems above or use --no-preflight.')
+    elif verbose_level >= 1:
+        dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+        print('%s: Preflight OK.' %(dt))
+
+    return result
+
+def run_vm(vm_name, osvm=None):
+    result = {'vm': vm_name, 'action': None, 'success': False, 'duration': 0, 'error': None}
+
+    start = time.time()
+    try:
+        if osvm is None:
+            osvm = OSVM(vm_name=vm_name)
+        result['action'] = osvm.get_action()
+        result['success'] = yield from osvm.run()
+    except Exception as e:
+        result['error'] = str(e).strip()
+        dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+        print('%s: VM %s FAILED: %s' %(dt, vm_name, result['error']))
+    result['duration'] = time.time() - start
+
+    return result
+
+def run_batch(vm_names, workers, osvms={}):
+    results = []
+
+    if verbose_level >= 1:
+        dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+        print('%s: Starting batch of %s VMs with %s workers...' %(dt, len(vm_names), workers))
+
+    # Summary in the same order as the input list, whatever the completion order
+    results = run_all_steps([run_vm(vm_name, osvms.get(vm_name)) for vm_name in vm_names], workers)
+    print_batch_summary(results)
+
+    return results
+
+def run_pipeline(vm_names, export_workers, import_workers, depth, osvms={}):
+    results = []
+    results_lock = threading.Lock()
+
+    if verbose_level >= 1:
+        dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+        print('%s: Starting pipeline of %s VMs with %s export workers, %s import workers and up to %s VMs in flight...' %(dt, len(vm_names), export_workers, import_workers, depth))
+
+    # One slot per staged image, taken before the export starts and given back once the import has consumed it
+    slots = threading.BoundedSemaphore(depth)
+    import_futures = []
+
+    def finish(result, start, error=None):
+        result['duration'] = time.time() - start
+        if error is not None:
+            result['error'] = str(error).strip()
+            dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+            print('%s: VM %s FAILED: %s' %(dt, result['vm'], result['error']))
+        with results_lock:
+            results.append(result)
+
+    def import_vm(osvm, result, start):
+        try:
+            result['success'] = drive_steps(osvm.run_import())
+            finish(result, start)
+        except Exception as e:
+            finish(result, start, e)
+        finally:
+            slots.release()
+
+    def export_vm(vm_name):
+        result = {'vm': vm_name, 'action': None, 'success': False, 'duration': 0, 'error': None}
+        slots.acquire()
+        start = time.time()
+        try:
+            osvm = osvms.get(vm_name)
+            if osvm is None:
+                osvm = OSVM(vm_name=vm_name)
+            result['action'] = osvm.get_action()
+            if result['action'] != 'transfer':
+                # Nothing to pipeline for a plain export or import
+                result['success'] = drive_steps(osvm.run())
+            elif drive_steps(osvm.run_export()):
+                with results_lock:
+                    import_futures.append(import_executor.submit(import_vm, osvm, result, start))
+                return
+            finish(result, start)
+        except Exception as e:
+            finish(result, start, e)
+        slots.release()
+
+    # Same stages for --engine asyncio, as coroutines holding their slot from the start of the export to the end of the import
+    async def transfer_vm(vm_name, exports, imports, staged):
+        result = {'vm': vm_name, 'action': None, 'success': False, 'duration': 0, 'error': None}
+        async with staged:
+            start = time.time()
+            try:
+                exported = False
+                async with exports:
+                    osvm = osvms.get(vm_name)
+                    if osvm is None:
+                        osvm = OSVM(vm_name=vm_name)
+                    result['action'] = osvm.get_action()
+                    if result['action'] != 'transfer':
+                        result['success'] = await drive_steps_async(osvm.run())
+                    else:
+                        exported = await drive_steps_async(osvm.run_export())
+                if exported:
+                    async with imports:
+                        result['success'] = await drive_steps_async(osvm.run_import())
+                finish(result, start)
+            except Exception as e:
+                finish(result, start, e)
+
+    async def transfer_vms():
+        exports = asyncio.Semaphore(export_workers)
+        imports = asyncio.Semaphore(import_workers)
+        staged = asyncio.Semaphore(depth)
+        await asyncio.gather(*[transfer_vm(vm_name, exports, imports, staged) for vm_name in vm_names])
+
+    if event_loop is not None:
+        event_loop.run_until_complete(transfer_vms())
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=import_workers) as import_executor:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=export_workers) as export_executor:
+                for vm_name in vm_names:
+                    export_executor.submit(export_vm, vm_name)
+
+    results.sort(key=lambda r: vm_names.index(r['vm']))
+    print_batch_summary(results)
+
+    return results
+
+def print_batch_summary(results):
+    name_width = max([len('VM')] + [len(r['vm']) for r in results])
+    print('')
+    print('%-*s  %-8s  %-7s  %10s  %s' %(name_width, 'VM', 'ACTION', 'STATUS', 'DURATION', 'ERROR'))
+    for r in results:
+        status = 'OK' if r['success'] else 'FAILED'
+        action = r['action'] if r['action'] is not None else '-'
+        error = r['error'] if r['error'] is not None else ''
+        print('%-*s  %-8s  %-7s  %9.0fs  %s' %(name_width, r['vm'], action, status, r['duration'], error.splitlines()[0] if error != '' else ''))
+    succeeded = len([r for r in results if r['success']])
+    print('%s/%s VMs done successfully.' %(succeeded, len(results)))
+
+def wait_clean_ups():
+    result = []
+
+    if cleanup_queue is not None:
+        if verbose_level >= 1:
+            dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+            print('%s: Waiting for the cleanups...' %(dt))
+        result = cleanup_queue.wait()
+        print_cleanup_failures(result)
+
+    return result
+
+def sweep_chunk_stores():
+    # One sweep of each store whose recipes were removed, instead of one per removed image
+    for directory in sorted(chunk_stores_to_sweep):
+        if verbose_level >= 1:
+            dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+            print('%s: Freeing the chunks of %s that no image uses anymore...' %(dt, directory))
+        freed = OSChunkStore(directory).sweep()
+        if verbose_level >= 1:
+            dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+            print('%s: %.1f MiB freed.' %(dt, freed / 1024 / 1024))
+
+def print_cleanup_failures(failures):
+    if len(failures) == 0:
+        return
+    print('')
+    print('Cleanup failures (resources left behind, retried by the next run from the journal):')
+    for failure in failures:
+        print('    VM %s, cloud %s: %s: %s' %(failure['vm'], failure['cloud'], failure['resources'], failure['error'].splitlines()[0] if failure['error'] != '' else ''))
 
 def main():
-    osvm = OSVM()
-    osvm.run()
+    if args.engine == 'asyncio':
+        global event_loop
+        event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(event_loop)
+        # Before Python 3.12, the default child watcher waits for each openstack CLI process in a thread of its own
+        if sys.version_info < (3, 12) and hasattr(os, 'pidfd_open'):
+            try:
+                os.close(os.pidfd_open(os.getpid()))
+                watcher = asyncio.PidfdChildWatcher()
+                watcher.attach_loop(event_loop)
+                asyncio.set_child_watcher(watcher)
+            except OSError:
+                # Linux before 5.3
+                pass
+
+    # The deletions of temporary resources are out of the way of the transfers
+    cleanup_workers = default_cleanup_workers
+    if args.cleanup_workers is not None:
+        cleanup_workers = args.cleanup_workers
+    if cleanup_workers > 0:
+        global cleanup_queue
+        cleanup_queue = OSCleanupQueue(cleanup_workers)
+
+    workers = default_workers
+    if args.workers is not None and args.workers > 0:
+        workers = args.workers
+    if args.vms is not None or args.vms_file is not None:
+        vm_names = get_batch_vm_names()
+        if len(vm_names) == 0:
+            sys.exit('No VM to process!')
+
+        # Many VMs in flight: wait on shared list calls instead of one show call per resource
+        if not args.no_batch_polling:
+            global status_watcher
+            status_watcher = OSStatusWatcher()
+
+        osvms = {}
+        if not args.no_preflight:
+            if not run_preflight(vm_names, workers, osvms):
+                sys.exit(1)
+            floating_ip_pool.reserve(args.import_cloud, len([osvm for osvm in osvms.values() if osvm.needs_floating_ip()]))
+
+        if args.pipeline:
+            import_workers = workers
+            if args.import_workers is not None and args.import_workers > 0:
+                import_workers = args.import_workers
+            depth = workers + import_workers
+            if args.pipeline_depth is not None and args.pipeline_depth > 0:
+                depth = args.pipeline_depth
+            results = run_pipeline(vm_names, workers, import_workers, depth, osvms)
+        else:
+            results = run_batch(vm_names, workers, osvms)
+        floating_ip_pool.release_unused()
+        failures = wait_clean_ups()
+        sweep_chunk_stores()
+        if len([r for r in results if not r['success']]) > 0 or len(failures) > 0:
+            sys.exit(1)
+    else:
+        osvm = OSVM()
+        if osvm.get_action() is None:
+            sys.exit('No action can be done!')
+        if not args.no_preflight and not run_preflight([osvm.get_vm_name()], 1, {osvm.get_vm_name(): osvm}):
+            sys.exit(1)
+        result = run_steps(osvm.run())
+        floating_ip_pool.release_unused()
+        failures = wait_clean_ups()
+        sweep_chunk_stores()
+        if not result or len(failures) > 0:
+            dt = datetime.datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+            sys.exit('%s: FAILED!' %(dt))
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    finally:
+        if api_profiler is not None:
+            api_profiler.report()
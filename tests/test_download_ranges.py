@@ -0,0 +1,214 @@
+# Tests of the ranged image downloads of --download-connections, against a local stand-in of the Glance image endpoint
+#   python3 -m pytest tests
+
+import os
+import sys
+import json
+import random
+import hashlib
+import threading
+import http.server
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# os_vm_transfer.py parses its command line when imported
+argv = sys.argv
+sys.argv = ['os_vm_transfer.py']
+import os_vm_transfer
+sys.argv = argv
+
+segment_size = 64 * 1024
+headers = {'X-Auth-Token': 'token'}
+
+class ImageHandler(http.server.BaseHTTPRequestHandler):
+    # Same answers as os_sim.py --serve, plus the connections broken off halfway, the short answers and the empty ones
+    def do_GET(self):
+        endpoint = self.server.endpoint
+        data = endpoint['data']
+        start = 0
+        end = len(data) - 1
+        partial = False
+        range_header = self.headers.get('Range', '')
+        if endpoint['ranges'] and range_header.startswith('bytes='):
+            first, last = range_header[len('bytes='):].split('-')
+            start = int(first)
+            if last != '':
+                end = min(end, int(last))
+            if start >= len(data):
+                self.send_error(416)
+                return
+            partial = True
+        with endpoint['lock']:
+            endpoint['requests'].append((start, end))
+            # Not the first byte asked for the size of the image
+            broken = start in endpoint['breaks'] and end > start
+            if broken:
+                endpoint['breaks'].discard(start)
+            if start in endpoint['shorts'] and end > start:
+                endpoint['shorts'].discard(start)
+                end = start + (end - start + 1) // 2 - 1
+            elif endpoint['empty'] and end > start:
+                end = start - 1
+
+        self.send_response(206 if partial else 200)
+        self.send_header('Content-Length', str(end - start + 1))
+        if partial:
+            self.send_header('Content-Range', 'bytes %s-%s/%s' %(start, end, len(data)))
+        self.end_headers()
+        if broken:
+            # Less than announced, then the connection is closed
+            self.wfile.write(data[start:start + (end - start + 1) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+        else:
+            self.wfile.write(data[start:end + 1])
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def endpoint(monkeypatch):
+    monkeypatch.setattr(os_vm_transfer, 'range_segment_size', segment_size)
+    monkeypatch.setattr(os_vm_transfer, 'range_retry_sleep_time', 0.01)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+    server.daemon_threads = True
+    server.endpoint = {'data': b'', 'ranges': True, 'breaks': set(), 'shorts': set(), 'empty': False, 'requests': [], 'lock': threading.Lock()}
+    server.endpoint['url'] = 'http://127.0.0.1:%s/v2/images/ima-000001/file' %(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.endpoint
+    server.shutdown()
+    server.server_close()
+
+def image_data(size, seed=0):
+    # Random blocks with zero blocks in between, for the sparse writes
+    rng = random.Random(seed)
+    blocks = []
+    while len(blocks) * 4096 < size:
+        blocks.append(bytes(4096) if rng.random() < 0.2 else bytes(rng.getrandbits(8) for _ in range(4096)))
+    return b''.join(blocks)[:size]
+
+def download(endpoint, filename, connections=4):
+    hashes = os_vm_transfer.MultiHash()
+    size = os_vm_transfer.download_ranges(endpoint['url'], headers, filename, connections, hashes)
+    return size, hashes.hexdigests()
+
+def test_download(endpoint, tmp_path):
+    endpoint['data'] = image_data(5 * segment_size + 1234)
+    filename = str(tmp_path / 'vm1.raw')
+
+    size, digests = download(endpoint, filename)
+
+    assert size == len(endpoint['data'])
+    assert digests['md5'] == hashlib.md5(endpoint['data']).hexdigest()
+    assert digests['sha512'] == hashlib.sha512(endpoint['data']).hexdigest()
+    with open(filename, 'rb') as f:
+        assert f.read() == endpoint['data']
+    assert not os.path.exists('%s.ranges' %(filename))
+
+def test_interrupted_segments(endpoint, tmp_path):
+    endpoint['data'] = image_data(4 * segment_size + 100, 1)
+    # The first request of every segment breaks off halfway
+    endpoint['breaks'] = set(range(0, len(endpoint['data']), segment_size))
+    filename = str(tmp_path / 'vm1.raw')
+
+    size, digests = download(endpoint, filename)
+
+    assert size == len(endpoint['data'])
+    assert digests['md5'] == hashlib.md5(endpoint['data']).hexdigest()
+    with open(filename, 'rb') as f:
+        assert f.read() == endpoint['data']
+    # Each segment is resumed after the bytes it received, not downloaded again
+    for start in range(0, len(endpoint['data']), segment_size):
+        end = min(len(endpoint['data']), start + segment_size) - 1
+        resumed = start + (end - start + 1) // 2
+        assert (start, end) in endpoint['requests']
+        assert (resumed, end) in endpoint['requests']
+
+def test_short_answers(endpoint, tmp_path):
+    endpoint['data'] = image_data(3 * segment_size + 10, 5)
+    # The first answer of every segment is a complete 206 response with only the first half of the range
+    endpoint['shorts'] = set(range(0, len(endpoint['data']), segment_size))
+    filename = str(tmp_path / 'vm1.raw')
+
+    size, digests = download(endpoint, filename)
+
+    assert size == len(endpoint['data'])
+    assert digests['md5'] == hashlib.md5(endpoint['data']).hexdigest()
+    with open(filename, 'rb') as f:
+        assert f.read() == endpoint['data']
+
+def test_empty_answers(endpoint, tmp_path):
+    endpoint['data'] = image_data(2 * segment_size, 6)
+    # 206 responses without any byte, forever
+    endpoint['empty'] = True
+    filename = str(tmp_path / 'vm1.raw')
+
+    with pytest.raises(Exception, match='stalled'):
+        download(endpoint, filename, 2)
+
+    # The first byte for the size, then range_tries tries at most per segment
+    segments = [request for request in endpoint['requests'] if request != (0, 0)]
+    assert 0 < len(segments) <= 2 * os_vm_transfer.range_tries
+
+def test_resume_from_ranges_file(endpoint, tmp_path):
+    endpoint['data'] = image_data(4 * segment_size, 2)
+    filename = str(tmp_path / 'vm1.raw')
+    # Left by an interrupted run: segments 0 and 2 are in the file, the others are garbage
+    with open(filename, 'wb') as f:
+        f.write(endpoint['data'][:segment_size])
+        f.write(b'\xff' * segment_size)
+        f.write(endpoint['data'][2 * segment_size:3 * segment_size])
+        f.write(b'\xff' * segment_size)
+    with open('%s.ranges' %(filename), 'w') as f:
+        json.dump({'url': endpoint['url'], 'size': len(endpoint['data']), 'segment_size': segment_size, 'done': [0, 2], 'blocks': {}}, f)
+
+    size, digests = download(endpoint, filename)
+
+    assert size == len(endpoint['data'])
+    # The segments already done are hashed from the file
+    assert digests['md5'] == hashlib.md5(endpoint['data']).hexdigest()
+    with open(filename, 'rb') as f:
+        assert f.read() == endpoint['data']
+    starts = sorted([start for start, end in endpoint['requests'] if (start, end) != (0, 0)])
+    assert starts == [segment_size, 3 * segment_size]
+
+def test_stale_ranges_file(endpoint, tmp_path):
+    endpoint['data'] = image_data(3 * segment_size + 7, 3)
+    filename = str(tmp_path / 'vm1.raw')
+    with open(filename, 'wb') as f:
+        f.write(b'\xff' * (3 * segment_size))
+    # Of another image, or of the same one with another size: nothing of it is kept
+    with open('%s.ranges' %(filename), 'w') as f:
+        json.dump({'url': endpoint['url'], 'size': 3 * segment_size, 'segment_size': segment_size, 'done': [0, 1, 2], 'blocks': {}}, f)
+
+    size, digests = download(endpoint, filename)
+
+    assert size == len(endpoint['data'])
+    assert digests['md5'] == hashlib.md5(endpoint['data']).hexdigest()
+    with open(filename, 'rb') as f:
+        assert f.read() == endpoint['data']
+    assert not os.path.exists('%s.ranges' %(filename))
+
+def test_no_range_support(endpoint, tmp_path):
+    endpoint['data'] = image_data(2 * segment_size, 4)
+    endpoint['ranges'] = False
+    filename = str(tmp_path / 'vm1.raw')
+
+    size, digests = download(endpoint, filename)
+
+    # The caller falls back to a single image save stream
+    assert size is None
+    assert digests['md5'] == hashlib.md5(b'').hexdigest()
+    assert not os.path.exists(filename)
+    assert not os.path.exists('%s.ranges' %(filename))
+
+def test_empty_image(endpoint, tmp_path):
+    endpoint['data'] = b''
+    filename = str(tmp_path / 'vm1.raw')
+
+    size, digests = download(endpoint, filename)
+
+    assert size is None
+    assert not os.path.exists(filename)